@@ -28,6 +28,7 @@ from paddle.distributed.fleet.utils.hybrid_parallel_util import fused_allreduce_
 from paddle.profiler import SummaryView
 
 from ppfleetx.distributed.apis import env, sharding
+from ppfleetx.data.sampler import FastForwardBatchSampler
 from ppfleetx.optims import build_lr_scheduler, build_optimizer
 from ppfleetx.utils.log import logger, get_timestamp, convert_timestamp_to_data
 from ppfleetx.core.engine import BasicEngine, InferenceEngine, TensorRTConfig
@@ -35,6 +36,10 @@ from ppfleetx.core.module import BasicModule
 from ppfleetx.utils.tensor_fusion_helper import all_reduce_parameters
 from ppfleetx.utils.version import version_check
 from ppfleetx.utils.export import export_inference_model
+from ppfleetx.utils.checkpoint import AsyncCheckpointSaver, save_checkpoint_files, \
+    is_checkpoint_done, is_checkpoint_incomplete
+from ppfleetx.utils.device_metrics import AsyncLogFlusher, DeviceMetricAccumulator
+from ppfleetx.utils.step_metrics import JsonlMetricsSink, StepMetricsTracker, get_peak_tflops
 from paddle.incubate.distributed.utils.io import save_for_auto_inference
 
 
@@ -122,6 +127,14 @@ class EagerEngine(BasicEngine):
         self._eval_iters = self._configs['eval_iters']
         self._test_iters = self._configs['test_iters']
         self._logging_freq = self._configs['logging_freq']
+        # Read back the logged metrics in the background, so that the next
+        # step is not blocked by the device.
+        self._log_flusher = AsyncLogFlusher() \
+            if self._configs.get('async_logging', False) else None
+        # Per step timing and throughput, see `_build_step_metrics`.
+        self._metrics_configs = self._configs.get('metrics', None) or {}
+        self._metrics_sinks = []
+        self._step_metrics = None
         self._num_train_epochs = self._configs['num_train_epochs']
         self._accumulate_steps = self._configs['accumulate_steps']
 
@@ -141,6 +154,13 @@ class EagerEngine(BasicEngine):
 
         self._output_dir = self._configs['save_load']['output_dir']
         self._ckpt_dir = self._configs['save_load']['ckpt_dir']
+        self._save_auto_infer = self._configs['save_load'].get(
+            'save_auto_infer', True)
+        # Write the checkpoints in the background, training only waits for
+        # the state dicts being copied to host memory.
+        self._checkpoint_saver = AsyncCheckpointSaver(
+            self._configs['save_load'].get('max_inflight_saves', 1)) \
+            if self._configs['save_load'].get('async_save', False) else None
 
         # TODO(haohongxiang): Remove there extra configs after reconstruct of Fleet API
         self._dist_configs = configs['Distributed']
@@ -200,7 +220,14 @@ class EagerEngine(BasicEngine):
             self._dp_rank = 0
 
         # using for save/load
-        self._load_recovery = {'step': 0, 'epoch': 0, 'rng_state': -1}
+        self._load_recovery = {
+            'step': 0,
+            'epoch': 0,
+            'consumed_samples': 0,
+            'rng_state': -1
+        }
+        # The step to start from in the epoch of the checkpoint.
+        self._resume_step = 0
 
         if 'Inference' in configs:
             self._inference_configs = configs['Inference']
@@ -273,7 +300,7 @@ class EagerEngine(BasicEngine):
         self._module.model.train()
 
         # time count
-        train_losses = []
+        train_metrics = DeviceMetricAccumulator()
         train_step_start = get_timestamp()
         skip_first = True
         # Note(GuoxiaWang): Do not use len(train_data_loader()),
@@ -281,32 +308,38 @@ class EagerEngine(BasicEngine):
         total_train_batch = len(train_data_loader)
         total_eval_batch = len(
             valid_data_loader) if valid_data_loader is not None else 0
-        for step, batch in enumerate(train_data_loader):
-
-            if epoch_index == self._load_recovery['epoch']:
-                if step < self._load_recovery['step']:
-                    continue
+        samples_per_step = FastForwardBatchSampler.get_samples_per_step(
+            train_data_loader.batch_sampler)
+        # The data loader of the epoch of the checkpoint has been fast
+        # forwarded to the resume step by `_fast_forward`.
+        start_step = self._resume_step \
+            if epoch_index == self._load_recovery['epoch'] else 0
+        if self._step_metrics:
+            self._step_metrics.start_data_wait()
+        for step, batch in enumerate(train_data_loader, start_step):
+            if self._step_metrics:
+                self._step_metrics.start_step()
 
             loss = self._fit_impl(batch)
-            train_losses.append(loss)
+            train_metrics.update(loss=loss)
+
+            if self._step_metrics:
+                self._step_metrics.end_step(step, epoch_index)
 
             if (step + 1) % self._logging_freq == 0:
                 train_step_cost = get_timestamp() - train_step_start
-                numpy_losses = [loss.numpy()[0] for loss in train_losses]
                 log_dict = {
                     'epoch': epoch_index,
                     'total_epoch': self._num_train_epochs,
                     'batch': step,
                     'total_batch': total_train_batch,
-                    'train_cost': train_step_cost
-                    if step == 0 else train_step_cost / self._logging_freq,
-                    'loss': sum(numpy_losses) / len(numpy_losses),
+                    'train_cost': train_step_cost / train_metrics.count,
                     'lr': self._optimizer.get_lr()
                 }
-                self._module.training_step_end(log_dict)
+                self._log_metrics(train_metrics, log_dict,
+                                  self._module.training_step_end)
 
                 train_step_start = get_timestamp()
-                train_losses = []
 
             if self._lr_scheduler is not None and self._lr_scheduler_mode == 'step':
                 self._lr_scheduler.step()
@@ -316,40 +349,70 @@ class EagerEngine(BasicEngine):
             if self._run_mode == 'step' and not skip_first:
                 if self._eval_freq > 0 and step % self._eval_freq == 0:
 
-                    eval_losses = []
+                    eval_metrics = DeviceMetricAccumulator()
                     eval_step_start = get_timestamp()
 
                     for eval_step, batch in enumerate(valid_data_loader):
                         loss = self._evaluate_impl(batch)
-                        eval_losses.append(loss)
+                        eval_metrics.update(loss=loss)
 
                         if eval_step >= self._eval_iters - 1:
                             break
 
                     eval_step_cost = get_timestamp() - eval_step_start
-                    eval_loss = sum(eval_losses) / len(eval_losses)
 
                     log_dict = {
-                        'loss': eval_loss.numpy()[0],
                         'epoch': epoch_index,
                         'batch': eval_step,
                         'total_batch': total_eval_batch,
                         'eval_cost': eval_step_cost / self._logging_freq,
                     }
-                    self._module.validation_step_end(log_dict)
+                    self._log_metrics(eval_metrics, log_dict,
+                                      self._module.validation_step_end)
 
                 if self._save_steps > 0 and step % self._save_steps == 0:
-                    paddle.device.cuda.synchronize()
-                    self.save(epoch=epoch_index, step=step)
+                    if self._checkpoint_saver is None:
+                        paddle.device.cuda.synchronize()
+                    self.save(
+                        epoch=epoch_index,
+                        step=step,
+                        consumed_samples=(step + 1) * samples_per_step)
             else:
                 skip_first = False
 
             if self._run_mode == 'step' and step >= self._max_steps:
+                self._flush_logs()
                 return
 
             if self.profiler:
                 self.profiler.step()
 
+            if self._step_metrics:
+                self._step_metrics.start_data_wait()
+
+        self._flush_logs()
+
+    def _log_metrics(self, metrics, log_dict, log_fn):
+        """
+        Reads back the averages of metrics, a `DeviceMetricAccumulator`, into
+        log_dict and calls log_fn with it. The metrics are reset, and with
+        async_logging they are read back and logged in the background.
+        """
+        snapshot = metrics.snapshot()
+
+        def _log(values):
+            log_dict.update(values)
+            log_fn(log_dict)
+
+        if self._log_flusher is not None:
+            self._log_flusher.submit(snapshot, _log)
+        else:
+            _log(snapshot.read())
+
+    def _flush_logs(self):
+        if self._log_flusher is not None:
+            self._log_flusher.flush()
+
     def fit(self, epoch=1, train_data_loader=None, valid_data_loader=None):
         """
         Run the full process of training/validation/save loop.
@@ -370,6 +433,8 @@ class EagerEngine(BasicEngine):
         start_epoch = self._load_recovery['epoch']
         if self._load_recovery['rng_state'] != -1:
             paddle.set_cuda_rng_state(self._load_recovery['rng_state'])
+        self._fast_forward(train_data_loader)
+        self._step_metrics = self._build_step_metrics(train_data_loader)
 
         for epoch_index in range(start_epoch, epoch):
             train_epoch_start = get_timestamp()
@@ -398,7 +463,19 @@ class EagerEngine(BasicEngine):
                 self._module.validation_epoch_end(log_dict)
 
             if self._save_epoch > 0 and self._run_mode == 'epoch' and epoch_index % self._save_epoch == 0:
-                self.save(epoch=epoch_index, step=len(train_data_loader))
+                self.save(
+                    epoch=epoch_index,
+                    step=len(train_data_loader),
+                    consumed_samples=len(train_data_loader) *
+                    FastForwardBatchSampler.get_samples_per_step(
+                        train_data_loader.batch_sampler))
+
+        if self._checkpoint_saver is not None:
+            self._checkpoint_saver.wait()
+
+        if self._step_metrics:
+            self._step_metrics.close()
+            self._step_metrics = None
 
         logger.info(
             "The training process is complete and total cost of time for training is : {}".
@@ -407,6 +484,60 @@ class EagerEngine(BasicEngine):
         if self.profiler:
             self._profiler_done()
 
+    def add_metrics_sink(self, sink):
+        """
+        Adds a callable to report the record dict of every training step to,
+        besides the JSONL file, with Engine.metrics.enable.
+        """
+        self._metrics_sinks.append(sink)
+
+    def _build_step_metrics(self, train_data_loader):
+        if not self._metrics_configs.get('enable', False):
+            return None
+
+        output_file = self._metrics_configs.get('output_file', None)
+        if output_file is None:
+            output_file = os.path.join(
+                self._output_dir,
+                "step_metrics.rank{}.jsonl".format(dist.get_rank()))
+        peak_tflops = self._metrics_configs.get('peak_tflops', None)
+        if peak_tflops is None and self._use_pure_fp16:
+            peak_tflops = get_peak_tflops()
+
+        return StepMetricsTracker(
+            FastForwardBatchSampler.get_samples_per_step(
+                train_data_loader.batch_sampler),
+            tokens_per_sample=getattr(self._module, 'tokens_per_sample',
+                                      None),
+            flops_per_sample=getattr(self._module, 'flops_per_sample', None),
+            world_size=dist.get_world_size(),
+            peak_tflops=peak_tflops,
+            sync_timing=self._metrics_configs.get('sync_timing', False),
+            sinks=[JsonlMetricsSink(output_file)] + self._metrics_sinks)
+
+    def _fast_forward(self, train_data_loader):
+        """
+        Makes the epoch of the checkpoint start after its consumed samples at
+        the sampler level, instead of loading and dropping all the consumed
+        batches.
+        """
+        samples_per_step = FastForwardBatchSampler.get_samples_per_step(
+            train_data_loader.batch_sampler)
+        consumed_samples = self._load_recovery['consumed_samples']
+        if consumed_samples is None:
+            # The checkpoints without consumed_samples restart from the
+            # saved step as before.
+            consumed_samples = self._load_recovery['step'] * samples_per_step
+        self._resume_step = consumed_samples // samples_per_step
+
+        if consumed_samples > 0:
+            logger.info(
+                "Fast forward the data loader of epoch %d to step %d, %d "
+                "samples are skipped." % (self._load_recovery['epoch'],
+                                          self._resume_step, consumed_samples))
+            train_data_loader.batch_sampler = FastForwardBatchSampler(
+                train_data_loader.batch_sampler, consumed_samples)
+
     def _fit_impl(self, batch):
         self._module.model.train()
 
@@ -436,7 +567,11 @@ class EagerEngine(BasicEngine):
                 loss = self._module.model.forward_backward_pipeline(
                     batch, self._scaler)
 
+        if self._step_metrics:
+            self._step_metrics.end_phase('forward_backward')
         self._optim_update_params()
+        if self._step_metrics:
+            self._step_metrics.end_phase('optimizer')
         return loss
 
     def _model_forward_backward(self, batch):
@@ -533,31 +668,32 @@ class EagerEngine(BasicEngine):
         self._module.model.eval()
 
         eval_step_start = get_timestamp()
-        eval_losses = []
+        eval_metrics = DeviceMetricAccumulator()
         total_eval_batch = len(valid_data_loader)
         for eval_step, batch in enumerate(valid_data_loader):
             loss = self._evaluate_impl(batch)
-            eval_losses.append(loss.numpy()[0])
+            eval_metrics.update(loss=loss)
 
             if eval_step % self._logging_freq == 0:
                 eval_step_cost = get_timestamp() - eval_step_start
                 log_dict = {
-                    'loss': sum(eval_losses) / len(eval_losses),
                     'epoch': epoch,
                     'batch': eval_step,
                     'total_batch': total_eval_batch,
-                    'eval_cost': eval_step_cost
-                    if eval_step == 0 else eval_step_cost / self._logging_freq,
+                    'eval_cost': eval_step_cost / eval_metrics.count,
                 }
-                self._module.validation_step_end(log_dict)
+                self._log_metrics(eval_metrics, log_dict,
+                                  self._module.validation_step_end)
                 eval_step_start = get_timestamp()
-                eval_losses = []
 
             if self._run_mode == 'step' and eval_step >= self._max_steps:
+                self._flush_logs()
                 logger.info("[eval] epoch {} : evaluting process is complete.".
                             format(epoch))
                 return
 
+        self._flush_logs()
+
     @paddle.no_grad()
     def _evaluate_impl(self, batch):
         self._module.model.eval()
@@ -590,30 +726,31 @@ class EagerEngine(BasicEngine):
         self._module.model.eval()
 
         test_start = get_timestamp()
-        test_losses = []
+        test_metrics = DeviceMetricAccumulator()
         for test_step, batch in enumerate(test_data_loader):
             loss = self._predict_impl(batch)
 
-            test_losses.append(loss.numpy()[0])
+            test_metrics.update(loss=loss)
 
             if test_step % self._logging_freq == 0:
                 test_cost = get_timestamp() - test_start
                 log_dict = {
-                    'loss': sum(test_losses) / len(test_losses),
                     'epoch': epoch,
                     'batch': test_step,
-                    'test_cost': test_cost
-                    if test_step == 0 else test_cost / self._logging_freq,
+                    'test_cost': test_cost / test_metrics.count,
                 }
-                self._module.test_step_end(log_dict)
+                self._log_metrics(test_metrics, log_dict,
+                                  self._module.test_step_end)
                 test_start = get_timestamp()
-                test_losses = []
 
             if test_step >= self._max_steps:
+                self._flush_logs()
                 logger.info("The predicting process is complete.")
                 del test_data_loader
                 return
 
+        self._flush_logs()
+
     @paddle.no_grad()
     def _predict_impl(self, batch):
         self._module.model.eval()
@@ -631,9 +768,11 @@ class EagerEngine(BasicEngine):
 
         return loss
 
-    def save(self, epoch=0, step=0):
+    def save(self, epoch=0, step=0, consumed_samples=0):
         """
         save the state dicts of model and optimizer into an checkpoint.
+        consumed_samples is the number of samples of the epoch consumed by
+        all the data parallel ranks, the training resumes after them.
         """
         if self._dp_rank != 0:
             logger.info("DP_Rank %d doesn't save model" % self._dp_rank)
@@ -652,21 +791,27 @@ class EagerEngine(BasicEngine):
 
             if self._sharding_stage == 3:
                 self._module.model.get_all_parameters(convert2cpu=False)
-            paddle.save(self._module.model.state_dict(),
-                        os.path.join(save_dir, "model.pdparams"))
-            paddle.save(self._optimizer.state_dict(),
-                        os.path.join(save_dir, "model_state.pdopt"))
 
             meta_dict = {
                 "epoch": epoch,
                 "step": step,
+                "consumed_samples": consumed_samples,
                 "cuda_rng_state": paddle.get_cuda_rng_state()
             }
-            paddle.save(meta_dict, os.path.join(save_dir, "meta_state.pdopt"))
+            files = {
+                "model.pdparams": self._module.model.state_dict(),
+                "model_state.pdopt": self._optimizer.state_dict(),
+                "meta_state.pdopt": meta_dict,
+            }
+            if self._checkpoint_saver is not None:
+                self._checkpoint_saver.save(save_dir, files)
+            else:
+                save_checkpoint_files(save_dir, files)
 
-            save_auto_dir = os.path.join(output_dir, "auto_infer")
-            save_for_auto_inference(
-                os.path.join(save_auto_dir, "auto"), self._module.model)
+            if self._save_auto_infer:
+                save_auto_dir = os.path.join(output_dir, "auto_infer")
+                save_for_auto_inference(
+                    os.path.join(save_auto_dir, "auto"), self._module.model)
 
         else:
             raise TypeError("`save` requires a valid value of `output_dir`.")
@@ -685,6 +830,17 @@ class EagerEngine(BasicEngine):
             opt_path = os.path.join(load_dir, "model_state.pdopt")
             meta_path = os.path.join(load_dir, "meta_state.pdopt")
 
+            if not is_checkpoint_done(load_dir):
+                if is_checkpoint_incomplete(load_dir):
+                    raise ValueError(
+                        "The checkpoint in %s is incomplete, its saving was "
+                        "interrupted. Please load an earlier checkpoint." %
+                        load_dir)
+                if os.path.isdir(load_dir):
+                    logger.warning(
+                        "No checkpoint.done found in %s, load it as a "
+                        "checkpoint saved by an earlier version." % load_dir)
+
             if os.path.exists(model_path):
                 model_dict = paddle.load(model_path)
                 for name, param in self._module.model.state_dict().items():
@@ -697,7 +853,7 @@ class EagerEngine(BasicEngine):
 
                 self._module.model.set_state_dict(model_dict)
             else:
-                raise ValueError("No optimizer checkpoint file found in %s." %
+                raise ValueError("No model checkpoint file found in %s." %
                                  model_path)
 
             if self.mode == 'train':
@@ -713,6 +869,8 @@ class EagerEngine(BasicEngine):
                     self._load_recovery = {
                         'step': meta_dict['step'],
                         'epoch': meta_dict['epoch'],
+                        'consumed_samples':
+                        meta_dict.get('consumed_samples', None),
                         'rng_state': meta_dict['cuda_rng_state']
                     }
                 else:
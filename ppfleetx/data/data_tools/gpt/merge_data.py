@@ -0,0 +1,60 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import argparse
+import sys
+
+try:
+    from ppfleetx.data.data_tools.gpt.preprocess_data import merge_datasets, print_summary
+except ImportError:
+    __dir__ = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.abspath(os.path.join(__dir__, '../../../../')))
+    from ppfleetx.data.data_tools.gpt.preprocess_data import merge_datasets, print_summary
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--input_path',
+        type=str,
+        required=True,
+        help='Directory of the preprocessed shards, i.e. xxx_ids.npy and '
+        'xxx_idx.npz files, they are merged in the order of file name.')
+    parser.add_argument(
+        '--output_prefix',
+        type=str,
+        required=True,
+        help='Output prefix to store output file.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+
+    input_prefixes = sorted(
+        os.path.join(args.input_path, f[:-len("_idx.npz")])
+        for f in os.listdir(args.input_path) if f.endswith("_idx.npz"))
+    if len(input_prefixes) == 0:
+        print("No preprocessed file found!")
+        exit(-1)
+
+    print("Merging %d files..." % len(input_prefixes))
+    writer = merge_datasets(input_prefixes, args.output_prefix)
+    print_summary(writer)
+
+
+if __name__ == "__main__":
+    main()
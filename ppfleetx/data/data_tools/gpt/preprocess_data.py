@@ -14,12 +14,17 @@
 
 import os
 import io
+import itertools
 import re
 import argparse
 import json
 import multiprocessing
+import shutil
+import struct
 import sys
 import time
+import zipfile
+from functools import partial
 
 import numpy as np
 from tqdm import tqdm
@@ -123,6 +128,24 @@ def get_args():
         default=1,
         help='Number of worker processes to launch')
 
+    group = parser.add_argument_group(title='sharded processing')
+    group.add_argument(
+        '--shard',
+        action='store_true',
+        help="Process every input file (or byte range of a .jsonl file) as "
+        "an independent shard in parallel. Finished shards are skipped when "
+        "restarted, and all the shards are merged into output_prefix.")
+    group.add_argument(
+        '--shard_size_mb',
+        type=int,
+        default=0,
+        help="Split .jsonl files into shards of about this many MB, 0 means "
+        "one shard per file. .zst files are always one shard per file.")
+    group.add_argument(
+        '--no_merge',
+        action='store_true',
+        help="Only process the shards, merge them later by merge_data.py.")
+
     args = parser.parse_args()
     if args.chinese:
         global CHINESE_SEG_FUNC
@@ -294,6 +317,250 @@ class Converter(object):
         return doc_ids, len(text.encode("utf-8"))
 
 
+# Fixed size of the .npy header, so it can be rewritten in place once the
+# length of the array is known.
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(dtype, length):
+    """
+    The version 1.0 .npy header of a 1-D array, padded to NPY_HEADER_SIZE.
+    """
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.dtype(dtype).str, length)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack(
+        "<H", len(header)) + header.encode("latin1")
+
+
+class DatasetWriter(object):
+    """
+    Append the token ids, sentence lengths and document offsets to disk as
+    the documents come in, so the memory usage does not grow with the corpus.
+
+    The token ids are written right after a placeholder .npy header, which is
+    rewritten with the final length by `finalize` before the file is renamed
+    to `{output_prefix}_ids.npy`. The lengths and offsets are kept in raw
+    files and stored into `{output_prefix}_idx.npz` by `finalize`.
+    """
+
+    def __init__(self, output_prefix, dtype, buffer_size=16 * 1024 * 1024):
+        self.output_prefix = output_prefix
+        self.dtype = np.dtype(dtype)
+        self.ids_filename = output_prefix + "_ids.npy"
+        self.idx_filename = output_prefix + "_idx.npz"
+        self.tmp_ids_filename = self.ids_filename + ".tmp"
+        self.tmp_lens_filename = output_prefix + "_idx.lens.tmp"
+        self.tmp_docs_filename = output_prefix + "_idx.docs.tmp"
+
+        self.num_tokens = 0
+        self.num_sentences = 0
+        self.num_docs = 0
+
+        self.ids_stream = open(self.tmp_ids_filename, "wb", buffer_size)
+        self.ids_stream.write(npy_header(self.dtype, 0))
+        self.lens_stream = open(self.tmp_lens_filename, "wb", buffer_size)
+        # Cunsum on document on every sentence num, type=np.int64
+        self.docs_stream = open(self.tmp_docs_filename, "wb", buffer_size)
+        self.docs_stream.write(np.array([0], dtype=np.int64).tobytes())
+
+    def add_document(self, doc):
+        """
+        doc: list of sentences, each one is a list of token ids.
+        """
+        sentences = [sentence for sentence in doc if len(sentence) > 0]
+        if len(sentences) == 0:
+            return
+        lens = np.array(
+            [len(sentence) for sentence in sentences], dtype=np.int32)
+        token_ids = np.array(
+            list(itertools.chain.from_iterable(sentences)), dtype=self.dtype)
+
+        self.ids_stream.write(token_ids.tobytes(order='C'))
+        self.lens_stream.write(lens.tobytes(order='C'))
+        self.num_tokens += len(token_ids)
+        self.num_sentences += len(lens)
+        self.num_docs += 1
+        self.docs_stream.write(
+            np.array([self.num_sentences], dtype=np.int64).tobytes())
+
+    def add_dataset(self, token_ids, lens, docs, chunk_size=16 * 1024 * 1024):
+        """
+        Append a whole preprocessed dataset, e.g. the memmap of a `_ids.npy`
+        and the `lens` and `docs` of a `_idx.npz`, the document offsets are
+        shifted by the sentences already written.
+        """
+        if token_ids.dtype != self.dtype:
+            raise ValueError("Can not merge token ids of dtype {} into {}.".
+                             format(token_ids.dtype, self.dtype))
+        for start in range(0, len(token_ids), chunk_size):
+            self.ids_stream.write(
+                np.ascontiguousarray(token_ids[start:start + chunk_size])
+                .tobytes(order='C'))
+        self.lens_stream.write(
+            np.asarray(
+                lens, dtype=np.int32).tobytes(order='C'))
+        self.docs_stream.write((np.asarray(
+            docs[1:], dtype=np.int64) + self.num_sentences).tobytes(order='C'))
+        self.num_tokens += len(token_ids)
+        self.num_sentences += len(lens)
+        self.num_docs += len(docs) - 1
+
+    def finalize(self):
+        for stream in [self.ids_stream, self.lens_stream, self.docs_stream]:
+            stream.close()
+
+        with open(self.tmp_ids_filename, "r+b") as f:
+            f.write(npy_header(self.dtype, self.num_tokens))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.tmp_ids_filename, self.ids_filename)
+
+        tmp_idx_filename = self.idx_filename + ".tmp"
+        with zipfile.ZipFile(
+                tmp_idx_filename, mode="w",
+                compression=zipfile.ZIP_STORED) as zf:
+            for name, filename, dtype, length in [
+                ("lens", self.tmp_lens_filename, np.int32,
+                 self.num_sentences),
+                ("docs", self.tmp_docs_filename, np.int64, self.num_docs + 1)
+            ]:
+                with zf.open(name + ".npy", "w", force_zip64=True) as out, \
+                        open(filename, "rb") as f:
+                    out.write(npy_header(dtype, length))
+                    shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+        os.replace(tmp_idx_filename, self.idx_filename)
+
+        os.remove(self.tmp_lens_filename)
+        os.remove(self.tmp_docs_filename)
+
+
+def merge_datasets(input_prefixes, output_prefix):
+    """
+    Concatenate the `_ids.npy` and `_idx.npz` of input_prefixes in order into
+    output_prefix without tokenizing again.
+    """
+    dtype = np.load(input_prefixes[0] + "_ids.npy", mmap_mode="r").dtype
+    writer = DatasetWriter(output_prefix, dtype)
+    for input_prefix in tqdm(input_prefixes):
+        token_ids = np.load(input_prefix + "_ids.npy", mmap_mode="r")
+        process_data = np.load(input_prefix + "_idx.npz")
+        writer.add_dataset(token_ids, process_data["lens"],
+                           process_data["docs"])
+    writer.finalize()
+    return writer
+
+
+def get_shards(file_paths, shards_dir, shard_size_mb):
+    """
+    Split the inputs into shards of (file_path, start, end, shard_prefix),
+    a shard holds the lines starting in the byte range [start, end) of the
+    file. The shards only depend on the inputs, so they are the same when
+    restarted.
+    """
+    shards = []
+    for file_index, file_path in enumerate(file_paths):
+        if not file_path.endswith((".zst", ".jsonl")):
+            print("Unexpected data format, skiped %s" % file_path)
+            continue
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        file_size = os.path.getsize(file_path)
+        shard_size = shard_size_mb * 1024 * 1024
+        if file_path.endswith(".zst") or shard_size <= 0:
+            shard_size = max(file_size, 1)
+        for shard_index, start in enumerate(
+                range(0, max(file_size, 1), shard_size)):
+            shard_prefix = os.path.join(shards_dir, "{:05d}_{}_{:05d}".format(
+                file_index, name, shard_index))
+            shards.append((file_path, start, min(start + shard_size,
+                                                 file_size), shard_prefix))
+    return shards
+
+
+def read_shard(file_path, start, end):
+    if file_path.endswith(".zst"):
+        import zstandard
+        cctx = zstandard.ZstdDecompressor()
+        with open(file_path, 'rb') as fh:
+            for line in io.BufferedReader(cctx.stream_reader(fh)):
+                yield line
+        return
+
+    with open(file_path, 'rb') as f:
+        # The line across start belongs to the previous shard.
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def process_shard(convert, save_dtype, shard):
+    file_path, start, end, shard_prefix = shard
+    done_filename = shard_prefix + ".done"
+    if os.path.isfile(done_filename):
+        with open(done_filename, "r") as f:
+            return shard_prefix, json.load(f), True
+
+    writer = DatasetWriter(shard_prefix, save_dtype)
+    total_bytes_processed = 0
+    for line in read_shard(file_path, start, end):
+        doc, bytes_processed = convert.encode(line)
+        total_bytes_processed += bytes_processed
+        writer.add_document(doc)
+    writer.finalize()
+
+    stats = {
+        "file_path": file_path,
+        "start": start,
+        "end": end,
+        "bytes": total_bytes_processed,
+        "tokens": writer.num_tokens,
+        "sentences": writer.num_sentences,
+        "documents": writer.num_docs,
+    }
+    # The marker is written last, a shard without it is processed again.
+    with open(done_filename + ".tmp", "w") as f:
+        json.dump(stats, f)
+    os.replace(done_filename + ".tmp", done_filename)
+    return shard_prefix, stats, False
+
+
+def main_shard(args, file_paths, convert, save_dtype):
+    shards_dir = args.output_prefix + "_shards"
+    os.makedirs(shards_dir, exist_ok=True)
+    shards = get_shards(file_paths, shards_dir, args.shard_size_mb)
+    print("Processing %d shards into %s" % (len(shards), shards_dir))
+
+    pool = multiprocessing.Pool(args.workers, initializer=convert.initializer)
+    startup_start = time.time()
+    total_bytes_processed = 0
+    for i, (shard_prefix, stats, skipped) in enumerate(
+            pool.imap_unordered(
+                partial(process_shard, convert, save_dtype), shards),
+            start=1):
+        if skipped:
+            print("Skip finished shard %s" % shard_prefix, file=sys.stderr)
+            continue
+        total_bytes_processed += stats["bytes"]
+        elapsed = time.time() - startup_start
+        mbs = total_bytes_processed / elapsed / 1024 / 1024
+        print(
+            f"Processed shard {shard_prefix} ({i}/{len(shards)}),",
+            f"{stats['documents']} documents ({mbs:.4f} MB/s).",
+            file=sys.stderr)
+    pool.close()
+
+    if args.no_merge:
+        return
+
+    print("Merging shards to files...")
+    return merge_datasets([shard[3] for shard in shards], args.output_prefix)
+
+
 def main():
     args = get_args()
 
@@ -318,22 +585,18 @@ def main():
     else:
         save_dtype = np.int32
 
-    pool = multiprocessing.Pool(args.workers, initializer=convert.initializer)
+    file_paths.sort()
 
-    # We use BytesIO to store the ids.
-    token_ids_stream = io.BytesIO()
-    sentlens_stream = io.BytesIO()
-    # # Cumsum on tokens num
-    # sent_cumsum_stream = io.BytesIO()
-    # sent_cumsum_stream.write((0).to_bytes(8, byteorder='little', signed=True))
-    # Cunsum on document on every sentence num, type=np.int64
-    doc_cumsum_stream = io.BytesIO()
-    doc_cumsum_stream.write((0).to_bytes(8, byteorder='little', signed=True))
+    if args.shard:
+        writer = main_shard(args, file_paths, convert, save_dtype)
+        if writer is not None:
+            print_summary(writer)
+        return
 
-    sent_count = 0
-    # token_count = 0
+    pool = multiprocessing.Pool(args.workers, initializer=convert.initializer)
 
-    file_paths.sort()
+    # Write the ids to disk as soon as the documents are encoded.
+    writer = DatasetWriter(args.output_prefix, save_dtype)
 
     step = 0
     total_bytes_processed = 0
@@ -355,28 +618,7 @@ def main():
         for i, (doc, bytes_processed) in enumerate(encoded_docs, start=1):
             step += 1
             total_bytes_processed += bytes_processed
-            if len(doc) == 0:
-                continue
-
-            for sentence in doc:
-                sentence_len = len(sentence)
-                if sentence_len == 0:
-                    continue
-                sentlens_stream.write(
-                    sentence_len.to_bytes(
-                        4, byteorder='little', signed=True))
-                # token_count += sentence_len
-                # sent_cumsum_stream.write(
-                #     token_count.to_bytes(
-                #         8, byteorder='little', signed=True))
-                sent_count += 1
-                token_ids_stream.write(
-                    np.array(
-                        sentence, dtype=save_dtype).tobytes(order='C'))
-
-            doc_cumsum_stream.write(
-                sent_count.to_bytes(
-                    8, byteorder='little', signed=True))
+            writer.add_document(doc)
 
             if step % args.log_interval == 0:
                 current = time.time()
@@ -389,20 +631,18 @@ def main():
 
     pool.close()
     print("Saving tokens to files...")
-    all_doc_ids = np.frombuffer(token_ids_stream.getbuffer(), dtype=save_dtype)
-    lens = np.frombuffer(sentlens_stream.getbuffer(), dtype=np.int32)
-    # sents = np.frombuffer(sent_cumsum_stream.getbuffer(), dtype=np.int64)
-    docs = np.frombuffer(doc_cumsum_stream.getbuffer(), dtype=np.int64)
-    np.save(args.output_prefix + "_ids.npy", all_doc_ids)
-    # np.savez(args.output_prefix + "_idx.npz", lens=lens, sents=sents, docs=docs)
-    np.savez(args.output_prefix + "_idx.npz", lens=lens, docs=docs)
-
-    print("Total sentences num: %d" % len(lens))
-    print("Total documents num: %d" % (len(docs) - 1))
-    print("Total tokens num: %d" % len(all_doc_ids))
-    print("Average tokens per sentence: %.2f" % (len(all_doc_ids) / len(lens)))
-    print("Average tokens per document: %.2f" % (len(all_doc_ids) /
-                                                 (len(docs) - 1)))
+    writer.finalize()
+    print_summary(writer)
+
+
+def print_summary(writer):
+    print("Total sentences num: %d" % writer.num_sentences)
+    print("Total documents num: %d" % writer.num_docs)
+    print("Total tokens num: %d" % writer.num_tokens)
+    print("Average tokens per sentence: %.2f" %
+          (writer.num_tokens / writer.num_sentences))
+    print("Average tokens per document: %.2f" %
+          (writer.num_tokens / writer.num_docs))
 
 
 if __name__ == "__main__":
@@ -28,6 +28,15 @@ import collections
 import numpy as np
 import paddle
 
+from ..index_map_cache import (
+    get_corpus_fingerprint,
+    get_cache_key,
+    build_or_load_index_maps,
+    save_index_map,
+    index_map_lock,
+    wait_for_index_maps,
+    use_barrier, )
+
 
 def get_local_rank():
     return int(os.getenv("PADDLE_RANK_IN_NODE", 0))
@@ -586,10 +595,20 @@ def get_train_valid_test_split_(splits_string, size):
     return splits_index
 
 
-def get_samples_mapping(indexed_dataset, data_prefix, num_epochs,
-                        max_num_samples, max_seq_length, short_seq_prob, seed,
-                        name, binary_head, share_folder):
-    """Get a list that maps a sample index to a starting sentence index, end sentence index, and length"""
+def get_samples_mapping(indexed_dataset,
+                        data_prefix,
+                        num_epochs,
+                        max_num_samples,
+                        max_seq_length,
+                        short_seq_prob,
+                        seed,
+                        name,
+                        binary_head,
+                        share_folder,
+                        cache_dir=None):
+    """Get a list that maps a sample index to a starting sentence index, end sentence index, and length.
+    If cache_dir is set, the mapping is kept in this shared cache and keyed by the content of the
+    corpus split and the other arguments, instead of next to the data_prefix."""
 
     if not num_epochs:
         if not max_num_samples:
@@ -599,28 +618,11 @@ def get_samples_mapping(indexed_dataset, data_prefix, num_epochs,
     if not max_num_samples:
         max_num_samples = np.iinfo(np.int64).max - 1
 
-    # Filename of the index mapping
-    indexmap_filename = data_prefix
-    indexmap_filename += '_{}_indexmap'.format(name)
-    if num_epochs != (np.iinfo(np.int32).max - 1):
-        indexmap_filename += '_{}ep'.format(num_epochs)
-    if max_num_samples != (np.iinfo(np.int64).max - 1):
-        indexmap_filename += '_{}mns'.format(max_num_samples)
-    indexmap_filename += '_{}msl'.format(max_seq_length)
-    indexmap_filename += '_{:0.2f}ssp'.format(short_seq_prob)
-    indexmap_filename += '_{}s'.format(seed)
-    indexmap_filename += '.npy'
-
     local_rank = get_local_rank()
     if share_folder:
         local_rank = paddle.distributed.get_rank()
-    # Build the indexed mapping if not exist.
-
-    if local_rank == 0 and \
-       not os.path.isfile(indexmap_filename):
-        print(' > WARNING: could not find index map file {}, building '
-              'the indices on rank 0 ...'.format(indexmap_filename))
 
+    def build_samples_mapping():
         # Make sure the types match the helpers input types.
         assert indexed_dataset.doc_idx.dtype == np.int64
         print(indexed_dataset.sizes.dtype)
@@ -644,35 +646,67 @@ def get_samples_mapping(indexed_dataset, data_prefix, num_epochs,
             max_num_samples, max_seq_length, short_seq_prob, seed, True, 2
             if binary_head else 1)
         print_rank_0(' > done building sapmles index maping')
-        start_time = time.time()
-        np.save(indexmap_filename, samples_mapping, allow_pickle=True)
-        print_rank_0(' > saved the index mapping in {}'.format(
-            indexmap_filename))
-        # Make sure all the ranks have built the mapping
-        print_rank_0(' > elasped time to build and save samples mapping '
-                     '(seconds): {:4f}'.format(time.time() - start_time))
+        return samples_mapping
+
+    if cache_dir is not None:
+        params = dict(
+            kind="ernie_samples_mapping",
+            corpus=get_corpus_fingerprint(indexed_dataset.doc_idx,
+                                          indexed_dataset.sizes),
+            num_epochs=int(num_epochs),
+            max_num_samples=int(max_num_samples),
+            max_seq_length=int(max_seq_length),
+            short_seq_prob=float(short_seq_prob),
+            seed=int(seed),
+            binary_head=bool(binary_head))
+        samples_mapping = build_or_load_index_maps(
+            cache_dir,
+            get_cache_key(**params), params,
+            lambda: {"samples_mapping": build_samples_mapping()},
+            local_rank == 0)["samples_mapping"]
+        print_rank_0('    total number of samples: {}'.format(
+            samples_mapping.shape[0]))
+        return samples_mapping
 
-    else:
-        while True:
-            if (not os.path.isfile(indexmap_filename)):
-                time.sleep(3)
-            else:
-                try:
-                    np.load(
-                        indexmap_filename, allow_pickle=True, mmap_mode='r')
-                    break
-                except Exception as e:
-                    print(
-                        "%s file is still writing or damaged, please wait a moment."
-                        % indexmap_filename)
-                    time.sleep(3)
+    # Filename of the index mapping
+    indexmap_filename = data_prefix
+    indexmap_filename += '_{}_indexmap'.format(name)
+    if num_epochs != (np.iinfo(np.int32).max - 1):
+        indexmap_filename += '_{}ep'.format(num_epochs)
+    if max_num_samples != (np.iinfo(np.int64).max - 1):
+        indexmap_filename += '_{}mns'.format(max_num_samples)
+    indexmap_filename += '_{}msl'.format(max_seq_length)
+    indexmap_filename += '_{:0.2f}ssp'.format(short_seq_prob)
+    indexmap_filename += '_{}s'.format(seed)
+    lock_filename = indexmap_filename + '.lock'
+    indexmap_filename += '.npy'
+
+    # Build the indexed mapping if not exist.
+
+    if local_rank == 0:
+        with index_map_lock(lock_filename):
+            if not os.path.isfile(indexmap_filename):
+                print(' > WARNING: could not find index map file {}, building '
+                      'the indices on rank 0 ...'.format(indexmap_filename))
+                samples_mapping = build_samples_mapping()
+                start_time = time.time()
+                save_index_map(indexmap_filename, samples_mapping)
+                print_rank_0(' > saved the index mapping in {}'.format(
+                    indexmap_filename))
+                # Make sure all the ranks have built the mapping
+                print_rank_0(
+                    ' > elasped time to build and save samples mapping '
+                    '(seconds): {:4f}'.format(time.time() - start_time))
+
+    elif not use_barrier():
+        # The mapping is renamed into place once it is fully written.
+        wait_for_index_maps([indexmap_filename], lock_filename)
 
     # This should be a barrier but nccl barrier assumes
     # device_index=rank which is not the case for model
     # parallel case
-    if paddle.distributed.get_world_size() > 1:
-        if paddle.in_dynamic_mode():
-            paddle.distributed.barrier()
+    if use_barrier():
+        paddle.distributed.barrier()
 
     # Load indexed dataset.
     print_rank_0(' > loading indexed mapping from {}'.format(
@@ -43,7 +43,8 @@ mode_to_index = {"Train": 0, "Eval": 1, "Test": 2}
 class ErnieDataset(paddle.io.Dataset):
     def __init__(self, input_dir, tokenizer_type, split, num_samples, mode,
                  max_seq_length, masked_lm_prob, short_seq_prob, seed,
-                 binary_head, share_folder, favor_longer_ngram, max_ngrams):
+                 binary_head, share_folder, favor_longer_ngram, max_ngrams,
+                 cache_dir=None):
         tokenizer = ErnieTokenizer.from_pretrained(tokenizer_type)
         tokenizer.extend_chinese_char()
 
@@ -101,7 +102,8 @@ class ErnieDataset(paddle.io.Dataset):
             self.seed,
             mode,
             self.binary_head,
-            self.share_folder)
+            self.share_folder,
+            cache_dir=cache_dir)
 
         self.vocab_id_list = list(tokenizer.vocab.idx_to_token.keys())
         self.vocab_id_to_token_dict = copy.deepcopy(
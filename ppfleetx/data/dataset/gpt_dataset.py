@@ -19,12 +19,21 @@ import numpy as np
 import re
 import math
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import paddle
 
 from ppfleetx.distributed.apis import env
 from ppfleetx.utils.log import logger
 from ppfleetx.data.tokenizers import GPTTokenizer
+from .index_map_cache import (
+    get_corpus_fingerprint,
+    get_cache_key,
+    build_or_load_index_maps,
+    save_index_map,
+    index_map_lock,
+    wait_for_index_maps,
+    use_barrier, )
 
 # TODO(haohongxiang): to solve the problem of cross-reference
 import paddlenlp
@@ -47,7 +56,8 @@ class GPTDataset(paddle.io.Dataset):
                  num_samples,
                  mode,
                  model_type="GPT",
-                 seed=1234):
+                 seed=1234,
+                 cache_dir=None):
 
         files = get_train_data_file(input_dir)
         files.sort()
@@ -55,30 +65,8 @@ class GPTDataset(paddle.io.Dataset):
 
         local_rank = int(os.getenv("PADDLE_RANK_IN_NODE", 0))
 
-        if local_rank == 0:
-            try:
-                import ppfleetx.data.data_tools.cpp.fast_index_map_helpers
-            except Exception as e:
-                start_time = time.time()
-                print('> compiling dataset index builder ...')
-                from ppfleetx.data.data_tools.cpp.compile import compile_helper
-                compile_helper()
-                print(
-                    '>>> done with dataset index builder. Compilation time: {:.3f} '
-                    'seconds'.format(time.time() - start_time),
-                    flush=True)
-
         device_world_size = paddle.distributed.get_world_size()
 
-        if device_world_size > 1 and local_rank != 0:
-            while True:
-                try:
-                    import ppfleetx.data.data_tools.cpp.fast_index_map_helpers
-                    break
-                except Exception as e:
-                    print("> wait for helpers to be compiled!")
-                    time.sleep(1)
-
         try:
             data_world_size = env.get_data_world_size()
 
@@ -134,15 +122,57 @@ class GPTDataset(paddle.io.Dataset):
         else:
             document_ids = documents
 
+        corpus_fingerprint = None
+        if cache_dir is not None:
+            corpus_fingerprint = get_corpus_fingerprint(self.sample_lens)
+            self.start_pos = get_cached_start_pos(
+                cache_dir, corpus_fingerprint, self.sample_lens,
+                self.build_data_file)
+        else:
+            # The doc cumsum start pos, shared with the index mappings below
+            # so that the barrier in construct_samples_and_shuffle_data
+            # covers it.
+            start_pos_filename = build_start_pos(
+                input_prefix, self.sample_lens, self.build_data_file)
+
         self.doc_idx, self.sample_idx, self.shuffle_idx = \
             construct_samples_and_shuffle_data(self.name, input_prefix, document_ids,\
-                self.sample_lens, num_samples, max_seq_len, seed, self.build_data_file)
-
-        # The doc cumsum start pos
-        self.start_pos = [0] + np.cumsum(self.sample_lens).tolist()
+                self.sample_lens, num_samples, max_seq_len, seed, self.build_data_file,
+                cache_dir=cache_dir, corpus_fingerprint=corpus_fingerprint)
+
+        if cache_dir is None:
+            self.start_pos = load_start_pos(start_pos_filename,
+                                            self.sample_lens)
+
+        # Read-only memory-mapped arrays are reopened by file name instead of
+        # being pickled into every DataLoader worker.
+        self._mmap_files = {
+            "sample_ids": input_prefix + "_ids.npy",
+            "doc_idx": getattr(self.doc_idx, "filename", None),
+            "sample_idx": getattr(self.sample_idx, "filename", None),
+            "shuffle_idx": getattr(self.shuffle_idx, "filename", None),
+            "start_pos": getattr(self.start_pos, "filename", None),
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key, filename in self._mmap_files.items():
+            if filename is not None and isinstance(state[key], np.memmap):
+                state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key, filename in self._mmap_files.items():
+            if self.__dict__[key] is None:
+                self.__dict__[key] = np.load(
+                    filename, allow_pickle=True, mmap_mode='r')
 
     def _construct_sample(self, tokens):
-        tokens = np.array(tokens).astype("int64").tolist()
+        """
+        tokens: int64 array with length seq_length + 1, tokens and labels are
+        both views of it.
+        """
         labels = tokens[1:]
         tokens = tokens[:-1]
         seq_length = len(tokens)
@@ -150,12 +180,9 @@ class GPTDataset(paddle.io.Dataset):
         # attention_mask = np.tri(seq_length, seq_length).reshape((1, seq_length,
         #  seq_length))
         # The pad and eos tokens do not contribute the loss
-        loss_mask = np.ones(seq_length, dtype="float32")
-        loss_mask[np.where(np.array(tokens) == self.eos_id)] = 0.0
+        loss_mask = (tokens != self.eos_id).astype("float32")
         position_ids = np.arange(0, seq_length, dtype="int64")
 
-        labels = np.array(labels).astype("int64")
-        tokens = np.array(tokens).astype("int64")
         if self.mode == "Test":
             return [tokens, position_ids]
         else:
@@ -169,31 +196,95 @@ class GPTDataset(paddle.io.Dataset):
             doc_index_l: data from the last doc.
             offset_f: offset of the first doc.
             offset_l: offset of the last doc.
+        Returns an int64 array with the tokens of the sample.
         """
         # Data from the sample doc. just select the needed ids.
         if doc_index_f == doc_index_l:
             current_start_pos = self.start_pos[self.doc_idx[doc_index_f]]
             return self.sample_ids[current_start_pos+offset_f:\
-                       current_start_pos+offset_l+1].tolist()
-
-        # Data from multi docs.
-        else:
-            current_start_pos = self.start_pos[self.doc_idx[doc_index_f]]
-            next_start_pos = self.start_pos[self.doc_idx[doc_index_f] + 1]
-            tokens = self.sample_ids[current_start_pos + offset_f:
-                                     next_start_pos].tolist()
-            for i in range(doc_index_f + 1, doc_index_l):
-                current_start_pos = self.start_pos[self.doc_idx[i]]
-                next_start_pos = self.start_pos[self.doc_idx[i] + 1]
-                tokens.extend(self.sample_ids[current_start_pos:next_start_pos]
-                              .tolist())
-            last_start_pos = self.start_pos[self.doc_idx[doc_index_l]]
-            tokens.extend(self.sample_ids[last_start_pos:last_start_pos +
-                                          offset_l + 1].tolist())
+                       current_start_pos+offset_l+1].astype("int64")
+
+        # Data from multi docs, gather all the spans in one pass.
+        doc_ids = self.doc_idx[doc_index_f:doc_index_l + 1]
+        starts = self.start_pos[doc_ids]
+        ends = self.start_pos[doc_ids + 1]
+        starts[0] += offset_f
+        ends[-1] = starts[-1] + offset_l + 1
+        lens = ends - starts
+
+        tokens = np.empty(lens.sum(), dtype="int64")
+        self._gather_spans(starts, lens, tokens)
+        return tokens
 
+    def _get_batch_samples_from_idx(self, doc_index_f, doc_index_l, offset_f,
+                                    offset_l):
+        """
+        The batched version of `_get_single_sample_from_idx`, every input is
+        an array with one element per sample. Returns an int64 array with
+        shape [batch_size, max_seq_len + 1].
+        """
+        num_docs = doc_index_l - doc_index_f + 1
+        # Position of the last and the first doc of each sample in the
+        # flattened doc list of the batch.
+        last = np.cumsum(num_docs) - 1
+        first = last - num_docs + 1
+        doc_index = np.arange(num_docs.sum(), dtype="int64")
+        doc_index += np.repeat(doc_index_f - first, num_docs)
+
+        doc_ids = self.doc_idx[doc_index]
+        starts = self.start_pos[doc_ids]
+        ends = self.start_pos[doc_ids + 1]
+        ends[last] = starts[last] + offset_l + 1
+        starts[first] += offset_f
+        lens = ends - starts
+
+        tokens = np.empty([len(num_docs), self.max_seq_len + 1], dtype="int64")
+        assert lens.sum() == tokens.size, \
+            "The sample_idx mismatches with max_seq_len {}.".format(
+                self.max_seq_len)
+        self._gather_spans(starts, lens, tokens.reshape([-1]))
         return tokens
 
+    def _gather_spans(self, starts, lens, out):
+        """
+        Copy the spans sample_ids[starts[i]:starts[i] + lens[i]] into out
+        back to back.
+        """
+        # The position of each token in sample_ids is the start of its span
+        # plus its offset in the span.
+        span_offsets = np.cumsum(lens) - lens
+        token_pos = np.arange(len(out), dtype="int64")
+        token_pos += np.repeat(starts - span_offsets, lens)
+        out[:] = self.sample_ids[token_pos]
+
+    def __getitems__(self, indices):
+        """
+        Fetch a whole batch of samples at once, the fields are the same as
+        `__getitem__` but already stacked along the first axis.
+        """
+        idx = self.shuffle_idx[np.asarray(indices, dtype="int64")]
+        sample_idx_f = self.sample_idx[idx]
+        sample_idx_l = self.sample_idx[idx + 1]
+        tokens = self._get_batch_samples_from_idx(
+            sample_idx_f[:, 0], sample_idx_l[:, 0], sample_idx_f[:, 1],
+            sample_idx_l[:, 1])
+
+        labels = np.ascontiguousarray(tokens[:, 1:])
+        tokens = np.ascontiguousarray(tokens[:, :-1])
+        loss_mask = (tokens != self.eos_id).astype("float32")
+        position_ids = np.tile(
+            np.arange(0, self.max_seq_len, dtype="int64"), [len(tokens), 1])
+
+        if self.mode == "Test":
+            return [tokens, position_ids]
+        else:
+            return [tokens, position_ids, labels, loss_mask]
+
     def __getitem__(self, index):
+        # A list of indices is handed over by GPTBatchSampler with batch_fetch.
+        if isinstance(index, (list, tuple, np.ndarray)):
+            return self.__getitems__(index)
+
         idx = self.shuffle_idx[index]
         # Start and end documents and offsets.
         doc_index_f = self.sample_idx[idx][0]
@@ -262,14 +353,98 @@ def get_train_valid_test_split_(splits, size):
     return splits_index
 
 
-def construct_samples_and_shuffle_data(name, data_prefix, documents, sizes,
-                                       num_samples, seq_length, seed,
-                                       build_data_file):
+def build_start_pos(data_prefix, sizes, build_data_file):
+    """
+    Build the int64 cumsum start pos of all docs next to the `_idx.npz` file,
+    len(start_pos) = len(sizes) + 1 and start_pos[0] = 0. The file is written
+    to a temporary name first and renamed, so readers never see a partial one.
+    Returns the filename, which may not exist if the data dir is read-only.
+    """
+    start_pos_filename = data_prefix + "_start_pos.npy"
+    if build_data_file and not _is_valid_start_pos(start_pos_filename, sizes):
+        start_time = time.time()
+        start_pos = _build_start_pos(sizes)
+        try:
+            save_index_map(start_pos_filename, start_pos)
+            print(' > elasped time to build and save start-pos mapping '
+                  '(seconds): {:4f}'.format(time.time() - start_time))
+        except OSError as e:
+            logger.warning(
+                "Failed to save the start pos to {}: {}. It will be kept in "
+                "memory instead.".format(start_pos_filename, e))
+    return start_pos_filename
+
+
+def load_start_pos(start_pos_filename, sizes):
+    """
+    Load the start pos built by `build_start_pos` as a read-only memmap, which
+    is shared by all DataLoader workers. Fall back to an in-memory int64 array
+    if the file is missing or stale.
+    """
+    if _is_valid_start_pos(start_pos_filename, sizes):
+        return np.load(start_pos_filename, allow_pickle=False, mmap_mode='r')
+
+    logger.warning("{} not found or mismatched with the dataset, compute the "
+                   "start pos in memory.".format(start_pos_filename))
+    return _build_start_pos(sizes)
+
+
+def get_cached_start_pos(cache_dir, corpus_fingerprint, sizes,
+                         build_data_file):
+    """
+    Same as `build_start_pos` and `load_start_pos`, but the start pos is kept
+    in the shared index map cache instead of next to the dataset.
+    """
+    params = dict(kind="gpt_start_pos", corpus=corpus_fingerprint)
+    index_maps = build_or_load_index_maps(
+        cache_dir,
+        get_cache_key(**params), params,
+        lambda: {"start_pos": _build_start_pos(sizes)}, build_data_file)
+    return index_maps["start_pos"]
+
+
+def _build_start_pos(sizes):
+    start_pos = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, dtype=np.int64, out=start_pos[1:])
+    return start_pos
+
+
+def _is_valid_start_pos(start_pos_filename, sizes):
+    if not os.path.isfile(start_pos_filename):
+        return False
+    try:
+        start_pos = np.load(
+            start_pos_filename, allow_pickle=False, mmap_mode='r')
+    except Exception:
+        return False
+    return start_pos.dtype == np.int64 and \
+        start_pos.shape == (len(sizes) + 1, ) and \
+        int(start_pos[-1]) == int(np.sum(sizes, dtype=np.int64))
+
+
+def construct_samples_and_shuffle_data(name,
+                                       data_prefix,
+                                       documents,
+                                       sizes,
+                                       num_samples,
+                                       seq_length,
+                                       seed,
+                                       build_data_file,
+                                       num_workers=None,
+                                       cache_dir=None,
+                                       corpus_fingerprint=None):
     """
     documents: document index from 0 to len(docs)
     sizes: the length list of all docs.
     num_samples: total step*bs iterations of data.
     seq_length: the sequence length.
+    num_workers: number of threads to build the index mappings, default to
+        the number of local CPU cores.
+    cache_dir: if set, the index mappings are kept in this shared cache and
+        keyed by the content of the corpus, split, seed, seq_length and
+        num_samples, instead of next to the data_prefix.
+    corpus_fingerprint: the `get_corpus_fingerprint` of sizes, computed here
+        if not given.
     sum(sizes) = tokens_per_epoch
     data_nums = num_samples *  micro_batch_size
     num_epochs = (data_nums + 1) // sum(sizes)
@@ -281,6 +456,29 @@ def construct_samples_and_shuffle_data(name, data_prefix, documents, sizes,
     # Rng state
     np_rng = np.random.RandomState(seed=seed)
 
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    if cache_dir is not None:
+        if corpus_fingerprint is None:
+            corpus_fingerprint = get_corpus_fingerprint(sizes)
+        params = dict(
+            kind="gpt_indexmap",
+            corpus=corpus_fingerprint,
+            documents=get_corpus_fingerprint(documents),
+            seed=int(seed),
+            seq_length=int(seq_length),
+            num_samples=int(num_samples))
+        index_maps = build_or_load_index_maps(
+            cache_dir,
+            get_cache_key(**params), params,
+            lambda: _build_index_maps(documents, sizes, num_samples,
+                                      seq_length, num_epochs,
+                                      tokens_per_epoch, np_rng, num_workers),
+            build_data_file)
+        return index_maps["doc_idx"], index_maps["sample_idx"], \
+            index_maps["shuffle_idx"]
+
     # Filename of the index mappings.
     _filename = data_prefix
     _filename += '_{}_indexmap'.format(name)
@@ -289,92 +487,38 @@ def construct_samples_and_shuffle_data(name, data_prefix, documents, sizes,
     doc_idx_filename = _filename + '_doc_idx.npy'
     sample_idx_filename = _filename + '_sample_idx.npy'
     shuffle_idx_filename = _filename + '_shuffle_idx.npy'
+    index_map_filenames = {
+        "doc_idx": doc_idx_filename,
+        "sample_idx": sample_idx_filename,
+        "shuffle_idx": shuffle_idx_filename,
+    }
+    lock_filename = _filename + '.lock'
 
     # Sava random state
     savedState = np_rng.get_state()
     # Build the indexed mapping if not exist.
     if build_data_file:
-        if (not os.path.isfile(doc_idx_filename)) or \
-           (not os.path.isfile(sample_idx_filename)) or \
-           (not os.path.isfile(shuffle_idx_filename)):
-            if num_epochs == 1:
-                separate_last_epoch = False
-            else:
-                num_samples_from_epochs_minus_one = (
-                    (num_epochs - 1) * tokens_per_epoch - 1) // seq_length
-                last_epoch_num_samples = num_samples - \
-                                         num_samples_from_epochs_minus_one
-                assert last_epoch_num_samples >= 0, \
-                    'last epoch number of samples should be non-negative.'
-                num_samples_per_epoch = (tokens_per_epoch - 1) // seq_length
-                assert last_epoch_num_samples < (num_samples_per_epoch + 1), \
-                    'last epoch number of samples exceeded max value.'
-                separate_last_epoch = (
-                    last_epoch_num_samples < int(0.80 * num_samples_per_epoch))
-            # Note. len(doc_idx) = num_epochs * len(doc)
-            start_time = time.time()
-            doc_idx = _build_doc_idx(documents, num_epochs, np_rng,
-                                     separate_last_epoch)
-            np.save(doc_idx_filename, doc_idx, allow_pickle=True)
-            print(' > elasped time to build and save doc-idx mapping '
-                  '(seconds): {:4f}'.format(time.time() - start_time))
-            # sample-idx. pos of each seq_len of data.
-            start_time = time.time()
-            assert doc_idx.dtype == np.int32
-            assert sizes.dtype == np.int32
-
-            from ppfleetx.data.data_tools.cpp import fast_index_map_helpers
-
-            sample_idx = fast_index_map_helpers.build_sample_idx(
-                sizes, doc_idx, seq_length, num_epochs, tokens_per_epoch)
-            # sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
-            #                                num_epochs, tokens_per_epoch)
-
-            np.save(sample_idx_filename, sample_idx, allow_pickle=True)
-            print(' > elasped time to build and save sample-idx mapping '
-                  '(seconds): {:4f}'.format(time.time() - start_time))
-
-            # shuffle-idx.
-            start_time = time.time()
-
-            if separate_last_epoch:
-                num_samples_ = num_samples_from_epochs_minus_one
-            else:
-                num_samples_ = sample_idx.shape[0] - 1
-
-            # Shuffle all seq len data.
-            shuffle_idx = _build_shuffle_idx(num_samples_,
-                                             sample_idx.shape[0] - 1, np_rng)
-            np.save(shuffle_idx_filename, shuffle_idx, allow_pickle=True)
-            print(' > elasped time to build and save shuffle-idx mapping'
-                  ' (seconds): {:4f}'.format(time.time() - start_time))
-
-    else:
-        while True:
-            if (not os.path.isfile(doc_idx_filename)) or \
-               (not os.path.isfile(sample_idx_filename)) or \
-               (not os.path.isfile(shuffle_idx_filename)):
-                time.sleep(3)
-            else:
-                try:
-                    np.load(
-                        shuffle_idx_filename, allow_pickle=True, mmap_mode='r')
-                    break
-                except Exception as e:
-                    print(
-                        "%s file is still writing or damaged, please wait a moment."
-                        % shuffle_idx_filename)
-                    time.sleep(3)
+        with index_map_lock(lock_filename):
+            if not all(
+                    os.path.isfile(f) for f in index_map_filenames.values()):
+                index_maps = _build_index_maps(
+                    documents, sizes, num_samples, seq_length, num_epochs,
+                    tokens_per_epoch, np_rng, num_workers)
+                start_time = time.time()
+                for key, filename in index_map_filenames.items():
+                    save_index_map(filename, index_maps[key])
+                print(' > elasped time to save index mappings '
+                      '(seconds): {:4f}'.format(time.time() - start_time))
+    elif not use_barrier():
+        # All the index mappings are renamed into place once they are fully
+        # written, so waiting for the builder to release the lock is enough.
+        wait_for_index_maps(index_map_filenames.values(), lock_filename)
 
     # Restore random state
     np_rng.set_state(savedState)
 
-    try:
-        if paddle.distributed.get_world_size() > 1:
-            if paddle.in_dynamic_mode():
-                paddle.distributed.barrier()
-    except AssertionError:
-        pass
+    if use_barrier():
+        paddle.distributed.barrier()
 
     # Load mappings.
     doc_idx = np.load(doc_idx_filename, allow_pickle=True, mmap_mode='r')
@@ -384,6 +528,65 @@ def construct_samples_and_shuffle_data(name, data_prefix, documents, sizes,
     return doc_idx, sample_idx, shuffle_idx
 
 
+def _build_index_maps(documents, sizes, num_samples, seq_length, num_epochs,
+                      tokens_per_epoch, np_rng, num_workers):
+    """
+    Build doc-idx, sample-idx and shuffle-idx, returns a dict from name to
+    the index mapping.
+    """
+    if num_epochs == 1:
+        separate_last_epoch = False
+    else:
+        num_samples_from_epochs_minus_one = (
+            (num_epochs - 1) * tokens_per_epoch - 1) // seq_length
+        last_epoch_num_samples = num_samples - \
+                                 num_samples_from_epochs_minus_one
+        assert last_epoch_num_samples >= 0, \
+            'last epoch number of samples should be non-negative.'
+        num_samples_per_epoch = (tokens_per_epoch - 1) // seq_length
+        assert last_epoch_num_samples < (num_samples_per_epoch + 1), \
+            'last epoch number of samples exceeded max value.'
+        separate_last_epoch = (
+            last_epoch_num_samples < int(0.80 * num_samples_per_epoch))
+    # Note. len(doc_idx) = num_epochs * len(doc)
+    start_time = time.time()
+    doc_idx = _build_doc_idx(documents, num_epochs, np_rng,
+                             separate_last_epoch)
+    print(' > elasped time to build doc-idx mapping '
+          '(seconds): {:4f}'.format(time.time() - start_time))
+    assert doc_idx.dtype == np.int32
+    assert sizes.dtype == np.int32
+
+    # The number of samples is known before sample-idx is built, so the
+    # shuffle-idx is built at the same time with the sample-idx chunks.
+    total_num_samples = (num_epochs * tokens_per_epoch - 1) // seq_length
+    if separate_last_epoch:
+        num_samples_ = num_samples_from_epochs_minus_one
+    else:
+        num_samples_ = total_num_samples
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(num_workers, 2)) as executor:
+        # Shuffle all seq len data.
+        shuffle_future = executor.submit(_build_shuffle_idx, num_samples_,
+                                         total_num_samples, np_rng)
+        # sample-idx. pos of each seq_len of data.
+        sample_idx = _build_sample_idx_parallel(
+            sizes, doc_idx, seq_length, total_num_samples, executor,
+            max(num_workers - 1, 1))
+        print(' > elasped time to build sample-idx mapping '
+              '(seconds): {:4f}'.format(time.time() - start_time))
+        shuffle_idx = shuffle_future.result()
+        print(' > elasped time to build shuffle-idx mapping'
+              ' (seconds): {:4f}'.format(time.time() - start_time))
+
+    return {
+        "doc_idx": doc_idx,
+        "sample_idx": sample_idx,
+        "shuffle_idx": shuffle_idx,
+    }
+
+
 def _num_tokens(documents, lens):
     """Total number of tokens in the dataset."""
     return np.sum(lens[documents])
@@ -407,11 +610,8 @@ def _build_doc_idx(documents, num_epochs, np_rng, separate_last_epoch):
     Each index is mapped to a corresponding document.
     """
     if not separate_last_epoch or num_epochs == 1:
-        doc_idx = np.mgrid[0:num_epochs, 0:len(documents)][1]
-        doc_idx[:] = documents
         # The documents repeat num_epochs times.
-        doc_idx = doc_idx.reshape(-1)
-        doc_idx = doc_idx.astype(np.int32)
+        doc_idx = np.tile(np.asarray(documents, dtype=np.int32), num_epochs)
         return doc_idx
 
     doc_idx_first = _build_doc_idx(documents, num_epochs - 1, np_rng, False)
@@ -453,6 +653,39 @@ def _build_sample_idx(sizes, doc_idx, seq_length, num_epochs,
     return sample_idx
 
 
+def _build_sample_idx_parallel(sizes, doc_idx, seq_length, num_samples,
+                               executor, num_chunks):
+    """
+    Same as `_build_sample_idx`, but computed in chunks on the executor.
+    The i-th sample starts at token i * seq_length of the documents flattened
+    by doc_idx, so every chunk can be found with a binary search over the
+    cumsum of the flattened document lengths.
+    """
+    # doc_starts[i] is the first token of doc_idx[i] in the flattened data.
+    doc_starts = np.zeros(len(doc_idx) + 1, dtype=np.int64)
+    np.cumsum(sizes[doc_idx], dtype=np.int64, out=doc_starts[1:])
+
+    sample_idx = np.empty([int(num_samples) + 1, 2], dtype=np.int64)
+
+    def build_chunk(start, end):
+        token_pos = np.arange(start, end, dtype=np.int64) * seq_length
+        doc_idx_index = np.searchsorted(
+            doc_starts, token_pos, side='right') - 1
+        sample_idx[start:end, 0] = doc_idx_index
+        sample_idx[start:end, 1] = token_pos - doc_starts[doc_idx_index]
+
+    bounds = np.linspace(0, len(sample_idx), num_chunks + 1).astype(np.int64)
+    futures = [
+        executor.submit(build_chunk, start, end)
+        for start, end in zip(bounds[:-1], bounds[1:]) if end > start
+    ]
+    for future in futures:
+        future.result()
+    # Start with first document and no offset.
+    sample_idx[0] = 0
+    return sample_idx
+
+
 def _build_shuffle_idx(num_samples, total_size, np_rng):
     dtype_ = np.uint32
     if total_size >= (np.iinfo(np.uint32).max - 1):
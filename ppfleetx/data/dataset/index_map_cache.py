@@ -0,0 +1,199 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import json
+import fcntl
+import shutil
+import socket
+import hashlib
+import contextlib
+
+import numpy as np
+import paddle
+
+from ppfleetx.utils.log import logger
+
+MANIFEST_NAME = "manifest.json"
+
+
+def get_corpus_fingerprint(*arrays):
+    """
+    Hash of the arrays the index mappings are built from, e.g. the lengths of
+    all the documents, so that the same corpus always gets the same key no
+    matter where it is mounted.
+    """
+    m = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        m.update("{}{}".format(array.dtype.str, array.shape).encode("utf-8"))
+        m.update(array.reshape([-1]).view(np.uint8))
+    return m.hexdigest()
+
+
+def get_cache_key(**params):
+    """
+    The key of an index map entry, params should contain everything the
+    index mappings depend on, e.g. the corpus fingerprint, split, seed,
+    sequence length and number of samples.
+    """
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+
+def build_or_load_index_maps(cache_dir, key, params, build_fn,
+                             build_data_file):
+    """
+    Load the index mappings of key from cache_dir, build them by build_fn
+    first if not exist.
+
+    Every entry is a directory named by key which holds one `.npy` file per
+    index mapping and a manifest. The entry is built in a private temporary
+    directory and renamed into place, so concurrent jobs sharing cache_dir
+    never see a partial entry, and a job only rebuilds what is missing.
+
+    Args:
+        cache_dir(str): the directory of the cache, can be shared by jobs.
+        key(str): the key returned by `get_cache_key`.
+        params(dict): the params of the key, recorded in the manifest.
+        build_fn(callable): returns a dict from name to numpy array.
+        build_data_file(bool): whether this process builds missing entries,
+            the others wait for it.
+    Returns:
+        dict: from name to the read-only memory-mapped array.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    manifest_filename = os.path.join(entry_dir, MANIFEST_NAME)
+    lock_filename = entry_dir + ".lock"
+
+    if not os.path.isfile(manifest_filename):
+        if build_data_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            with index_map_lock(lock_filename):
+                if not os.path.isfile(manifest_filename):
+                    _build_entry(cache_dir, key, params, build_fn)
+        elif not use_barrier():
+            wait_for_index_maps([manifest_filename], lock_filename)
+
+    if use_barrier():
+        paddle.distributed.barrier()
+
+    with open(manifest_filename, "r") as f:
+        manifest = json.load(f)
+    logger.info("Load index mappings {} from {}".format(
+        sorted(manifest["files"]), entry_dir))
+    return {
+        name: np.load(
+            os.path.join(entry_dir, filename),
+            allow_pickle=True,
+            mmap_mode='r')
+        for name, filename in manifest["files"].items()
+    }
+
+
+def _build_entry(cache_dir, key, params, build_fn):
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = "{}.tmp.{}.{}".format(entry_dir,
+                                    socket.gethostname(), os.getpid())
+    start_time = time.time()
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        files = {}
+        for name, index_map in build_fn().items():
+            files[name] = name + ".npy"
+            with open(os.path.join(tmp_dir, files[name]), "wb") as f:
+                np.save(f, index_map, allow_pickle=True)
+
+        manifest = {
+            "key": key,
+            "params": params,
+            "files": files,
+            "created_by": "{}:{}".format(socket.gethostname(), os.getpid()),
+            "created_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another job has published the same entry in the meantime.
+            if not os.path.isfile(os.path.join(entry_dir, MANIFEST_NAME)):
+                raise
+            return
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # The index of all the entries for humans, a single small append is
+    # atomic so concurrent jobs don't corrupt it.
+    with open(os.path.join(cache_dir, "manifest.jsonl"), "a") as f:
+        f.write(json.dumps({"key": key, "params": params}, default=str) +
+                "\n")
+    print(' > elasped time to build and save index mappings to {} '
+          '(seconds): {:4f}'.format(entry_dir, time.time() - start_time))
+
+
+def use_barrier():
+    try:
+        return paddle.distributed.get_world_size() > 1 and \
+            paddle.in_dynamic_mode()
+    except AssertionError:
+        return False
+
+
+def save_index_map(filename, index_map):
+    """
+    Write to a temporary file and rename it, so the file is either missing
+    or complete for other processes. The temporary file is named by host and
+    pid, as the ranks of every node may write the same file on a shared
+    filesystem.
+    """
+    tmp_filename = '{}.tmp.{}.{}'.format(filename,
+                                         socket.gethostname(), os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, index_map, allow_pickle=True)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+@contextlib.contextmanager
+def index_map_lock(lock_filename, shared=False):
+    """
+    Hold a file lock while building the index mappings. No lock is taken if
+    the lock file can not be created, e.g. on a read-only mount.
+    """
+    try:
+        f = open(lock_filename, 'a+')
+    except OSError:
+        yield
+        return
+    try:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        f.close()
+
+
+def wait_for_index_maps(filenames, lock_filename):
+    while not all(os.path.isfile(f) for f in filenames):
+        # Blocks while the builder holds the exclusive lock.
+        with index_map_lock(lock_filename, shared=True):
+            pass
+        if not all(os.path.isfile(f) for f in filenames):
+            time.sleep(1)
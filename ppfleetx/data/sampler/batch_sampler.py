@@ -19,13 +19,16 @@ import os
 import sys
 import numpy as np
 import math
+import itertools
 
 import paddle
 from paddle.io import DistributedBatchSampler
 
 from ppfleetx.distributed.apis import env
 
-__all__ = ["GPTBatchSampler", "DistributedBatchSampler"]
+__all__ = [
+    "GPTBatchSampler", "DistributedBatchSampler", "FastForwardBatchSampler"
+]
 
 
 class GPTBatchSampler(paddle.io.BatchSampler):
@@ -53,6 +56,12 @@ class GPTBatchSampler(paddle.io.BatchSampler):
             batch indices. Default False.
         drop_last(bool): whether drop the last incomplete batch dataset size
             is not divisible by the batch size. Default False
+        consumed_samples(int): the number of samples already consumed, the
+            sampler starts from it. Default 0
+        batch_fetch(bool): whether to hand over the whole batch of indices to
+            the dataset as a single index, which requires the dataset to
+            support `__getitems__` and the DataLoader to use
+            `gpt_batch_collate_fn`. Default False
     Examples:
         .. code-block:: python
             import numpy as np
@@ -84,7 +93,8 @@ class GPTBatchSampler(paddle.io.BatchSampler):
                  rank=None,
                  shuffle=False,
                  drop_last=False,
-                 consumed_samples=0):
+                 consumed_samples=0,
+                 batch_fetch=False):
         self.dataset = dataset
 
         assert isinstance(batch_size, int) and batch_size > 0, \
@@ -113,6 +123,12 @@ class GPTBatchSampler(paddle.io.BatchSampler):
             self.local_rank = env.get_data_world_rank()
 
         self.drop_last = drop_last
+        assert isinstance(batch_fetch, bool), \
+                "batch_fetch should be a boolean value"
+        if batch_fetch:
+            assert hasattr(dataset, "__getitems__"), \
+                "batch_fetch requires the dataset to implement __getitems__"
+        self.batch_fetch = batch_fetch
         self.epoch = 0
 
         self.consumed_samples = consumed_samples
@@ -126,9 +142,18 @@ class GPTBatchSampler(paddle.io.BatchSampler):
         return start_idx, end_idx
 
     def __iter__(self):
+        for batch_indices in self._iter_batch_indices():
+            if self.batch_fetch:
+                # DataLoader fetches dataset[index] for every index in a
+                # batch, so wrap the batch as one index.
+                yield [batch_indices]
+            else:
+                yield batch_indices
+
+    def _iter_batch_indices(self):
         assert self.consumed_samples % self.nranks == 0, \
             "The consumed_samples should be divided by nranks. consumed_samples=%d, nranks=%s" % (
-            self.consumed_samples, nranks)
+            self.consumed_samples, self.nranks)
         self.remain_num_samples = int(
             math.ceil((len(self.dataset) - self.consumed_samples) * 1.0 /
                       self.nranks))
@@ -186,3 +211,64 @@ class GPTBatchSampler(paddle.io.BatchSampler):
         self.epoch = epoch
         # if we reset the epoch, the consumed_samples should be set to 0.
         self.consumed_samples = consumed_samples
+
+
+class FastForwardBatchSampler(object):
+    """
+    Wraps the batch sampler of a DataLoader, so that its next epoch starts
+    after consumed_samples when resuming from a checkpoint, without loading
+    any of the skipped samples. The following epochs are not affected.
+
+    GPTBatchSampler starts from consumed_samples by itself. For the other
+    batch samplers, e.g. DistributedBatchSampler, only the indices of the
+    consumed batches are generated and dropped.
+
+    Args:
+        batch_sampler(BatchSampler): the batch sampler to wrap.
+        consumed_samples(int): the number of samples consumed by all the
+            data parallel ranks in the epoch.
+    """
+
+    def __init__(self, batch_sampler, consumed_samples=0):
+        self.batch_sampler = batch_sampler
+        self.consumed_samples = consumed_samples
+
+    @staticmethod
+    def get_samples_per_step(batch_sampler):
+        """
+        The number of samples consumed by all the data parallel ranks at a
+        step.
+        """
+        return batch_sampler.batch_size * getattr(batch_sampler, "nranks", 1)
+
+    def __iter__(self):
+        consumed_samples, self.consumed_samples = self.consumed_samples, 0
+        if consumed_samples == 0:
+            for batch_indices in self.batch_sampler:
+                yield batch_indices
+        elif isinstance(self.batch_sampler, GPTBatchSampler):
+            epoch = self.batch_sampler.epoch
+            origin_consumed_samples = self.batch_sampler.consumed_samples
+            self.batch_sampler.set_epoch(
+                epoch,
+                consumed_samples=origin_consumed_samples + consumed_samples)
+            try:
+                for batch_indices in self.batch_sampler:
+                    yield batch_indices
+            finally:
+                self.batch_sampler.set_epoch(
+                    epoch, consumed_samples=origin_consumed_samples)
+        else:
+            num_steps = consumed_samples // self.get_samples_per_step(
+                self.batch_sampler)
+            for batch_indices in itertools.islice(self.batch_sampler,
+                                                  num_steps, None):
+                yield batch_indices
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __getattr__(self, name):
+        if name == "batch_sampler":
+            raise AttributeError(name)
+        return getattr(self.batch_sampler, name)
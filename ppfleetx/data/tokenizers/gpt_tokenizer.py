@@ -19,12 +19,17 @@ from __future__ import (absolute_import, division, print_function,
 
 import sys
 import json
+import heapq
 import logging
 import warnings
 import os
+import codecs
+import collections
 import regex as re
 from io import open
 
+import numpy as np
+
 from ppfleetx.utils.download import cached_path
 
 try:
@@ -176,6 +181,7 @@ class GPTTokenizer(object):
                  errors='replace',
                  special_tokens=None,
                  max_len=None,
+                 cache_size=100000,
                  **kwargs):
 
         self.padding_side = kwargs.pop("padding_side", self.padding_side)
@@ -200,7 +206,29 @@ class GPTTokenizer(object):
         bpe_data = open(merges_file, encoding='utf-8').read().split('\n')[1:-1]
         bpe_merges = [tuple(merge.split()) for merge in bpe_data]
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        # Bounded LRU cache from a pretokenized word to its BPE symbol ids.
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        # Maps the utf-8 bytes of a latin-1 decoded string to the unicode
+        # strings of byte_encoder with a single str.translate.
+        self.byte_translation = {
+            b: c
+            for b, c in self.byte_encoder.items()
+        }
+
+        # The BPE merges work on integer symbol ids, bpe_symbols[i] is the
+        # string of symbol i, and bpe_merge_ids maps a pair of symbol ids to
+        # its rank and the id of the merged symbol.
+        self.bpe_symbols = []
+        self.bpe_symbol_ids = {}
+        for symbol in self.byte_encoder.values():
+            self._add_bpe_symbol(symbol)
+        self.bpe_merge_ids = {}
+        for (first, second), rank in self.bpe_ranks.items():
+            pair = (self._add_bpe_symbol(first),
+                    self._add_bpe_symbol(second))
+            self.bpe_merge_ids[pair] = (rank,
+                                        self._add_bpe_symbol(first + second))
 
         # Should haved added re.IGNORECASE so BPE merges can happen for
         # capitalized versions of contractions
@@ -213,6 +241,31 @@ class GPTTokenizer(object):
         self.special_tokens_decoder = {}
         self.set_special_tokens(special_tokens)
 
+    def _add_bpe_symbol(self, symbol):
+        if symbol not in self.bpe_symbol_ids:
+            self.bpe_symbol_ids[symbol] = len(self.bpe_symbols)
+            self.bpe_symbols.append(symbol)
+        return self.bpe_symbol_ids[symbol]
+
+    def _update_decode_table(self):
+        # decode_table[i] is the utf-8 bytes of token i, and the special
+        # tokens are empty bytes as they are not part of the vocab.
+        num_ids = len(self.encoder) + len(self.special_tokens)
+        self.decode_table = np.full([num_ids], b'', dtype=object)
+        for token_id, token in self.decoder.items():
+            self.decode_table[token_id] = bytes(
+                [self.byte_decoder[c] for c in token])
+        self.special_ids_mask = np.zeros([num_ids], dtype=bool)
+        self.special_ids_mask[list(self.special_tokens_decoder)] = True
+        self.special_ids_mask[self.eod_id] = True
+
+    def _update_bpe_symbol_to_id(self):
+        # The same as convert_tokens_to_ids for every BPE symbol.
+        self.bpe_symbol_to_id = [
+            self.special_tokens[symbol] if symbol in self.special_tokens else
+            self.encoder.get(symbol, 0) for symbol in self.bpe_symbols
+        ]
+
     def __call__(self,
                  text,
                  text_pair=None,
@@ -623,6 +676,8 @@ class GPTTokenizer(object):
         if not special_tokens:
             self.special_tokens = {}
             self.special_tokens_decoder = {}
+            self._update_bpe_symbol_to_id()
+            self._update_decode_table()
             return
         self.special_tokens = dict((tok, len(self.encoder) + i)
                                    for i, tok in enumerate(special_tokens))
@@ -630,62 +685,94 @@ class GPTTokenizer(object):
             v: k
             for k, v in self.special_tokens.items()
         }
+        self._update_bpe_symbol_to_id()
+        self._update_decode_table()
         logger.info("Special tokens {}".format(self.special_tokens))
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
-
-        if not pairs:
-            return token
-
-        while True:
-            bigram = min(
-                pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except BaseException:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[
-                        i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
+        return ' '.join(self.bpe_symbols[i] for i in self._bpe_ids(token))
+
+    def _bpe_ids(self, token):
+        """
+        Returns the BPE symbol ids of a byte encoded word, with the same
+        result as applying the merges one by one in the order of rank.
+        """
+        cache = self.cache
+        if token in cache:
+            cache.move_to_end(token)
+            return cache[token]
+
+        symbol_ids = self.bpe_symbol_ids
+        word = [
+            symbol_ids[c] if c in symbol_ids else self._add_bpe_symbol(c)
+            for c in token
+        ]
+        if len(word) > 1:
+            word = self._merge_bpe_ids(word)
+        word = tuple(word)
+
+        cache[token] = word
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
         return word
 
+    def _merge_bpe_ids(self, word):
+        """
+        Merge the symbols of word in a linked list, the candidate pairs are
+        kept in a heap ordered by (rank, position). A merged symbol only
+        takes part in merges of higher rank than the one creating it, so
+        popping the heap applies the merges in the same order as the classic
+        loop, and the same rank from left to right.
+        """
+        merges = self.bpe_merge_ids
+        n = len(word)
+        next_pos = list(range(1, n + 1))
+        next_pos[-1] = -1
+        prev_pos = list(range(-1, n - 1))
+
+        heap = []
+        for i in range(n - 1):
+            merge = merges.get((word[i], word[i + 1]))
+            if merge is not None:
+                heap.append((merge[0], i, word[i], word[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            _, i, first, second = heapq.heappop(heap)
+            j = next_pos[i]
+            # Skip the pairs changed by previous merges.
+            if word[i] != first or j == -1 or word[j] != second:
+                continue
+            merged = merges[(first, second)][1]
+            word[i] = merged
+            word[j] = -1
+            next_pos[i] = next_pos[j]
+            if next_pos[j] != -1:
+                prev_pos[next_pos[j]] = i
+
+            p = prev_pos[i]
+            if p != -1:
+                merge = merges.get((word[p], merged))
+                if merge is not None:
+                    heapq.heappush(heap, (merge[0], p, word[p], merged))
+            k = next_pos[i]
+            if k != -1:
+                merge = merges.get((merged, word[k]))
+                if merge is not None:
+                    heapq.heappush(heap, (merge[0], i, merged, word[k]))
+
+        return [symbol for symbol in word if symbol != -1]
+
+    def _byte_encode(self, token):
+        return token.encode('utf-8').decode('latin-1').translate(
+            self.byte_translation)
+
     def tokenize(self, text):
         """ Tokenize a string. """
         bpe_tokens = []
-        for token in re.findall(self.pat, text):
-            if sys.version_info[0] == 2:
-                token = ''.join(self.byte_encoder[ord(b)] for b in token)
-            else:
-                token = ''.join(self.byte_encoder[b]
-                                for b in token.encode('utf-8'))
-            bpe_tokens.extend(
-                bpe_token for bpe_token in self.bpe(token).split(' '))
+        for token in self.pat.findall(text):
+            bpe_tokens.extend(self.bpe_symbols[i]
+                              for i in self._bpe_ids(self._byte_encode(token)))
         return bpe_tokens
 
     def convert_tokens_to_ids(self, tokens):
@@ -725,11 +812,7 @@ class GPTTokenizer(object):
                 print(tokenizer.convert_ids_to_string(tokenizer.convert_ids_to_string([14618, 284, 779, 350, 37382, 47, 37382, 290, 350, 37382, 45, 19930]))
                 # 'Welcome to use PaddlePaddle and PaddleNLP'
         """
-
-        text = ''.join([self.decoder[id] for id in ids])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode(
-            'utf-8', errors=self.errors)
-        return text
+        return self.decode_batch([np.atleast_1d(ids)])[0]
 
     def convert_ids_to_tokens(self, ids, skip_special_tokens=False):
         """Converts a sequence of ids in BPE tokens using the vocab."""
@@ -743,16 +826,69 @@ class GPTTokenizer(object):
         return tokens
 
     def encode(self, text):
-        return self.convert_tokens_to_ids(self.tokenize(text))
+        bpe_symbol_to_id = self.bpe_symbol_to_id
+        ids = []
+        for token in self.pat.findall(text):
+            ids.extend(bpe_symbol_to_id[i]
+                       for i in self._bpe_ids(self._byte_encode(token)))
+        if len(ids) > self.max_len:
+            warnings.warn(
+                "Token indices sequence length is longer than the specified maximum "
+                " sequence length for this OpenAI GPT model ({} > {}). Running this"
+                " sequence through the model will result in indexing errors".
+                format(len(ids), self.max_len))
+        return ids
 
-    def decode(self, tokens):
-        text = ''.join([
-            self.decoder[token] if token in self.decoder.keys() else ''
-            for token in tokens
-        ])
-        text = bytearray([self.byte_decoder[c] for c in text]).decode(
-            'utf-8', errors=self.errors)
-        return text
+    def encode_batch(self, texts):
+        """
+        Encode a list of texts, the BPE cache is shared by all of them.
+        Args:
+            texts (List[str]): the texts to be encoded.
+        Returns:
+            List[List[int]]: the token ids of every text.
+        """
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens, skip_special_tokens=False):
+        return self.decode_batch(
+            [tokens], skip_special_tokens=skip_special_tokens)[0]
+
+    def decode_batch(self, ids_2d, skip_special_tokens=False):
+        """
+        Decode a batch of token ids, the bytes of every token are looked up
+        from `decode_table` and joined once per sequence.
+        Args:
+            ids_2d (numpy.ndarray|paddle.Tensor|List[List[int]]): the token
+                ids, one sequence per row and the rows can be of different
+                lengths if it is a list.
+            skip_special_tokens (bool): whether to drop the special tokens
+                and the end of text token. The ids out of the vocab are
+                always dropped.
+        Returns:
+            List[str]: the decoded text of every sequence.
+        """
+        if hasattr(ids_2d, "numpy"):
+            ids_2d = ids_2d.numpy()
+
+        return [
+            self.ids_to_bytes(ids, skip_special_tokens).decode(
+                'utf-8', errors=self.errors) for ids in ids_2d
+        ]
+
+    def ids_to_bytes(self, ids, skip_special_tokens=False):
+        """ Converts a sequence of ids to the utf-8 bytes of the text. """
+        ids = np.asarray(ids, dtype="int64").reshape([-1])
+        ids = ids[(ids >= 0) & (ids < len(self.decode_table))]
+        if skip_special_tokens:
+            ids = ids[~self.special_ids_mask[ids]]
+        return b''.join(self.decode_table[ids].tolist())
+
+    def stream_decoder(self, skip_special_tokens=False):
+        """
+        Returns a `GPTStreamDecoder` to decode the ids of a sequence as they
+        are generated.
+        """
+        return GPTStreamDecoder(self, skip_special_tokens=skip_special_tokens)
 
     def save_vocabulary(self, vocab_path):
         """Save the tokenizer vocabulary and merge files to a directory."""
@@ -811,3 +947,34 @@ class GPTTokenizer(object):
     @property
     def eos_token_id(self):
         return self.eod_id
+
+
+class GPTStreamDecoder(object):
+    """
+    Decode the token ids of one sequence incrementally. A byte-level BPE
+    token may end in the middle of a multi-byte utf-8 character, such bytes
+    are buffered until the rest of the character arrives, so the text deltas
+    never contain broken characters.
+
+    Args:
+        tokenizer (GPTTokenizer): the tokenizer of the ids.
+        skip_special_tokens (bool): whether to drop the special tokens and
+            the end of text token.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=False):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.decoder = codecs.getincrementaldecoder('utf-8')(
+            errors=tokenizer.errors)
+
+    def put(self, ids):
+        """
+        Feed the new ids and return the text decoded since the last call.
+        """
+        return self.decoder.decode(
+            self.tokenizer.ids_to_bytes(ids, self.skip_special_tokens))
+
+    def end(self):
+        """ Flush the buffered bytes at the end of the sequence. """
+        return self.decoder.decode(b'', final=True)
@@ -95,6 +95,17 @@ def gpt_collate_fn(batch):
     return Tuple([Stack() for raw in zip(*batch)])(batch)
 
 
+def gpt_batch_collate_fn(batch):
+    """
+    Collate function for GPTBatchSampler with batch_fetch, the only element
+    of batch is already the stacked mini-batch from GPTDataset.__getitems__.
+    """
+    assert len(batch) == 1, \
+        "gpt_batch_collate_fn expects one pre-batched element, but got {}".format(
+            len(batch))
+    return batch[0]
+
+
 class ErnieCollateData():
     def __init__(self, micro_batch_size=1):
         self.micro_batch_size = micro_batch_size
@@ -14,3 +14,4 @@
 
 from .gate import GShardGate, BaseGate, SwitchGate, NaiveGate
 from .moe_layer import MoELayer
+from .grouped_experts import GroupedExperts
@@ -22,7 +22,7 @@
 import paddle
 from paddle.autograd import PyLayer
 from paddle.distributed.utils.moe_utils import global_scatter, global_gather
-from .utils import _local_scatter, _local_gather, _all_gather
+from .utils import _local_scatter, _local_gather, _all_gather, _alltoall, _alltoall_async
 
 
 class MoEScatter(PyLayer):
@@ -118,6 +118,97 @@ class MoEGather(PyLayer):
         return global_grad_out_buf, None, None, None
 
 
+class AllToAll(PyLayer):
+    r"""
+    A wrapper for the All-to-All function with equal splits to support
+    auto-differentiation.
+    """
+
+    @staticmethod
+    def forward(ctx, inp, group):
+        ctx.group = group
+        return _alltoall(inp, group=group)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        return _alltoall(grad_out, group=ctx.group)
+
+
+class AllToAllPipeline(PyLayer):
+    r"""
+    Computes all_to_all(fn(all_to_all(inp))) in num_chunks chunks, so that
+    the all-to-all of a chunk overlaps the computation of the others, and
+    the backward does the same in reverse.
+
+    inp is split along axis 2, e.g. the capacity of the buffers of
+    [world_size, num_expert, capacity, d_model], fn is computed on every
+    chunk independently. The graph of fn of every chunk is kept for the
+    backward, use recompute in fn to recompute it instead.
+
+    The result equals that of a single chunk up to the rounding of fn, as
+    the matmuls of the smaller chunks may take other kernels, e.g. about
+    1e-6 relative in float32.
+    """
+
+    @staticmethod
+    def forward(ctx, inp, fn, num_chunks, group):
+        chunk_sizes = _split_sizes(inp.shape[2], num_chunks)
+        recv = [
+            _alltoall_async(chunk, group)
+            for chunk in paddle.split(inp, chunk_sizes, axis=2)
+        ]
+
+        chunk_inputs, chunk_outputs, send = [], [], []
+        for chunk, task in recv:
+            task.wait()
+            chunk.stop_gradient = False
+            with paddle.set_grad_enabled(True):
+                out = fn(chunk)
+            chunk_inputs.append(chunk)
+            chunk_outputs.append(out)
+            send.append(_alltoall_async(out.detach(), group))
+
+        outputs = []
+        for out, task in send:
+            task.wait()
+            outputs.append(out)
+
+        ctx.chunks = chunk_inputs, chunk_outputs
+        ctx.args = chunk_sizes, group
+        return paddle.concat(outputs, axis=2)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        chunk_inputs, chunk_outputs = ctx.chunks
+        chunk_sizes, group = ctx.args
+        recv = [
+            _alltoall_async(grad, group)
+            for grad in paddle.split(grad_out, chunk_sizes, axis=2)
+        ]
+
+        send = []
+        for chunk, out, (grad, task) in zip(chunk_inputs, chunk_outputs,
+                                             recv):
+            task.wait()
+            paddle.autograd.backward([out], [grad])
+            send.append(_alltoall_async(chunk.grad, group))
+        ctx.chunks = None
+
+        grad_in = []
+        for grad, task in send:
+            task.wait()
+            grad_in.append(grad)
+        return paddle.concat(grad_in, axis=2)
+
+
+def _split_sizes(size, num_chunks):
+    num_chunks = max(min(num_chunks, size), 1)
+    return [
+        size // num_chunks + (1 if i < size % num_chunks else 0)
+        for i in range(num_chunks)
+    ]
+
+
 class AllGather(PyLayer):
     r"""
     A wrapper for the All-Gather function to support auto-differentiation.
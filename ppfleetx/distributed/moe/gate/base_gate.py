@@ -29,6 +29,9 @@ class BaseGate(nn.Layer):
         self.num_expert = num_expert
         self.tot_expert = self.world_size * num_expert
         self.loss = None
+        # Whether to prune the tokens over the capacity in the gate, False
+        # if the dispatch limits the capacity itself.
+        self.limit_capacity = True
 
     def forward(self, x):
         raise NotImplementedError("Please implement the forward function.")
@@ -55,14 +55,15 @@ class GShardGate(NaiveGate):
         loss = paddle.mean(c_e * m_e) * (self.num_expert**2)
         self.set_loss(loss)
 
-        cap_rate = self.capacity[0 if self.training else 1]
-        capacity = math.ceil(cap_rate * x.shape[0])
-        _new_lec, _new_gec, topk_idx = limit_by_capacity(
-            topk_idx,
-            self.num_expert,
-            self.world_size,
-            capacity,
-            group=self.group)
+        if self.limit_capacity:
+            cap_rate = self.capacity[0 if self.training else 1]
+            capacity = math.ceil(cap_rate * x.shape[0])
+            _new_lec, _new_gec, topk_idx = limit_by_capacity(
+                topk_idx,
+                self.num_expert,
+                self.world_size,
+                capacity,
+                group=self.group)
 
         if self.random_routing:
             rand_routing_prob = paddle.rand(
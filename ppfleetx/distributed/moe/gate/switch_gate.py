@@ -51,23 +51,25 @@ class SwitchGate(NaiveGate):
         score = F.softmax(score, axis=-1)
         top1_score, top1_idx = paddle.topk(score, k=1, axis=-1, largest=True)
 
-        cap_rate = self.capacity[0 if self.training else 1]
-        capacity = math.ceil(cap_rate * inp.shape[0])
-        _new_lec, _new_gec, top1_idx = limit_by_capacity(
-            top1_idx,
-            self.num_expert,
-            self.world_size,
-            capacity,
-            group=self.group)
-        valid_idx = top1_idx[top1_idx > -1]
-        valid_idx_tmp = paddle.reshape(valid_idx, shape=[len(valid_idx), 1])
+        if self.limit_capacity:
+            cap_rate = self.capacity[0 if self.training else 1]
+            capacity = math.ceil(cap_rate * inp.shape[0])
+            _new_lec, _new_gec, top1_idx = limit_by_capacity(
+                top1_idx,
+                self.num_expert,
+                self.world_size,
+                capacity,
+                group=self.group)
+        # Count the valid tokens by a mask instead of selecting them, which
+        # would read the number back to host.
+        valid = (top1_idx > -1).astype(paddle.float32).reshape([-1])
+        num_valid = valid.sum()
         fraction_expert = paddle.scatter_nd_add(
             x=paddle.zeros(shape=[self.tot_expert]),
-            index=valid_idx_tmp,
-            updates=paddle.ones_like(
-                valid_idx, dtype=paddle.float32).reshape(
-                    shape=[len(valid_idx)]), ) / valid_idx.numel()
-        prob_expert = score.sum(axis=0) / valid_idx.numel()
+            index=paddle.clip(
+                top1_idx, min=0).reshape([-1, 1]),
+            updates=valid, ) / num_valid
+        prob_expert = score.sum(axis=0) / num_valid
         loss = (fraction_expert * prob_expert).sum() * self.tot_expert
         self.set_loss(loss)
 
@@ -0,0 +1,108 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import paddle
+import paddle.nn as nn
+
+
+def expert_padded_index(expert_count, num_rows, capacity):
+    """
+    Maps the rows sorted by expert to the capacity-padded layout of
+    [num_expert, capacity], all on device.
+
+    Args:
+        expert_count (Tensor): the number of rows of every expert, int64 of
+            [num_expert].
+        num_rows (int): the total number of rows.
+        capacity (int): the number of rows of every expert after padding,
+            the rows over it are dropped.
+    Returns:
+        tuple: the index of every row in the flattened padded layout of
+            [num_rows], num_expert * capacity for the dropped rows, and the
+            index of the row of every padded position of
+            [num_expert * capacity], num_rows for the paddings.
+    """
+    num_expert = expert_count.shape[0]
+    expert_count = expert_count.astype('int64')
+    ends = paddle.cumsum(expert_count)
+    starts = ends - expert_count
+
+    rows = paddle.arange(num_rows, dtype='int64')
+    expert_ids = paddle.searchsorted(ends, rows, right=True)
+    position = rows - paddle.gather(starts, expert_ids)
+    row_index = paddle.where(position < capacity,
+                             expert_ids * capacity + position,
+                             paddle.full_like(rows, num_expert * capacity))
+
+    slots = paddle.arange(capacity, dtype='int64').unsqueeze(0)
+    padded_index = paddle.where(
+        slots < expert_count.unsqueeze(1),
+        starts.unsqueeze(1) + slots,
+        paddle.full_like(slots, num_rows)).reshape([num_expert * capacity])
+    return row_index, padded_index
+
+
+class GroupedExperts(nn.Layer):
+    """
+    The base class of the experts of `MoELayer` which are computed together
+    by batched matmuls instead of one by one.
+
+    The rows of every expert are scattered into a capacity-padded layout of
+    [num_expert, capacity, d_model], computed by `grouped_forward` and
+    gathered back, so the counts of the experts are never read back to host.
+    The rows over the capacity of an expert are dropped, their outputs are
+    zeros, so a static capacity bounds the buffers whatever the routing.
+    The subclasses keep the weights of the experts stacked, e.g.
+    [num_expert, d_model, d_hidden], and implement `grouped_forward`.
+
+    Args:
+        num_expert (int): the number of the experts.
+    """
+
+    def __init__(self, num_expert):
+        super(GroupedExperts, self).__init__()
+        self.num_expert = num_expert
+
+    def __len__(self):
+        return self.num_expert
+
+    def grouped_forward(self, x):
+        """
+        Computes x of [num_expert, capacity, d_model], the rows of the i-th
+        expert in x[i].
+        """
+        raise NotImplementedError
+
+    def forward(self, x, expert_count, capacity):
+        """
+        Args:
+            x (Tensor): the rows sorted by expert, [num_rows, d_model].
+            expert_count (Tensor): the number of rows of every expert.
+            capacity (int): the number of rows of every expert after padding,
+                no row is dropped if it is not less than the max of
+                expert_count.
+        """
+        num_rows = x.shape[0]
+        if num_rows == 0:
+            return x
+        row_index, padded_index = expert_padded_index(expert_count, num_rows,
+                                                      capacity)
+        # The paddings gather the extra zero row, and are never gathered back.
+        x = paddle.concat([x, paddle.zeros([1, x.shape[1]], dtype=x.dtype)])
+        x = paddle.gather(x, padded_index).reshape(
+            [self.num_expert, capacity, -1])
+        x = self.grouped_forward(x).reshape([self.num_expert * capacity, -1])
+        # The dropped rows gather the extra zero row.
+        x = paddle.concat([x, paddle.zeros([1, x.shape[1]], dtype=x.dtype)])
+        return paddle.gather(x, row_index)
@@ -19,13 +19,18 @@
 #     Copyright 2021, Jiaao He. All rights reserved.
 #   Licensed under the Apache License, Version 2.0 (the "License").
 
+import math
+import threading
+
 import numpy as np
 import paddle
 import paddle.nn as nn
+import paddle.nn.functional as F
 
 from .gate import NaiveGate, GShardGate, SwitchGate, BaseGate
-from .comm_ops import MoEScatter, MoEGather, AllGather, Slice
-from .utils import prepare_forward
+from .comm_ops import MoEScatter, MoEGather, AllGather, AllToAll, AllToAllPipeline, Slice
+from .utils import prepare_forward, get_hierarchical_group
+from .grouped_experts import GroupedExperts
 from paddle.distributed.fleet.utils import recompute
 from paddle.incubate.distributed.fleet import recompute_hybrid
 
@@ -34,7 +39,8 @@ class MoELayer(nn.Layer):
     """MoE Layer
     Args:
         d_model: (int) model dimention
-        experts: (list|nn.LayerList) expert networks list
+        experts: (list|nn.LayerList|GroupedExperts) expert networks list, or
+                the experts computed together by batched matmuls
         gate: (str|BaseGate|None):
                 if gate is a str, it can only be "naive", "gshard", "switch" or None, default is "naive"
                 else gate is an instance of BaseGate
@@ -44,6 +50,21 @@ class MoELayer(nn.Layer):
         mp_group: mp group for mp commutication
         recompute_interval(int, optional): whether to use recompute, default 0, means to disable recompute.
         recompute_ctx(dict, optional): the context for recompute, if recompute_interval > 1, recompute_ctx must be given.
+        padded_dispatch(bool, optional): whether to dispatch the tokens into buffers of [num_expert, capacity, d_model]
+                of a static shape without host sync, dropping the tokens over the capacity, default False.
+        capacity(tuple, optional): the capacity factors of training and evaluation for padded_dispatch, relative to
+                the even share of num_tokens * top_k / total_expert, default the capacity of the gate or (1.2, 2.4).
+        a2a_chunks(int, optional): the number of chunks of the padded dispatch, the all-to-all of a chunk overlaps
+                the expert computation of the others, default 1.
+        a2a_local_size(int, optional): the number of ranks of every node to run the all-to-all of the padded dispatch
+                within the nodes and then between them, default 0, means the flat all-to-all of moe_group. The
+                hierarchical all-to-all is synchronous, so the pipelined all-to-all of a2a_chunks > 1 keeps the
+                flat one.
+        grouped_capacity(tuple, optional): the static capacity factors of training and evaluation of GroupedExperts
+                in the dynamic dispatch, relative to the even share of num_tokens * top_k / num_expert, which bound the
+                buffers of [num_expert, capacity, d_model] whatever the routing. The rows over the capacity of an expert
+                are dropped, their outputs are zeros, and counted by the dispatch statistics. Default None, the max
+                count of the experts without dropping, the same as the experts computed one by one.
     Examples:
         .. code-block:: python
         from paddle.nn import layer, LayerList
@@ -96,19 +117,26 @@ class MoELayer(nn.Layer):
                  gate=None,
                  recompute_interval=0,
                  recompute_partition=False,
-                 recompute_offload=False):
+                 recompute_offload=False,
+                 padded_dispatch=False,
+                 capacity=None,
+                 a2a_chunks=1,
+                 a2a_local_size=0,
+                 grouped_capacity=None):
         super(MoELayer, self).__init__()
 
         self.d_model = d_model
 
         assert experts is not None
-        assert isinstance(experts, (list, nn.LayerList)), \
-             "The type of experts must be list or nn.LayerList"
+        assert isinstance(experts, (list, nn.LayerList, GroupedExperts)), \
+             "The type of experts must be list, nn.LayerList or GroupedExperts"
 
-        for i, exp in enumerate(experts):
-            assert isinstance(
-                exp,
-                nn.Layer), "The type of experts[{}] must be nn.Layer".format(i)
+        self.grouped_experts = isinstance(experts, GroupedExperts)
+        if not self.grouped_experts:
+            for i, exp in enumerate(experts):
+                assert isinstance(
+                    exp, nn.Layer
+                ), "The type of experts[{}] must be nn.Layer".format(i)
 
         self.experts = nn.LayerList(experts) if isinstance(experts,
                                                            list) else experts
@@ -155,6 +183,27 @@ class MoELayer(nn.Layer):
             "partition": recompute_partition,
         }
 
+        self.grouped_capacity = grouped_capacity
+        self.padded_dispatch = padded_dispatch
+        if capacity is None:
+            capacity = getattr(self.gate, "capacity", (1.2, 2.4))
+        self.capacity = capacity
+        assert a2a_chunks == 1 or padded_dispatch, \
+            "a2a_chunks > 1 is only supported by the padded dispatch."
+        self.a2a_chunks = a2a_chunks
+        # The group of the all-to-all of the padded dispatch.
+        self.a2a_group = self.group
+        if a2a_local_size > 0 and self.world_size > a2a_local_size:
+            assert padded_dispatch, \
+                "The hierarchical all-to-all is only supported by the padded dispatch."
+            self.a2a_group = get_hierarchical_group(self.group,
+                                                    a2a_local_size)
+        if padded_dispatch:
+            # The padded dispatch drops the tokens over the capacity itself.
+            self.gate.limit_capacity = False
+        self._dispatch_stats = None
+        self._stats_lock = threading.Lock()
+
     def forward(self, inp):
         origin_shape = inp.shape
         inp = inp.reshape_([-1, origin_shape[-1]])
@@ -168,13 +217,27 @@ class MoELayer(nn.Layer):
             inp = Slice.apply(inp, mp_rank, mp_size, self.mp_group)
         value, gate = self.gate(inp)
 
+        if self.padded_dispatch:
+            x = self._padded_forward(inp, value, gate)
+        else:
+            x = self._dynamic_forward(inp, value, gate)
+
+        if mp_size > 1:
+            x = AllGather.apply(x, mp_rank, mp_size, self.mp_group)
+
+        x = paddle.reshape_(x, origin_shape)
+
+        return x
+
+    def _dynamic_forward(self, inp, value, gate):
         (
             pos,
             local_expert_count,
             global_expert_count,
             fwd_expert_count,
-            fwd_batch_size, ) = prepare_forward(gate, self.num_expert,
-                                                self.world_size, self.group)
+            fwd_batch_size,
+            fwd_max_expert_count, ) = prepare_forward(
+                gate, self.num_expert, self.world_size, self.group)
 
         topk = 1
         if len(gate.shape) == 2:
@@ -207,7 +270,34 @@ class MoELayer(nn.Layer):
                 last_index = expert_count + last_index
             return paddle.concat(y, axis=0)
 
-        if self.recompute_interval <= 0 or x.shape[0] == 0:
+        if self.grouped_experts:
+            # The counts stay on device. The capacity is static, or the max
+            # count read back together with fwd_batch_size.
+            if self.grouped_capacity is None:
+                capacity = fwd_max_expert_count
+            else:
+                capacity_factor = self.grouped_capacity[0 if self.training
+                                                        else 1]
+                capacity = max(
+                    int(math.ceil(capacity_factor * inp.shape[0] *
+                                  self.top_k / self.num_expert)), 1)
+                # Counted once a training step as the padded dispatch.
+                if self.training and paddle.is_grad_enabled():
+                    with paddle.no_grad():
+                        expert_count = fwd_expert_count.astype('int64')
+                        self._update_dispatch_stats(
+                            expert_count,
+                            paddle.clip(
+                                expert_count, max=capacity).sum(),
+                            expert_count.sum(), self.num_expert * capacity)
+            if self.recompute_interval <= 0 or x.shape[0] == 0:
+                x = self.experts(x, fwd_expert_count, capacity)
+            elif self.world_size > 1:
+                x = recompute_hybrid(self.recompute_ctx, self.experts, x,
+                                     fwd_expert_count, capacity)
+            else:
+                x = recompute(self.experts, x, fwd_expert_count, capacity)
+        elif self.recompute_interval <= 0 or x.shape[0] == 0:
             x = experts_fwd(x, fwd_expert_count.numpy(), self.experts)
         elif self.world_size > 1:
             x = recompute_hybrid(self.recompute_ctx, experts_fwd, x,
@@ -225,11 +315,152 @@ class MoELayer(nn.Layer):
 
         x = x.reshape([-1, self.top_k, d_model])
         value = value.reshape([x.shape[0], 1, self.top_k])
-        x = paddle.bmm(value, x).reshape([-1, d_model])
-
-        if mp_size > 1:
-            x = AllGather.apply(x, mp_rank, mp_size, self.mp_group)
-
-        x = paddle.reshape_(x, origin_shape)
-
-        return x
+        return paddle.bmm(value, x).reshape([-1, d_model])
+
+    def _padded_forward(self, inp, value, gate):
+        """
+        Dispatches the tokens into buffers of [num_expert, capacity, d_model]
+        of a static shape, the capacity of every expert is
+        ceil(capacity_factor * num_tokens * top_k / total_expert). The
+        assignments over the capacity are dropped, their outputs are zeros,
+        in the order of all the top-1 choices before the top-2 ones. Nothing
+        is read back to host.
+
+        The dispatch statistics count the training forwards with grad only.
+        The recompute of the layer runs the forward without grad first and
+        again with grad in backward, so a step is counted once either way,
+        and the evaluation is never counted.
+        """
+        update_stats = self.training and paddle.is_grad_enabled()
+        num_tokens, d_model = inp.shape
+        top_k = gate.shape[1] if len(gate.shape) == 2 else 1
+        assert top_k == self.top_k
+        total_expert = self.num_expert * self.world_size
+        capacity_factor = self.capacity[0 if self.training else 1]
+        capacity = max(
+            int(math.ceil(capacity_factor * num_tokens * top_k /
+                          total_expert)), 1)
+        num_slots = total_expert * capacity
+
+        with paddle.no_grad():
+            # The assignments of [top_k * num_tokens], -1 if pruned by the
+            # gate, e.g. random routing of GShardGate.
+            expert_idx = gate.reshape([num_tokens, top_k]).transpose(
+                [1, 0]).reshape([-1]).astype('int64')
+            valid = expert_idx >= 0
+            one_hot = F.one_hot(
+                paddle.clip(
+                    expert_idx, min=0), total_expert).astype('int64')
+            one_hot = one_hot * valid.astype('int64').unsqueeze(1)
+            # The position of every assignment among those of its expert.
+            position = (paddle.cumsum(
+                one_hot, axis=0) * one_hot).sum(axis=1) - 1
+            keep = paddle.logical_and(valid, position < capacity)
+            # The dropped assignments go to the extra slot of num_slots.
+            slot = paddle.where(keep, expert_idx * capacity + position,
+                                paddle.full_like(expert_idx, num_slots))
+            token_idx = paddle.arange(
+                top_k * num_tokens, dtype='int64') % num_tokens
+            # The token of every slot, num_tokens for the empty ones.
+            slot_token = paddle.scatter(
+                paddle.full(
+                    [num_slots + 1], num_tokens, dtype='int64'),
+                slot,
+                token_idx,
+                overwrite=True)[:num_slots]
+
+            if update_stats:
+                self._update_dispatch_stats(
+                    one_hot.sum(axis=0),
+                    keep.astype('int64').sum(),
+                    valid.astype('int64').sum(), num_slots)
+
+        zero_row = paddle.zeros([1, d_model], dtype=inp.dtype)
+        x = paddle.gather(paddle.concat([inp, zero_row]), slot_token)
+        # The slots of [world_size, num_expert, capacity, d_model], the
+        # world_size dim is exchanged by the all-to-all.
+        x = x.reshape([self.world_size, self.num_expert, capacity, -1])
+
+        def experts_fwd(x, experts):
+            if isinstance(experts, GroupedExperts):
+                return experts.grouped_forward(x)
+            return paddle.stack(
+                [expert(x[i]) for i, expert in enumerate(experts)])
+
+        def local_experts_fwd(x):
+            # The rows from every rank to every local expert.
+            world_size, num_expert, chunk_capacity, _ = x.shape
+            x = x.transpose([1, 0, 2, 3]).reshape(
+                [num_expert, world_size * chunk_capacity, -1])
+            if self.recompute_interval <= 0:
+                x = experts_fwd(x, self.experts)
+            elif self.world_size > 1:
+                x = recompute_hybrid(self.recompute_ctx, experts_fwd, x,
+                                     self.experts)
+            else:
+                x = recompute(experts_fwd, x, self.experts)
+            return x.reshape([num_expert, world_size, chunk_capacity,
+                              -1]).transpose([1, 0, 2, 3])
+
+        if self.world_size == 1:
+            x = local_experts_fwd(x)
+        elif self.a2a_chunks > 1:
+            # The chunks overlap the flat all-to-all only.
+            x = AllToAllPipeline.apply(x, local_experts_fwd, self.a2a_chunks,
+                                       self.group)
+        else:
+            x = AllToAll.apply(x, self.a2a_group)
+            x = AllToAll.apply(local_experts_fwd(x), self.a2a_group)
+        x = x.reshape([num_slots, -1])
+
+        zero_row = paddle.zeros([1, x.shape[1]], dtype=x.dtype)
+        x = paddle.gather(paddle.concat([x, zero_row]), slot)
+        x = x.reshape([top_k, num_tokens, d_model]).transpose([1, 0, 2])
+        value = value.reshape([num_tokens, 1, top_k]).astype(x.dtype)
+        return paddle.bmm(value, x).reshape([-1, d_model])
+
+    def _update_dispatch_stats(self, expert_load, num_kept, num_valid,
+                               num_slots):
+        stats = paddle.concat([
+            expert_load.astype('float32'),
+            paddle.stack([
+                num_kept.astype('float32').reshape([]),
+                num_valid.astype('float32').reshape([]),
+                paddle.full(
+                    [], num_slots, dtype='float32'),
+                paddle.ones(
+                    [], dtype='float32'),
+            ]),
+        ])
+        with self._stats_lock:
+            self._dispatch_stats = stats if self._dispatch_stats is None \
+                else self._dispatch_stats + stats
+
+    def get_dispatch_stats(self, reset=True):
+        """
+        The statistics of the padded dispatch, or of the static capacity of
+        grouped_capacity, of the training steps since the last reset, read
+        back to host, None if there is neither of them.
+
+        Returns:
+            dict: expert_load, the fraction of the assignments to every
+                expert of all the ranks, or of the rows received by every
+                local expert for grouped_capacity, drop_rate, the fraction of the
+                assignments dropped for the capacity, capacity_utilization,
+                the fraction of the slots used, and num_steps.
+        """
+        with self._stats_lock:
+            stats = self._dispatch_stats
+            if reset:
+                self._dispatch_stats = None
+        if stats is None:
+            return None
+        stats = stats.numpy()
+        expert_load = stats[:-4]
+        num_kept, num_valid, num_slots, num_steps = stats[-4:]
+        return {
+            "expert_load": expert_load / max(expert_load.sum(), 1.),
+            "drop_rate": float(1. - num_kept / max(num_valid, 1.)),
+            "capacity_utilization": float(num_kept / max(num_slots, 1.)),
+            "num_steps": int(num_steps),
+        }
@@ -30,19 +30,104 @@ def prepare_forward(gate, num_expert, world_size, moe_group):
     with paddle.no_grad():
         fwd_expert_count = global_expert_count.reshape_(
             [world_size, num_expert]).sum(axis=0)
-        fwd_batch_size = int(fwd_expert_count.sum().item())
+        # Read back the batch size and the max count of the experts at once,
+        # the latter is the capacity of the grouped experts.
+        sizes = paddle.stack(
+            [fwd_expert_count.sum(), fwd_expert_count.max()]).numpy()
+        fwd_batch_size, fwd_max_expert_count = int(sizes[0]), int(sizes[1])
     return (
         pos,
         local_expert_count,
         global_expert_count,
         fwd_expert_count,
-        fwd_batch_size, )
+        fwd_batch_size,
+        fwd_max_expert_count, )
+
+
+class HierarchicalGroup(object):
+    """
+    An expert parallel group spanning several nodes, whose all-to-all of
+    equal splits runs in two levels: an all-to-all within every node that
+    aggregates the blocks of all the local ranks for the same local rank of
+    the other nodes, then an all-to-all between the ranks of the same local
+    rank of all the nodes. Every pair of ranks across nodes exchanges one
+    message of local_size blocks instead of local_size * local_size small
+    ones over the slow link, and the result is the same as the flat one.
+
+    Use `get_hierarchical_group`, which creates the groups once, it must be
+    called by all the ranks in the same order as `new_group`.
+
+    Args:
+        group (Group): the expert parallel group, whose ranks are ordered by
+            node with local_size ranks of every node.
+        local_size (int): the number of ranks of every node.
+    """
+
+    def __init__(self, group, local_size):
+        ranks = list(group.ranks)
+        assert len(ranks) % local_size == 0, \
+            "The number of ranks {} should be divisible by local_size {}".format(
+                len(ranks), local_size)
+        self.group = group
+        self.nranks = group.nranks
+        self.rank = group.rank
+        self.local_size = local_size
+        self.num_nodes = len(ranks) // local_size
+
+        self.intra_group = None
+        self.inter_group = None
+        for node in range(self.num_nodes):
+            intra_group = paddle.distributed.new_group(ranks[
+                node * local_size:(node + 1) * local_size])
+            if intra_group.is_member():
+                self.intra_group = intra_group
+        for local_rank in range(local_size):
+            inter_group = paddle.distributed.new_group(ranks[local_rank::
+                                                             local_size])
+            if inter_group.is_member():
+                self.inter_group = inter_group
+
+    def is_member(self):
+        return self.group.is_member()
+
+
+_hierarchical_groups = {}
+
+
+def get_hierarchical_group(group, local_size):
+    """
+    The `HierarchicalGroup` of group, created at the first call.
+    """
+    key = (tuple(group.ranks), local_size)
+    if key not in _hierarchical_groups:
+        _hierarchical_groups[key] = HierarchicalGroup(group, local_size)
+    return _hierarchical_groups[key]
+
+
+def _hierarchical_alltoall(in_tensor, group):
+    """
+    The all-to-all of a `HierarchicalGroup`. The all-to-all between the nodes
+    starts after the one within the node is done, and both are waited, so it
+    is synchronous.
+    """
+    # The blocks of [num_nodes, local_size] destinations, grouped by the
+    # destination local rank for the all-to-all within the node.
+    x = in_tensor.reshape([group.num_nodes, group.local_size, -1])
+    x = _alltoall(x.transpose([1, 0, 2]), group=group.intra_group)
+    # [local_size source, num_nodes destination] blocks, grouped by the
+    # destination node for the all-to-all between the nodes, which gives the
+    # blocks of [num_nodes, local_size] sources as the flat all-to-all.
+    x = x.transpose([1, 0, 2]).reshape(in_tensor.shape)
+    return _alltoall(x, group=group.inter_group)
 
 
 def _alltoall(in_tensor_list, group=None, use_calc_stream=True):
     if group is not None and not group.is_member():
         return
 
+    if isinstance(group, HierarchicalGroup):
+        return _hierarchical_alltoall(in_tensor_list, group)
+
     if in_dygraph_mode():
         group = paddle.distributed.collective._get_default_group(
         ) if group is None else group
@@ -57,6 +142,21 @@ def _alltoall(in_tensor_list, group=None, use_calc_stream=True):
                                              ring_id)
 
 
+def _alltoall_async(in_tensor, group=None):
+    """
+    Starts an all-to-all of equal splits without waiting for it, returns the
+    output and the task to wait before using the output. group can not be a
+    `HierarchicalGroup`, whose all-to-all is synchronous.
+    """
+    assert not isinstance(group, HierarchicalGroup), \
+        "The hierarchical all-to-all is synchronous."
+    group = paddle.distributed.collective._get_default_group(
+    ) if group is None else group
+    out = paddle.empty(in_tensor.shape, in_tensor.dtype)
+    task = group.process_group.alltoall(in_tensor, out)
+    return out, task
+
+
 def _local_scatter(inp, pos):
     if pos.shape != [0]:
         inp_buf = paddle.index_select(inp, pos, 0)
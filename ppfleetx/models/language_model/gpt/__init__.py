@@ -20,3 +20,5 @@ from .auto.auto_model import (GPTModelAuto, GPTForPretrainingAuto,
                               GPTForGenerationAuto)
 
 from .dygraph.single_model import GPTForPretraining, GPTPretrainingCriterion, GPTModel, GPTForGeneration, GPTForSequenceClassification
+from .dygraph.continuous_batching import ContinuousBatchingScheduler, GenerationRequest
+from .dygraph.prefix_cache import PrefixCache
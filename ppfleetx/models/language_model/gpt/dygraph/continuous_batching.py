@@ -0,0 +1,371 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import asyncio
+import threading
+
+import numpy as np
+import paddle
+import paddle.nn.functional as F
+
+from .single_model import MultiHeadAttention
+from .processor import top_k_top_p_sampling
+from ppfleetx.utils.log import logger
+
+
+class GenerationRequest(object):
+    """
+    A prompt to be generated by `ContinuousBatchingScheduler` with its own
+    sampling params.
+
+    Args:
+        input_ids (List[int]): the token ids of the prompt.
+        max_dec_len (int): the max number of generated tokens.
+        top_k (int): keep the top_k tokens to sample, 0 to keep all.
+        top_p (float): keep the most probable tokens whose probabilities add
+            up to top_p.
+        temperature (float): logits = logits / temperature, 0 for greedy
+            search.
+        on_finish (callable): called with the request by the scheduler
+            thread when it is finished.
+    """
+
+    def __init__(self,
+                 input_ids,
+                 max_dec_len=20,
+                 top_k=0,
+                 top_p=1.0,
+                 temperature=1.0,
+                 on_finish=None):
+        self.input_ids = list(input_ids)
+        self.max_dec_len = max_dec_len
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.on_finish = on_finish
+
+        self.output_ids = []
+        # "eos", "length" or "error"
+        self.finish_reason = None
+        self.error = None
+
+
+def sample_next_tokens(logits, top_k, top_p, temperature):
+    """
+    Samples a token for every row of logits with the params of the row.
+
+    Only the top k tokens are sorted, k the max top_k of the rows, the whole
+    vocab is sorted only if a row filters by top_p without top_k. The rows
+    without any filtering sample from the whole vocab without sorting, and
+    a batch of greedy rows takes the argmax.
+
+    Args:
+        logits (Tensor): [batch_size, vocab_size].
+        top_k (numpy.ndarray): [batch_size], 0 to keep all the tokens.
+        top_p (numpy.ndarray): [batch_size].
+        temperature (numpy.ndarray): [batch_size], 0 for greedy search.
+    Returns:
+        numpy.ndarray: the token ids of [batch_size].
+    """
+    vocab_size = logits.shape[-1]
+    greedy = temperature <= 0
+    if greedy.all():
+        return paddle.argmax(logits, axis=-1).numpy()
+
+    top_k = np.where(greedy, 1,
+                     np.where(top_k <= 0, 0, np.minimum(top_k, vocab_size)))
+    top_p = np.where(greedy, 1.0, top_p)
+    temperature = np.where(greedy, 1.0, temperature)
+    logits = logits / paddle.to_tensor(
+        temperature[:, None], dtype=logits.dtype)
+    logits = logits.astype('float32')
+
+    # The rows sampled from the whole vocab.
+    unfiltered = (top_k == 0) & (top_p >= 1.0)
+    if unfiltered.any():
+        next_tokens = paddle.multinomial(F.softmax(
+            logits, axis=-1)).numpy()[:, 0]
+        if unfiltered.all():
+            return next_tokens
+
+    filtered_top_k = top_k[~unfiltered]
+    filtered_top_p = top_p[~unfiltered]
+    k = vocab_size if (filtered_top_k == 0).any() else int(
+        filtered_top_k.max())
+    if len(set(filtered_top_k)) == 1 and len(set(filtered_top_p)) == 1:
+        # The rows to filter share the params.
+        sampled = top_k_top_p_sampling(
+            logits, top_k=k, top_p=float(filtered_top_p[0])).numpy()[:, 0]
+    else:
+        topk_logits, topk_ids = paddle.topk(logits, k=k)
+        probs = paddle.exp(topk_logits - paddle.logsumexp(
+            logits, axis=-1, keepdim=True))
+        rank = paddle.arange(k, dtype='int64').unsqueeze(0)
+        keep = rank < paddle.to_tensor(
+            np.where(top_k == 0, vocab_size, top_k)[:, None], dtype='int64')
+        # Keep the tokens before the cumulative probability reaches top_p,
+        # the first token is always kept.
+        keep = paddle.logical_and(keep, (paddle.cumsum(
+            probs, axis=-1) - probs) <= paddle.to_tensor(
+                top_p[:, None], dtype='float32'))
+        probs = paddle.where(keep, probs, paddle.zeros_like(probs))
+        choice = paddle.multinomial(probs)
+        sampled = paddle.take_along_axis(topk_ids, choice,
+                                         axis=1).numpy()[:, 0]
+
+    if unfiltered.any():
+        return np.where(unfiltered, next_tokens, sampled)
+    return sampled
+
+
+class ContinuousBatchingScheduler(object):
+    """
+    Keeps a running batch of sequences at different decode positions. At
+    every step the waiting requests are admitted into the free slots of the
+    batch, one token is decoded for all the running sequences, and the
+    finished ones are evicted, so a long request never holds up the others.
+
+    Every slot owns a row of the preallocated KV cache of
+    [max_batch_size, num_heads, max_length, head_dim], the prompt of a new
+    request is prefilled into its row and the decode steps write the new
+    keys and values at the position of every row in place.
+
+    Args:
+        model (GPTForGeneration): the model to generate with.
+        max_batch_size (int): the number of slots of the running batch.
+        max_length (int): the max length of prompt and generated tokens.
+        queue_size (int): the max number of waiting requests, `submit`
+            blocks or raises `queue.Full` when the queue is full.
+        eos_token_id (int): the end of text token, model.eos_token_id by
+            default.
+    """
+
+    def __init__(self,
+                 model,
+                 max_batch_size=8,
+                 max_length=1024,
+                 queue_size=64,
+                 eos_token_id=None):
+        self.model = model
+        self.gpt = model.gpt
+        self.max_batch_size = max_batch_size
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id if eos_token_id is not None \
+            else model.eos_token_id
+
+        self.waiting = queue.Queue(maxsize=queue_size)
+        self.slots = [None] * max_batch_size
+        self.seq_lens = np.zeros([max_batch_size], dtype='int64')
+        self.last_tokens = np.zeros([max_batch_size], dtype='int64')
+        self.cache = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, request, block=True, timeout=None):
+        """
+        Puts a request into the waiting queue, raises `queue.Full` if the
+        queue is still full after timeout or at once if block is False.
+        """
+        if len(request.input_ids) == 0:
+            request.input_ids = [self.eos_token_id]
+        if len(request.input_ids) >= self.max_length:
+            raise ValueError(
+                "The prompt length {} should be less than max_length {}".
+                format(len(request.input_ids), self.max_length))
+        self.waiting.put(request, block=block, timeout=timeout)
+
+    async def generate(self, request, block=False):
+        """
+        Submits a request from asyncio and waits until it is finished. With
+        block False, `queue.Full` is raised at once when the queue is full,
+        so that the callers can reject the request.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_finish(request):
+            loop.call_soon_threadsafe(_set_future_result, future, request)
+
+        request.on_finish = on_finish
+        if block:
+            await loop.run_in_executor(None, self.submit, request)
+        else:
+            self.submit(request, block=False)
+        return await future
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run_forever, name="continuous_batching", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_forever(self):
+        with paddle.no_grad():
+            while not self._stop.is_set():
+                if not self.step():
+                    # Sleep until a request comes.
+                    try:
+                        request = self.waiting.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    self._admit(request)
+
+    def step(self):
+        """
+        Admits the waiting requests and decodes one token for the running
+        batch. Returns False if there is nothing to do.
+        """
+        while None in self.slots and not self.waiting.empty():
+            try:
+                request = self.waiting.get_nowait()
+            except queue.Empty:
+                break
+            self._admit(request)
+
+        if all(request is None for request in self.slots):
+            return False
+        try:
+            self._decode()
+        except Exception as e:
+            logger.warning("Failed to decode the running batch: {}".format(e))
+            for slot, request in enumerate(self.slots):
+                if request is not None:
+                    self.slots[slot] = None
+                    request.error = e
+                    self._finish(request, "error")
+        return True
+
+    @property
+    def num_running(self):
+        return sum(request is not None for request in self.slots)
+
+    def _logits(self, hidden_states):
+        return paddle.matmul(
+            hidden_states[:, -1, :],
+            self.gpt.embeddings.word_embeddings.weight,
+            transpose_y=True)
+
+    def _admit(self, request):
+        slot = self.slots.index(None)
+        try:
+            input_ids = paddle.to_tensor([request.input_ids], dtype='int64')
+            if self.model.prefix_cache is not None:
+                hidden_states, cache = self.model.prefill_with_prefix_cache(
+                    input_ids)
+            else:
+                hidden_states, cache = self.gpt(input_ids, use_cache=True)
+
+            if self.cache is None:
+                _, num_heads, _, head_dim = cache[0].k.shape
+                shape = [
+                    self.max_batch_size, num_heads, self.max_length, head_dim
+                ]
+                self.cache = [(paddle.zeros(
+                    shape, dtype=cache[0].k.dtype), paddle.zeros(
+                        shape, dtype=cache[0].k.dtype)) for _ in cache]
+
+            seq_len = len(request.input_ids)
+            for (k, v), layer_cache in zip(self.cache, cache):
+                k[slot, :, :seq_len, :] = layer_cache.k[0]
+                v[slot, :, :seq_len, :] = layer_cache.v[0]
+
+            next_token = sample_next_tokens(
+                self._logits(hidden_states),
+                np.array([request.top_k]),
+                np.array([request.top_p], dtype='float32'),
+                np.array([request.temperature], dtype='float32'))[0]
+        except Exception as e:
+            logger.warning("Failed to prefill the request: {}".format(e))
+            request.error = e
+            self._finish(request, "error")
+            return
+
+        self.slots[slot] = request
+        self.seq_lens[slot] = seq_len
+        self._append_token(slot, next_token)
+
+    def _decode(self):
+        input_ids = paddle.to_tensor(self.last_tokens[:, None])
+        position_ids = paddle.to_tensor(self.seq_lens[:, None])
+        # Every row attends to its own prefix and the current token.
+        attention_mask = np.where(
+            np.arange(self.max_length)[None, :] <= self.seq_lens[:, None],
+            0.0, -1e4)
+        attention_mask = paddle.to_tensor(
+            attention_mask, dtype=paddle.get_default_dtype())
+        seq_lens = paddle.to_tensor(self.seq_lens)
+        cache = [
+            MultiHeadAttention.PreallocatedCache(k, v, seq_lens)
+            for k, v in self.cache
+        ]
+
+        hidden_states, _ = self.gpt(input_ids,
+                                    position_ids=position_ids,
+                                    attention_mask=attention_mask,
+                                    use_cache=True,
+                                    cache=cache)
+
+        params = [(request.top_k, request.top_p, request.temperature)
+                  if request is not None else (1, 1.0, 0.0)
+                  for request in self.slots]
+        top_k, top_p, temperature = zip(*params)
+        next_tokens = sample_next_tokens(
+            self._logits(hidden_states),
+            np.array(top_k),
+            np.array(
+                top_p, dtype='float32'),
+            np.array(
+                temperature, dtype='float32'))
+
+        for slot, request in enumerate(self.slots):
+            if request is not None:
+                self.seq_lens[slot] += 1
+                self._append_token(slot, next_tokens[slot])
+
+    def _append_token(self, slot, token):
+        request = self.slots[slot]
+        request.output_ids.append(int(token))
+        self.last_tokens[slot] = token
+
+        if token == self.eos_token_id:
+            finish_reason = "eos"
+        elif len(request.output_ids) >= request.max_dec_len or \
+                self.seq_lens[slot] + 1 >= self.max_length:
+            finish_reason = "length"
+        else:
+            return
+
+        # Evict the finished request, its slot is free for the next one.
+        self.slots[slot] = None
+        self.seq_lens[slot] = 0
+        self.last_tokens[slot] = 0
+        self._finish(request, finish_reason)
+
+    def _finish(self, request, finish_reason):
+        request.finish_reason = finish_reason
+        if request.on_finish is not None:
+            request.on_finish(request)
+
+
+def _set_future_result(future, request):
+    if not future.done():
+        future.set_result(request)
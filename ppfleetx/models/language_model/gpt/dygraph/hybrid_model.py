@@ -31,7 +31,8 @@ from paddle.distributed.fleet.meta_parallel import LayerDesc, PipelineLayer, Sha
 from paddle.distributed.fleet.utils import recompute
 import sys
 
-from .single_model import ExpertLayer
+from .single_model import ExpertLayer, GroupedExpertLayer
+from .processor import top_k_top_p_sampling
 from .sequence_parallel_utils import ScatterOp, GatherOp, \
         mark_as_sequence_parallel_parameter, ColumnSequenceParallelLinear, RowSequenceParallelLinear
 
@@ -80,6 +81,10 @@ class MultiHeadAttention(nn.Layer):
 
     Cache = collections.namedtuple("Cache", ["k", "v"])
     StaticCache = collections.namedtuple("StaticCache", ["k", "v"])
+    # k and v are buffers of [batch_size, num_heads, max_length, head_dim],
+    # only the first seq_len positions are valid.
+    PreallocatedCache = collections.namedtuple("PreallocatedCache",
+                                               ["k", "v", "seq_len"])
 
     def __init__(self,
                  embed_dim,
@@ -187,12 +192,17 @@ class MultiHeadAttention(nn.Layer):
             cache, self.StaticCache
         ), "cache currently does not support the StaticCache type"
 
-        if isinstance(cache, self.Cache):
-            # for decoder self-attention in inference
-            k = tensor.concat([cache.k, k], axis=2)
-            v = tensor.concat([cache.v, v], axis=2)
-        if use_cache is True:
-            cache = self.Cache(k, v)
+        if isinstance(cache, self.PreallocatedCache):
+            # for decoder self-attention in inference, without reallocating
+            # the cache at every step
+            k, v, cache = self._update_preallocated_cache(cache, k, v)
+        else:
+            if isinstance(cache, self.Cache):
+                # for decoder self-attention in inference
+                k = tensor.concat([cache.k, k], axis=2)
+                v = tensor.concat([cache.v, v], axis=2)
+            if use_cache is True:
+                cache = self.Cache(k, v)
 
         return (q, k, v) if use_cache is False else (q, k, v, cache)
 
@@ -216,15 +226,64 @@ class MultiHeadAttention(nn.Layer):
         else:
             k, v = self.compute_kv(key, value)
 
-        if isinstance(cache, self.Cache):
-            # for decoder self-attention in inference
-            k = tensor.concat([cache.k, k], axis=2)
-            v = tensor.concat([cache.v, v], axis=2)
-        if use_cache is True:
-            cache = self.Cache(k, v)
+        if isinstance(cache, self.PreallocatedCache):
+            # for decoder self-attention in inference, without reallocating
+            # the cache at every step
+            k, v, cache = self._update_preallocated_cache(cache, k, v)
+        else:
+            if isinstance(cache, self.Cache):
+                # for decoder self-attention in inference
+                k = tensor.concat([cache.k, k], axis=2)
+                v = tensor.concat([cache.v, v], axis=2)
+            if use_cache is True:
+                cache = self.Cache(k, v)
 
         return (q, k, v) if use_cache is False else (q, k, v, cache)
 
+    def _update_preallocated_cache(self, cache, k, v):
+        """
+        Writes k and v at the current position of the cache in place, and
+        returns the whole buffers for attention, the positions after the
+        valid ones are masked out by `mask_preallocated_cache`, so the valid
+        part is never copied out of the buffers.
+        """
+        seq_len = cache.seq_len + k.shape[2]
+        assert seq_len <= cache.k.shape[2], \
+            "the length {} exceeds the preallocated cache length {}".format(
+                seq_len, cache.k.shape[2])
+        cache.k[:, :, cache.seq_len:seq_len, :] = k
+        cache.v[:, :, cache.seq_len:seq_len, :] = v
+        return (cache.k, cache.v,
+                self.PreallocatedCache(cache.k, cache.v, seq_len))
+
+    @classmethod
+    def mask_preallocated_cache(cls, attn_mask, cache, length):
+        """
+        Extends attn_mask of the valid positions of a preallocated cache,
+        with length new tokens written, to the whole buffers by masking out
+        the positions after them. attn_mask is returned as it is for the
+        other caches.
+        """
+        if not isinstance(cache, cls.PreallocatedCache) or \
+                isinstance(cache.seq_len, paddle.Tensor):
+            return attn_mask
+        seq_len = cache.seq_len + length
+        max_length = cache.k.shape[2]
+        if seq_len == max_length:
+            return attn_mask
+        if attn_mask is not None and attn_mask.shape[-1] == seq_len:
+            pad = paddle.full(
+                attn_mask.shape[:-1] + [max_length - seq_len],
+                -1e4,
+                dtype=attn_mask.dtype)
+            return paddle.concat([attn_mask, pad], axis=-1)
+
+        # attn_mask is broadcast over the positions of the cache.
+        dtype = attn_mask.dtype if attn_mask is not None else \
+            paddle.get_default_dtype()
+        mask = (paddle.arange(max_length) >= seq_len).astype(dtype) * -1e4
+        return mask if attn_mask is None else attn_mask + mask
+
     def compute_kv(self, key, value):
         r"""
         Applies linear projection on input keys and values, then splits heads
@@ -499,6 +558,16 @@ class TransformerDecoderLayer(nn.Layer):
             self.top_k = moe_configs.get('top_k', 2)
             self.num_experts = moe_configs.get('num_experts', 1)
             self.expert_mode = moe_configs.get('expert_mode', False)
+            self.grouped_experts = moe_configs.get('grouped_experts', False)
+            self.grouped_capacity = moe_configs.get('grouped_capacity', None)
+            self.padded_dispatch = moe_configs.get('padded_dispatch', False)
+            self.capacity = moe_configs.get('capacity', None)
+            self.a2a_chunks = moe_configs.get('a2a_chunks', 1)
+            self.a2a_local_size = 0
+            if moe_configs.get('hierarchical_a2a', False):
+                self.a2a_local_size = moe_configs.get(
+                    'a2a_local_size',
+                    None) or paddle.device.cuda.device_count()
 
         if sequence_parallel:
             ColumnParallelLinear = ColumnSequenceParallelLinear
@@ -525,10 +594,14 @@ class TransformerDecoderLayer(nn.Layer):
             do_recompute=do_recompute)
 
         if self.expert_mode:
-            experts_list = nn.LayerList([
-                ExpertLayer(d_model, dim_feedforward)
-                for e in range(self.num_experts)
-            ])
+            if self.grouped_experts:
+                experts_list = GroupedExpertLayer(self.num_experts, d_model,
+                                                  dim_feedforward)
+            else:
+                experts_list = nn.LayerList([
+                    ExpertLayer(d_model, dim_feedforward)
+                    for e in range(self.num_experts)
+                ])
 
             hcg = env.get_hcg()
             moe_group = hcg.get_expert_parallel_group()
@@ -541,7 +614,12 @@ class TransformerDecoderLayer(nn.Layer):
                 top_k=self.top_k,
                 moe_group=moe_group,
                 mp_group=mp_group,
-                recompute_interval=int(self.use_recompute))
+                recompute_interval=int(self.use_recompute),
+                padded_dispatch=self.padded_dispatch,
+                capacity=self.capacity,
+                a2a_chunks=self.a2a_chunks,
+                a2a_local_size=self.a2a_local_size,
+                grouped_capacity=self.grouped_capacity)
         else:
             self.linear1 = ColumnParallelLinear(
                 d_model,
@@ -791,6 +869,10 @@ class GPTModelHybrid(nn.Layer):
                 attention_mask = attention_mask + causal_mask
             else:
                 attention_mask = causal_mask
+            if cache is not None:
+                # The preallocated cache is attended as a whole.
+                attention_mask = MultiHeadAttention.mask_preallocated_cache(
+                    attention_mask, cache[0], input_ids.shape[-1])
             # The tensor returned by triu not in static graph.
             attention_mask.stop_gradient = True
 
@@ -1136,6 +1218,11 @@ class GPTForGenerationHybrid(nn.Layer):
         self.num_return_sequences = self.configs.get('num_return_sequences', 1)
         self.diversity_rate = self.configs.get('diversity_rate', 0.0)
         self.use_cache = self.configs.get('use_cache', True)
+        self.use_preallocated_cache = self.configs.get('preallocate_cache',
+                                                       True)
+        self.use_fused_sampling = self.configs.get('fused_sampling', True)
+        # The preallocated cache buffers, reused by the following calls.
+        self._cache_buffers = None
 
     def prepare_input_ids_for_generation(self,
                                          bos_token_id,
@@ -1248,6 +1335,59 @@ class GPTForGenerationHybrid(nn.Layer):
 
         return input_ids, model_kwargs
 
+    def build_preallocated_cache(self, cache, max_length):
+        """
+        Copies the cache of the prompt into buffers of max_length, so that
+        the following steps write their keys and values in place instead of
+        concatenating the whole cache at every step. The buffers are kept
+        and reused as long as the batch size and dtype are the same and
+        they are long enough.
+        """
+        batch_size, num_heads, seq_len, head_dim = cache[0].k.shape
+        dtype = cache[0].k.dtype
+
+        buffers = self._cache_buffers
+        if buffers is None or len(buffers) != len(cache) or \
+                buffers[0][0].shape[0] != batch_size or \
+                buffers[0][0].shape[2] < max_length or \
+                buffers[0][0].dtype != dtype:
+            # Release the old buffers before allocating the new ones.
+            self._cache_buffers = buffers = None
+            shape = [batch_size, num_heads, max_length, head_dim]
+            buffers = [(paddle.zeros(
+                shape, dtype=dtype), paddle.zeros(
+                    shape, dtype=dtype)) for _ in cache]
+            self._cache_buffers = buffers
+
+        preallocated_cache = []
+        for (k, v), layer_cache in zip(buffers, cache):
+            k[:, :, :seq_len, :] = layer_cache.k
+            v[:, :, :seq_len, :] = layer_cache.v
+            preallocated_cache.append(
+                MultiHeadAttention.PreallocatedCache(k, v, seq_len))
+        return preallocated_cache
+
+    def gather_rows(self, index, input_ids, scores, model_kwargs):
+        """
+        Keeps the rows of index of the batch in the inputs and the cache.
+        """
+        input_ids = paddle.gather(input_ids, index)
+        scores = paddle.gather(scores, index)
+        for name in [
+                "attention_mask", "position_ids", "token_type_ids", "role_ids"
+        ]:
+            if model_kwargs.get(name, None) is not None:
+                model_kwargs[name] = paddle.gather(model_kwargs[name], index)
+
+        cache = model_kwargs.get("cache", None)
+        if cache is not None:
+            model_kwargs["cache"] = [
+                type(layer_cache)(paddle.gather(layer_cache.k, index),
+                                  paddle.gather(layer_cache.v, index),
+                                  *layer_cache[2:]) for layer_cache in cache
+            ]
+        return input_ids, scores, model_kwargs
+
     def prepare_inputs_for_generation(self,
                                       input_ids,
                                       use_cache=False,
@@ -1348,6 +1488,7 @@ class GPTForGenerationHybrid(nn.Layer):
                top_p=None,
                temperature=None,
                min_tokens_to_keep=1,
+               streamer=None,
                **model_kwargs):
         def TopKProcess(probs, top_k, min_tokens_to_keep):
             top_k = min(max(top_k, min_tokens_to_keep), probs.shape[-1])
@@ -1389,6 +1530,13 @@ class GPTForGenerationHybrid(nn.Layer):
         batch_size, cur_len = input_ids.shape
         origin_len = input_ids.shape[1]
         unfinished_flag = paddle.full([batch_size, 1], True, dtype='bool')
+        # The index of every row in the original batch. The finished rows are
+        # dropped from the batch in dynamic mode, so that the following steps
+        # only compute the unfinished ones.
+        rows = paddle.arange(batch_size, dtype='int64')
+        drop_finished_rows = paddle.in_dynamic_mode() and \
+            eos_token_id is not None and pad_token_id is not None
+        finished_outputs = []
         scores = paddle.full(
             [batch_size, 1], 0.0, dtype=paddle.get_default_dtype())
 
@@ -1418,16 +1566,19 @@ class GPTForGenerationHybrid(nn.Layer):
             logits = logits_processors(input_ids, logits)
 
             # sample
-            origin_probs = F.softmax(logits)
-            origin_probs = paddle.log(origin_probs)
+            origin_probs = F.log_softmax(logits)
             if temperature is not None and temperature != 1.0:
                 logits = logits / temperature
-            probs = F.softmax(logits)
-            if top_k is not None and top_k != 0:
-                probs = TopKProcess(probs, top_k, min_tokens_to_keep)
-            if top_p is not None and top_p < 1.0:
-                probs = TopPProcess(probs, top_p, min_tokens_to_keep)
-            next_tokens = paddle.multinomial(probs)
+            if self.use_fused_sampling:
+                next_tokens = top_k_top_p_sampling(logits, top_k, top_p,
+                                                   min_tokens_to_keep)
+            else:
+                probs = F.softmax(logits)
+                if top_k is not None and top_k != 0:
+                    probs = TopKProcess(probs, top_k, min_tokens_to_keep)
+                if top_p is not None and top_p < 1.0:
+                    probs = TopPProcess(probs, top_p, min_tokens_to_keep)
+                next_tokens = paddle.multinomial(probs)
 
             next_scores = paddle.index_sample(origin_probs, next_tokens)
 
@@ -1436,6 +1587,11 @@ class GPTForGenerationHybrid(nn.Layer):
                     unfinished_flag, next_tokens,
                     paddle.full_like(next_tokens, pad_token_id))
 
+            # Hand the new tokens out as soon as they are sampled, the
+            # finished sequences have unfinished_flag False.
+            if streamer is not None:
+                streamer(next_tokens, unfinished_flag, rows)
+
             scores = self.update_scores_for_generation(
                 scores, next_scores, cur_len - origin_len, unfinished_flag)
 
@@ -1467,7 +1623,31 @@ class GPTForGenerationHybrid(nn.Layer):
             attn_mask, paddle.shape(attn_mask))
         model_kwargs['cache'] = outputs[1] if isinstance(outputs,
                                                          tuple) else None
+        # The preallocated cache is written in place, which is only for
+        # dynamic mode.
+        if self.use_preallocated_cache and paddle.in_dynamic_mode() and \
+                model_kwargs['cache'] is not None:
+            model_kwargs['cache'] = self.build_preallocated_cache(
+                model_kwargs['cache'], max_length)
         while cur_len < max_length:
+            if drop_finished_rows:
+                keep = paddle.nonzero(unfinished_flag[:, 0]).reshape([-1])
+                if keep.shape[0] == 0:
+                    break
+                if keep.shape[0] < rows.shape[0]:
+                    finished = paddle.nonzero(
+                        paddle.logical_not(unfinished_flag[:, 0])).reshape(
+                            [-1])
+                    finished_outputs.append(
+                        (paddle.gather(rows, finished), paddle.gather(
+                            input_ids[:, origin_len:], finished),
+                         paddle.gather(scores, finished)))
+                    rows = paddle.gather(rows, keep)
+                    input_ids, scores, model_kwargs = self.gather_rows(
+                        keep, input_ids, scores, model_kwargs)
+                    unfinished_flag = paddle.full(
+                        [keep.shape[0], 1], True, dtype='bool')
+
             # Note(GuoxiaWang): Remove outputs = _forward_(**model_kwargs) 
             # and change it to pass directly to _post_process_ to avoid 
             # closed-loop problem of dynamic-to-static model
@@ -1479,10 +1659,35 @@ class GPTForGenerationHybrid(nn.Layer):
             if not paddle.any(unfinished_flag):
                 break
 
-        return input_ids[:, origin_len:], scores
+        if not finished_outputs:
+            return input_ids[:, origin_len:], scores
+
+        # Put the dropped rows back and pad them to the same length, which
+        # is the same as generating all the rows until the end.
+        finished_outputs.append((rows, input_ids[:, origin_len:], scores))
+        all_rows, all_ids, all_scores = [], [], []
+        for finished_rows, ids, finished_scores in finished_outputs:
+            all_rows.append(finished_rows)
+            all_ids.append(
+                paddle.concat(
+                    [
+                        ids, paddle.full(
+                            [ids.shape[0], cur_len - origin_len - ids.shape[1]],
+                            pad_token_id,
+                            dtype=ids.dtype)
+                    ],
+                    axis=1))
+            all_scores.append(finished_scores)
+        order = paddle.argsort(paddle.concat(all_rows))
+        return (paddle.gather(paddle.concat(all_ids), order),
+                paddle.gather(paddle.concat(all_scores), order))
 
     def forward(self, input_ids=None, **model_kwargs):
 
+        # streamer(next_tokens, unfinished_flag, rows) is called at every
+        # step, rows is the index of every row in the original batch.
+        streamer = model_kwargs.pop('streamer', None)
+
         max_length = self.max_length
         min_length = self.min_length
         decode_strategy = self.decode_strategy
@@ -1558,9 +1763,17 @@ class GPTForGenerationHybrid(nn.Layer):
                     expand_size=num_return_sequences,
                     **model_kwargs)
 
-            ret = self.sample(input_ids, logits_processors, max_length,
-                              pad_token_id, eos_token_id, top_k, top_p,
-                              temperature, **model_kwargs)
+            ret = self.sample(
+                input_ids,
+                logits_processors,
+                max_length,
+                pad_token_id,
+                eos_token_id,
+                top_k,
+                top_p,
+                temperature,
+                streamer=streamer,
+                **model_kwargs)
         else:
             raise ValueError(f'Not support {decoding_strategy} strategy yet!')
         return ret
@@ -0,0 +1,140 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import collections
+
+import numpy as np
+import paddle
+from paddle.common_ops_import import convert_dtype
+
+
+class PrefixCache(object):
+    """
+    Keeps the keys and values of the prompt prefixes of GPT generation, so
+    that a new prompt only computes the tokens after its longest cached
+    prefix, e.g. the requests sharing a long system prompt.
+
+    The prompts are split into blocks of block_size tokens, and every block
+    is keyed by the hash of all the tokens up to its end, so a block is
+    shared by all the prompts with the same prefix. The blocks are evicted
+    in LRU order when their total size exceeds max_bytes.
+
+    The cached keys and values depend on the model parameters, call `clear`
+    after loading new parameters.
+
+    Args:
+        max_bytes (int): the max total size of the cached keys and values.
+        block_size (int): the number of tokens of a block.
+    """
+
+    def __init__(self, max_bytes, block_size=16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        # key -> [(k, v)] of every layer, of [num_heads, block_size, head_dim]
+        self.blocks = collections.OrderedDict()
+        self.num_bytes = 0
+
+        self.num_query_tokens = 0
+        self.num_hit_tokens = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def hit_rate(self):
+        """The ratio of the prompt tokens found in the cache."""
+        return self.num_hit_tokens / max(self.num_query_tokens, 1)
+
+    def clear(self):
+        self.blocks.clear()
+        self.num_bytes = 0
+
+    def block_keys(self, token_ids, max_length=None):
+        """
+        The keys of the full blocks of token_ids within max_length.
+        """
+        length = len(token_ids) if max_length is None else min(
+            len(token_ids), max_length)
+        token_ids = np.asarray(token_ids[:length], dtype='int64')
+
+        keys = []
+        key = b""
+        for end in range(self.block_size, length + 1, self.block_size):
+            m = hashlib.sha256(key)
+            m.update(token_ids[end - self.block_size:end].tobytes())
+            key = m.digest()
+            keys.append(key)
+        return keys
+
+    def get(self, token_ids, max_length=None):
+        """
+        Finds the longest cached prefix of token_ids within max_length.
+
+        Returns:
+            tuple: the length of the prefix and the [(k, v)] of every layer
+                of [1, num_heads, length, head_dim], or (0, None) if no
+                prefix is cached.
+        """
+        self.num_query_tokens += len(token_ids)
+        blocks = []
+        for key in self.block_keys(token_ids, max_length):
+            if key not in self.blocks:
+                break
+            blocks.append(key)
+        if not blocks:
+            return 0, None
+
+        # Mark the blocks used from the last one, so that the prefix blocks
+        # are always evicted after the blocks depending on them.
+        for key in reversed(blocks):
+            self.blocks.move_to_end(key)
+
+        length = len(blocks) * self.block_size
+        self.num_hit_tokens += length
+        cache = []
+        for layer_blocks in zip(* [self.blocks[key] for key in blocks]):
+            k, v = zip(*layer_blocks)
+            cache.append((paddle.concat(
+                k, axis=1).unsqueeze(0), paddle.concat(
+                    v, axis=1).unsqueeze(0)))
+        return length, cache
+
+    def put(self, token_ids, cache, row=0):
+        """
+        Stores the full blocks of token_ids, whose keys and values are the
+        first positions of row of cache, a list of the caches of every layer
+        with k and v of [batch_size, num_heads, seq_len, head_dim].
+        """
+        keys = self.block_keys(token_ids)
+        for i, key in enumerate(keys):
+            if key in self.blocks:
+                continue
+            start, end = i * self.block_size, (i + 1) * self.block_size
+            block = [(layer_cache.k[row, :, start:end, :].clone(),
+                      layer_cache.v[row, :, start:end, :].clone())
+                     for layer_cache in cache]
+            self.blocks[key] = block
+            self.num_bytes += self._block_bytes(block)
+        for key in reversed(keys):
+            self.blocks.move_to_end(key)
+
+        while self.num_bytes > self.max_bytes and self.blocks:
+            _, block = self.blocks.popitem(last=False)
+            self.num_bytes -= self._block_bytes(block)
+
+    def _block_bytes(self, block):
+        k = block[0][0]
+        itemsize = np.dtype(convert_dtype(k.dtype)).itemsize
+        return 2 * len(block) * int(np.prod(k.shape)) * itemsize
@@ -198,3 +198,128 @@ class ForcedEOSTokenLogitsProcessor(LogitsProcessor):
             ]] = -1e9  #TODO change back to -inf after paddle.topk is fixed
             scores[:, self.forced_eos_token_id] = 0
         return scores
+
+
+class BeamHypotheses:
+    """
+    Keeps the best `num_beams` finished hypotheses of a sequence for beam
+    search.
+    Args:
+        num_beams (int): The number of hypotheses to keep.
+        length_penalty (float): The score of a hypothesis is its sum of log
+            probabilities divided by ((length + 5) / 6) ** length_penalty.
+        early_stopping (bool): Whether to stop as soon as there are
+            `num_beams` finished hypotheses.
+    """
+
+    def __init__(self, num_beams, length_penalty, early_stopping):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def _score(self, sum_logprobs, length):
+        return sum_logprobs / (((length + 5) / 6)**self.length_penalty)
+
+    def add(self, hyp, sum_logprobs):
+        """
+        Adds a hypothesis, hyp is the list of generated token ids.
+        """
+        score = self._score(sum_logprobs, len(hyp))
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self) > self.num_beams:
+                self.beams.sort(key=lambda x: x[0])
+                del self.beams[0]
+                self.worst_score = self.beams[0][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, length):
+        """
+        Whether none of the running beams can be better than the worst kept
+        hypothesis, length is the generated length of the running beams.
+        """
+        if len(self) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        return self.worst_score >= self._score(best_sum_logprobs, length)
+
+
+def top_k_top_p_sampling(logits, top_k=0, top_p=1.0, min_tokens_to_keep=1):
+    """
+    Samples a token for every row of logits from the top_k tokens whose
+    cumulative probability is within top_p.
+
+    The top_k tokens are selected first, already in descending order, so
+    the nucleus filtering only runs over the k survivors instead of sorting
+    the whole vocab. The probabilities are normalized over the whole vocab,
+    which keeps exactly the same tokens as filtering the sorted vocab.
+    Args:
+        logits (Tensor): [batch_size, vocab_size], divided by temperature.
+        top_k (int): 0 to keep all the tokens.
+        top_p (float): 1.0 to keep all the tokens.
+        min_tokens_to_keep (int): the min number of tokens to keep.
+    Returns:
+        Tensor: the sampled token ids of [batch_size, 1].
+    """
+    vocab_size = logits.shape[-1]
+    if not top_k and (top_p is None or top_p >= 1.0):
+        return paddle.multinomial(paddle.nn.functional.softmax(logits))
+
+    k = min(max(top_k, min_tokens_to_keep),
+            vocab_size) if top_k else vocab_size
+    topk_logits, topk_ids = paddle.topk(logits, k=k)
+    probs = paddle.exp(topk_logits - paddle.logsumexp(
+        logits, axis=-1, keepdim=True))
+
+    if top_p is not None and top_p < 1.0:
+        # Keep a token if the cumulative probability before it is within
+        # top_p, so the first token is always kept.
+        keep = (paddle.cumsum(probs, axis=-1) - probs) <= top_p
+        if min_tokens_to_keep > 1:
+            keep = paddle.logical_or(
+                keep, paddle.arange(k).unsqueeze(0) < min_tokens_to_keep)
+        probs = paddle.where(keep, probs, paddle.zeros_like(probs))
+
+    next_ids = paddle.multinomial(probs)
+    return paddle.take_along_axis(topk_ids, next_ids, axis=1)
+
+
+def top_k_top_p_probs(logits, top_k=0, top_p=1.0, min_tokens_to_keep=1):
+    """
+    Returns the distribution `top_k_top_p_sampling` samples from, i.e. the
+    probabilities of the kept tokens renormalized and zeros for the others.
+    Args:
+        logits (Tensor): [batch_size, vocab_size], divided by temperature.
+        top_k (int): 0 to keep all the tokens.
+        top_p (float): 1.0 to keep all the tokens.
+        min_tokens_to_keep (int): the min number of tokens to keep.
+    Returns:
+        Tensor: the probabilities of [batch_size, vocab_size].
+    """
+    probs = paddle.nn.functional.softmax(logits)
+    if not top_k and (top_p is None or top_p >= 1.0):
+        return probs
+
+    vocab_size = logits.shape[-1]
+    k = min(max(top_k, min_tokens_to_keep),
+            vocab_size) if top_k else vocab_size
+    topk_probs, topk_ids = paddle.topk(probs, k=k)
+
+    if top_p is not None and top_p < 1.0:
+        keep = (paddle.cumsum(topk_probs, axis=-1) - topk_probs) <= top_p
+        if min_tokens_to_keep > 1:
+            keep = paddle.logical_or(
+                keep, paddle.arange(k).unsqueeze(0) < min_tokens_to_keep)
+        topk_probs = paddle.where(keep, topk_probs,
+                                  paddle.zeros_like(topk_probs))
+
+    probs = paddle.put_along_axis(
+        paddle.zeros_like(probs), topk_ids, topk_probs, axis=1)
+    return probs / probs.sum(axis=-1, keepdim=True)
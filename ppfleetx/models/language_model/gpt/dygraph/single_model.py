@@ -17,6 +17,7 @@
 import collections
 import logging
 
+import numpy as np
 import paddle
 import paddle.nn as nn
 import paddle.nn.functional as F
@@ -30,9 +31,13 @@ from paddle.incubate.nn import FusedLinear
 from .processor import (
     LogitsProcessorList, MinLengthLogitsProcessor,
     HammingDiversityLogitsProcessor, RepetitionPenaltyLogitsProcessor,
-    ForcedBOSTokenLogitsProcessor, ForcedEOSTokenLogitsProcessor)
+    ForcedBOSTokenLogitsProcessor, ForcedEOSTokenLogitsProcessor,
+    BeamHypotheses, top_k_top_p_sampling, top_k_top_p_probs)
 
-from ppfleetx.distributed.moe import MoELayer
+from .prefix_cache import PrefixCache
+
+from ppfleetx.distributed.moe import MoELayer, GroupedExperts
+from ppfleetx.utils.log import logger
 
 
 def get_attr(layer, name):
@@ -65,6 +70,61 @@ class ExpertLayer(nn.Layer):
         return x
 
 
+class GroupedExpertLayer(GroupedExperts):
+    """
+    num_expert ExpertLayers with their weights stacked, e.g. htoh4_weight of
+    [num_expert, d_model, d_hidden], computed by batched matmuls.
+    """
+
+    def __init__(self, num_expert, d_model, d_hidden, name=None):
+        super(GroupedExpertLayer, self).__init__(num_expert)
+
+        self.htoh4_weight = self.create_parameter(
+            shape=[num_expert, d_model, d_hidden],
+            default_initializer=nn.initializer.KaimingUniform(fan_in=d_model))
+        self.htoh4_bias = self.create_parameter(
+            shape=[num_expert, 1, d_hidden],
+            is_bias=True,
+            default_initializer=nn.initializer.Constant(value=0.0))
+        self.h4toh_weight = self.create_parameter(
+            shape=[num_expert, d_hidden, d_model],
+            default_initializer=nn.initializer.KaimingUniform(
+                fan_in=d_hidden))
+        self.h4toh_bias = self.create_parameter(
+            shape=[num_expert, 1, d_model],
+            is_bias=True,
+            default_initializer=nn.initializer.Constant(value=0.0))
+
+        for param in self.parameters():
+            param.name = "expert_" + param.name
+
+    @classmethod
+    def from_experts(cls, experts):
+        """
+        Creates a GroupedExpertLayer with the weights of a list of
+        ExpertLayers.
+        """
+        d_model, d_hidden = experts[0].htoh4.weight.shape
+        layer = cls(len(experts), d_model, d_hidden)
+        with paddle.no_grad():
+            for name in ["htoh4", "h4toh"]:
+                getattr(layer, name + "_weight").set_value(
+                    paddle.stack([
+                        getattr(expert, name).weight for expert in experts
+                    ]))
+                getattr(layer, name + "_bias").set_value(
+                    paddle.stack([
+                        getattr(expert, name).bias for expert in experts
+                    ]).unsqueeze(1))
+        return layer
+
+    def grouped_forward(self, x):
+        x = paddle.bmm(x, self.htoh4_weight) + self.htoh4_bias
+        x = F.gelu(x, approximate=True)
+        x = paddle.bmm(x, self.h4toh_weight) + self.h4toh_bias
+        return x
+
+
 class MultiHeadAttention(nn.Layer):
     """
     Attention mapps queries and a set of key-value pairs to outputs, and
@@ -75,6 +135,10 @@ class MultiHeadAttention(nn.Layer):
 
     Cache = collections.namedtuple("Cache", ["k", "v"])
     StaticCache = collections.namedtuple("StaticCache", ["k", "v"])
+    # k and v are buffers of [batch_size, num_heads, max_length, head_dim],
+    # only the first seq_len positions are valid.
+    PreallocatedCache = collections.namedtuple("PreallocatedCache",
+                                               ["k", "v", "seq_len"])
 
     def __init__(self,
                  embed_dim,
@@ -133,12 +197,17 @@ class MultiHeadAttention(nn.Layer):
             cache, self.StaticCache
         ), "cache currently does not support the StaticCache type"
 
-        if isinstance(cache, self.Cache):
-            # for decoder self-attention in inference
-            k = tensor.concat([cache.k, k], axis=2)
-            v = tensor.concat([cache.v, v], axis=2)
-        if use_cache is True:
-            cache = self.Cache(k, v)
+        if isinstance(cache, self.PreallocatedCache):
+            # for decoder self-attention in inference, without reallocating
+            # the cache at every step
+            k, v, cache = self._update_preallocated_cache(cache, k, v)
+        else:
+            if isinstance(cache, self.Cache):
+                # for decoder self-attention in inference
+                k = tensor.concat([cache.k, k], axis=2)
+                v = tensor.concat([cache.v, v], axis=2)
+            if use_cache is True:
+                cache = self.Cache(k, v)
 
         return (q, k, v) if use_cache is False else (q, k, v, cache)
 
@@ -159,15 +228,78 @@ class MultiHeadAttention(nn.Layer):
         else:
             k, v = self.compute_kv(key, value)
 
-        if isinstance(cache, self.Cache):
-            # for decoder self-attention in inference
-            k = tensor.concat([cache.k, k], axis=2)
-            v = tensor.concat([cache.v, v], axis=2)
-        if use_cache is True:
-            cache = self.Cache(k, v)
+        if isinstance(cache, self.PreallocatedCache):
+            # for decoder self-attention in inference, without reallocating
+            # the cache at every step
+            k, v, cache = self._update_preallocated_cache(cache, k, v)
+        else:
+            if isinstance(cache, self.Cache):
+                # for decoder self-attention in inference
+                k = tensor.concat([cache.k, k], axis=2)
+                v = tensor.concat([cache.v, v], axis=2)
+            if use_cache is True:
+                cache = self.Cache(k, v)
 
         return (q, k, v) if use_cache is False else (q, k, v, cache)
 
+    def _update_preallocated_cache(self, cache, k, v):
+        """
+        Writes k and v at the current position of the cache in place, and
+        returns the whole buffers for attention, the positions after the
+        valid ones are masked out by `mask_preallocated_cache`, so the valid
+        part is never copied out of the buffers.
+
+        seq_len can also be a tensor of [batch_size] when every row is at its
+        own position, e.g. in continuous batching or speculative sampling.
+        Then k and v are written after the position of every row, and the
+        attention mask of the whole buffers is given by the caller.
+        """
+        if isinstance(cache.seq_len, paddle.Tensor):
+            index = cache.seq_len.reshape([-1, 1, 1, 1]) + paddle.arange(
+                k.shape[2], dtype=cache.seq_len.dtype).reshape([1, 1, -1, 1])
+            index = paddle.expand(index, k.shape)
+            cache.k.put_along_axis_(index, k, 2)
+            cache.v.put_along_axis_(index, v, 2)
+            return (cache.k, cache.v, self.PreallocatedCache(
+                cache.k, cache.v, cache.seq_len + k.shape[2]))
+
+        seq_len = cache.seq_len + k.shape[2]
+        assert seq_len <= cache.k.shape[2], \
+            "the length {} exceeds the preallocated cache length {}".format(
+                seq_len, cache.k.shape[2])
+        cache.k[:, :, cache.seq_len:seq_len, :] = k
+        cache.v[:, :, cache.seq_len:seq_len, :] = v
+        return (cache.k, cache.v,
+                self.PreallocatedCache(cache.k, cache.v, seq_len))
+
+    @classmethod
+    def mask_preallocated_cache(cls, attn_mask, cache, length):
+        """
+        Extends attn_mask of the valid positions of a preallocated cache,
+        with length new tokens written, to the whole buffers by masking out
+        the positions after them. attn_mask is returned as it is for the
+        other caches.
+        """
+        if not isinstance(cache, cls.PreallocatedCache) or \
+                isinstance(cache.seq_len, paddle.Tensor):
+            return attn_mask
+        seq_len = cache.seq_len + length
+        max_length = cache.k.shape[2]
+        if seq_len == max_length:
+            return attn_mask
+        if attn_mask is not None and attn_mask.shape[-1] == seq_len:
+            pad = paddle.full(
+                attn_mask.shape[:-1] + [max_length - seq_len],
+                -1e4,
+                dtype=attn_mask.dtype)
+            return paddle.concat([attn_mask, pad], axis=-1)
+
+        # attn_mask is broadcast over the positions of the cache.
+        dtype = attn_mask.dtype if attn_mask is not None else \
+            paddle.get_default_dtype()
+        mask = (paddle.arange(max_length) >= seq_len).astype(dtype) * -1e4
+        return mask if attn_mask is None else attn_mask + mask
+
     def compute_kv(self, key, value):
         r"""
         Applies linear projection on input keys and values, then splits heads
@@ -412,6 +544,11 @@ class TransformerDecoderLayer(nn.Layer):
             self.top_k = moe_configs.get('top_k', 2)
             self.num_experts = moe_configs.get('num_experts', 1)
             self.expert_mode = moe_configs.get('expert_mode', False)
+            self.grouped_experts = moe_configs.get('grouped_experts', False)
+            self.grouped_capacity = moe_configs.get('grouped_capacity', None)
+            self.padded_dispatch = moe_configs.get('padded_dispatch', False)
+            self.capacity = moe_configs.get('capacity', None)
+            self.a2a_chunks = moe_configs.get('a2a_chunks', 1)
 
         weight_attrs = _convert_param_attr_to_list(weight_attr, 3)
         bias_attrs = _convert_param_attr_to_list(bias_attr, 3)
@@ -431,17 +568,25 @@ class TransformerDecoderLayer(nn.Layer):
             do_recompute=do_recompute)
 
         if self.expert_mode:
-            experts_list = nn.LayerList([
-                ExpertLayer(d_model, dim_feedforward)
-                for e in range(self.num_experts)
-            ])
+            if self.grouped_experts:
+                experts_list = GroupedExpertLayer(self.num_experts, d_model,
+                                                  dim_feedforward)
+            else:
+                experts_list = nn.LayerList([
+                    ExpertLayer(d_model, dim_feedforward)
+                    for e in range(self.num_experts)
+                ])
 
             self.moe_mlp = MoELayer(
                 d_model=d_model,
                 experts=experts_list,
                 gate=self.gate,
                 top_k=self.top_k,
-                recompute_interval=int(self.use_recompute))
+                recompute_interval=int(self.use_recompute),
+                padded_dispatch=self.padded_dispatch,
+                capacity=self.capacity,
+                a2a_chunks=self.a2a_chunks,
+                grouped_capacity=self.grouped_capacity)
         else:
             self.linear1 = Linear(
                 d_model,
@@ -618,7 +763,8 @@ class GPTModel(nn.Layer):
         if position_ids is None:
             past_length = 0
             if cache is not None:
-                past_length = paddle.shape(attention_mask)[-1] - 1
+                past_length = paddle.shape(attention_mask)[-1] - paddle.shape(
+                    input_ids)[-1]
             position_ids = paddle.arange(
                 past_length,
                 paddle.shape(input_ids)[-1] + past_length,
@@ -631,18 +777,32 @@ class GPTModel(nn.Layer):
             input_ids=input_ids, position_ids=position_ids)
 
         if self.training == False:
-            # TODO, use registered buffer
-            causal_mask = paddle.tensor.triu(
-                paddle.ones(
-                    (paddle.shape(input_ids)[-1], paddle.shape(input_ids)[-1]))
-                * -1e4,
-                diagonal=1)
+            if cache is not None and attention_mask is not None and \
+                    input_ids.shape[-1] > 1 and paddle.in_dynamic_mode():
+                # Several new tokens after the cache, e.g. the draft tokens
+                # verified by speculative decoding, attend to the whole cache
+                # and causally to each other.
+                length = input_ids.shape[-1]
+                total_length = attention_mask.shape[-1]
+                causal_mask = paddle.tensor.triu(
+                    paddle.ones((length, total_length)) * -1e4,
+                    diagonal=total_length - length + 1)
+            else:
+                # TODO, use registered buffer
+                causal_mask = paddle.tensor.triu(
+                    paddle.ones((paddle.shape(input_ids)[-1],
+                                 paddle.shape(input_ids)[-1])) * -1e4,
+                    diagonal=1)
             if attention_mask is not None:
                 if len(attention_mask.shape) == 2:
                     attention_mask = attention_mask[:, None, None, :]
                 attention_mask = attention_mask + causal_mask
             else:
                 attention_mask = causal_mask
+            if cache is not None:
+                # The preallocated cache is attended as a whole.
+                attention_mask = MultiHeadAttention.mask_preallocated_cache(
+                    attention_mask, cache[0], input_ids.shape[-1])
             # The tensor returned by triu not in static graph.
             attention_mask.stop_gradient = True
 
@@ -785,12 +945,16 @@ class GPTForGeneration(nn.Layer):
     Args:
         gpt (:class:`GPTModel`):
             An instance of :class:`GPTModel`.
+        draft_gpt (:class:`GPTModel`, optional):
+            A smaller model with the same vocab, which proposes the tokens
+            for speculative sampling.
 
     """
 
-    def __init__(self, gpt, configs):
+    def __init__(self, gpt, configs, draft_gpt=None):
         super(GPTForGeneration, self).__init__()
         self.gpt = gpt
+        self.draft_gpt = draft_gpt
         self.configs = configs
 
         self.max_length = self.configs.get('max_dec_len', 20)
@@ -816,6 +980,21 @@ class GPTForGeneration(nn.Layer):
         self.num_return_sequences = self.configs.get('num_return_sequences', 1)
         self.diversity_rate = self.configs.get('diversity_rate', 0.0)
         self.use_cache = self.configs.get('use_cache', True)
+        self.use_preallocated_cache = self.configs.get('preallocate_cache',
+                                                       True)
+        self.use_fused_sampling = self.configs.get('fused_sampling', True)
+        self.num_draft_tokens = self.configs.get('num_draft_tokens', 4)
+        # The keys and values of the prompt prefixes shared by the calls.
+        prefix_cache_mb = self.configs.get('prefix_cache_mb', 0)
+        self.prefix_cache = PrefixCache(
+            int(prefix_cache_mb * 1024 * 1024),
+            block_size=self.configs.get('prefix_cache_block_size', 16)
+        ) if prefix_cache_mb > 0 else None
+        # The preallocated cache buffers, reused by the following calls.
+        self._cache_buffers = None
+        # The acceptance rate and tokens per target forward of the last call
+        # of speculative sampling.
+        self.speculative_stats = None
 
     def prepare_input_ids_for_generation(self,
                                          bos_token_id,
@@ -928,6 +1107,121 @@ class GPTForGeneration(nn.Layer):
 
         return input_ids, model_kwargs
 
+    def build_preallocated_cache(self, cache, max_length):
+        """
+        Copies the cache of the prompt into buffers of max_length, so that
+        the following steps write their keys and values in place instead of
+        concatenating the whole cache at every step. The buffers are kept
+        and reused as long as the batch size and dtype are the same and
+        they are long enough.
+        """
+        batch_size, num_heads, seq_len, head_dim = cache[0].k.shape
+        dtype = cache[0].k.dtype
+
+        buffers = self._cache_buffers
+        if buffers is None or len(buffers) != len(cache) or \
+                buffers[0][0].shape[0] != batch_size or \
+                buffers[0][0].shape[2] < max_length or \
+                buffers[0][0].dtype != dtype:
+            # Release the old buffers before allocating the new ones.
+            self._cache_buffers = buffers = None
+            shape = [batch_size, num_heads, max_length, head_dim]
+            buffers = [(paddle.zeros(
+                shape, dtype=dtype), paddle.zeros(
+                    shape, dtype=dtype)) for _ in cache]
+            self._cache_buffers = buffers
+
+        preallocated_cache = []
+        for (k, v), layer_cache in zip(buffers, cache):
+            k[:, :, :seq_len, :] = layer_cache.k
+            v[:, :, :seq_len, :] = layer_cache.v
+            preallocated_cache.append(
+                MultiHeadAttention.PreallocatedCache(k, v, seq_len))
+        return preallocated_cache
+
+    def is_padded(self, attention_mask):
+        """
+        Whether any token is masked out by attention_mask, which is either
+        the 2D int mask or the additive float mask.
+        """
+        if attention_mask is None:
+            return False
+        if len(attention_mask.shape) == 4:
+            attention_mask = attention_mask[:, 0, -1, :]
+        if "float" in convert_dtype(attention_mask.dtype):
+            return bool(paddle.any(attention_mask < -1.0))
+        return bool(paddle.any(attention_mask.astype("int64") == 0))
+
+    def prefill_with_prefix_cache(self, input_ids, position_ids=None):
+        """
+        Runs the forward of the prompts without padding, the longest prefix
+        of them found in the prefix cache is reused and only the tokens
+        after it are computed. The full blocks of the prompts are stored
+        into the prefix cache for the following calls.
+
+        Returns:
+            tuple: the hidden states of the computed tokens and the cache of
+                the whole prompts.
+        """
+        batch_size, seq_len = input_ids.shape
+        token_ids = input_ids.numpy().tolist()
+        # At least the last token is computed for its logits.
+        prefixes = [
+            self.prefix_cache.get(ids, seq_len - 1) for ids in token_ids
+        ]
+        length = min(prefix_length for prefix_length, _ in prefixes)
+
+        if length == 0:
+            hidden_states, cache = self.gpt(input_ids,
+                                            position_ids=position_ids,
+                                            use_cache=True)
+        else:
+            cache = [
+                MultiHeadAttention.Cache(
+                    paddle.concat([
+                        prefix[i][0][:, :, :length, :]
+                        for _, prefix in prefixes
+                    ]),
+                    paddle.concat([
+                        prefix[i][1][:, :, :length, :]
+                        for _, prefix in prefixes
+                    ])) for i in range(len(prefixes[0][1]))
+            ]
+            if position_ids is None:
+                position_ids = paddle.arange(
+                    seq_len, dtype="int64").unsqueeze(0).expand_as(input_ids)
+            hidden_states, cache = self.gpt(
+                input_ids[:, length:],
+                position_ids=position_ids[:, length:],
+                attention_mask=paddle.zeros(
+                    [batch_size, seq_len], dtype=paddle.get_default_dtype()),
+                use_cache=True,
+                cache=cache)
+
+        for row, ids in enumerate(token_ids):
+            self.prefix_cache.put(ids, cache, row)
+        return hidden_states, cache
+
+    def gather_rows(self, index, input_ids, model_kwargs):
+        """
+        Keeps the rows of index of the batch in the inputs and the cache.
+        """
+        input_ids = paddle.gather(input_ids, index)
+        for name in [
+                "attention_mask", "position_ids", "token_type_ids", "role_ids"
+        ]:
+            if model_kwargs.get(name, None) is not None:
+                model_kwargs[name] = paddle.gather(model_kwargs[name], index)
+
+        cache = model_kwargs.get("cache", None)
+        if cache is not None:
+            model_kwargs["cache"] = [
+                type(layer_cache)(paddle.gather(layer_cache.k, index),
+                                  paddle.gather(layer_cache.v, index),
+                                  *layer_cache[2:]) for layer_cache in cache
+            ]
+        return input_ids, model_kwargs
+
     def prepare_inputs_for_generation(self,
                                       input_ids,
                                       use_cache=False,
@@ -1028,6 +1322,8 @@ class GPTForGeneration(nn.Layer):
                top_p=None,
                temperature=None,
                min_tokens_to_keep=1,
+               streamer=None,
+               greedy=False,
                **model_kwargs):
         def TopKProcess(probs, top_k, min_tokens_to_keep):
             top_k = min(max(top_k, min_tokens_to_keep), probs.shape[-1])
@@ -1069,6 +1365,13 @@ class GPTForGeneration(nn.Layer):
         batch_size, cur_len = input_ids.shape
         origin_len = input_ids.shape[1]
         unfinished_flag = paddle.full([batch_size, 1], True, dtype='bool')
+        # The index of every row in the original batch. The finished rows are
+        # dropped from the batch in dynamic mode, so that the following steps
+        # only compute the unfinished ones.
+        rows = paddle.arange(batch_size, dtype='int64')
+        drop_finished_rows = paddle.in_dynamic_mode() and \
+            eos_token_id is not None and pad_token_id is not None
+        finished_outputs = []
         scores = paddle.full(
             [batch_size, 1], 0.0, dtype=paddle.get_default_dtype())
 
@@ -1099,16 +1402,23 @@ class GPTForGeneration(nn.Layer):
             logits = logits_processors(input_ids, logits)
 
             # sample
-            origin_probs = F.softmax(logits)
-            origin_probs = paddle.log(origin_probs)
-            if temperature is not None and temperature != 1.0:
-                logits = logits / temperature
-            probs = F.softmax(logits)
-            if top_k is not None and top_k != 0:
-                probs = TopKProcess(probs, top_k, min_tokens_to_keep)
-            if top_p is not None and top_p < 1.0:
-                probs = TopPProcess(probs, top_p, min_tokens_to_keep)
-            next_tokens = paddle.multinomial(probs)
+            origin_probs = F.log_softmax(logits)
+            if greedy:
+                next_tokens = paddle.argmax(logits, axis=-1, keepdim=True)
+            elif self.use_fused_sampling:
+                if temperature is not None and temperature != 1.0:
+                    logits = logits / temperature
+                next_tokens = top_k_top_p_sampling(logits, top_k, top_p,
+                                                   min_tokens_to_keep)
+            else:
+                if temperature is not None and temperature != 1.0:
+                    logits = logits / temperature
+                probs = F.softmax(logits)
+                if top_k is not None and top_k != 0:
+                    probs = TopKProcess(probs, top_k, min_tokens_to_keep)
+                if top_p is not None and top_p < 1.0:
+                    probs = TopPProcess(probs, top_p, min_tokens_to_keep)
+                next_tokens = paddle.multinomial(probs)
 
             next_scores = paddle.index_sample(origin_probs, next_tokens)
 
@@ -1117,6 +1427,11 @@ class GPTForGeneration(nn.Layer):
                     unfinished_flag, next_tokens,
                     paddle.full_like(next_tokens, pad_token_id))
 
+            # Hand the new tokens out as soon as they are sampled, the
+            # finished sequences have unfinished_flag False.
+            if streamer is not None:
+                streamer(next_tokens, unfinished_flag, rows)
+
             scores = self.update_scores_for_generation(
                 scores, next_scores, cur_len - origin_len, unfinished_flag)
 
@@ -1135,7 +1450,15 @@ class GPTForGeneration(nn.Layer):
 
         # Note(GuoxiaWang):Pre-while call for inference, simulate a do while loop statement
         # the value in model_kwargs should be tensor before while loop
-        outputs = _forward_(**model_kwargs)
+        if self.prefix_cache is not None and immutable['use_cache'] and \
+                paddle.in_dynamic_mode() and \
+                model_kwargs.get('cache', None) is None and \
+                not self.is_padded(model_kwargs.get('attention_mask', None)):
+            # Only the tokens after the longest cached prefix are computed.
+            outputs = self.prefill_with_prefix_cache(
+                input_ids, model_kwargs.get('position_ids', None))
+        else:
+            outputs = _forward_(**model_kwargs)
 
         input_ids, scores, unfinished_flag, model_kwargs = _post_process_(
             outputs, input_ids, cur_len, origin_len, scores, unfinished_flag,
@@ -1148,7 +1471,32 @@ class GPTForGeneration(nn.Layer):
             attn_mask, paddle.shape(attn_mask))
         model_kwargs['cache'] = outputs[1] if isinstance(outputs,
                                                          tuple) else None
+        # The preallocated cache is written in place, which is only for
+        # dynamic mode.
+        if self.use_preallocated_cache and paddle.in_dynamic_mode() and \
+                model_kwargs['cache'] is not None:
+            model_kwargs['cache'] = self.build_preallocated_cache(
+                model_kwargs['cache'], max_length)
         while cur_len < max_length:
+            if drop_finished_rows:
+                keep = paddle.nonzero(unfinished_flag[:, 0]).reshape([-1])
+                if keep.shape[0] == 0:
+                    break
+                if keep.shape[0] < rows.shape[0]:
+                    finished = paddle.nonzero(
+                        paddle.logical_not(unfinished_flag[:, 0])).reshape(
+                            [-1])
+                    finished_outputs.append(
+                        (paddle.gather(rows, finished), paddle.gather(
+                            input_ids[:, origin_len:], finished),
+                         paddle.gather(scores, finished)))
+                    rows = paddle.gather(rows, keep)
+                    scores = paddle.gather(scores, keep)
+                    input_ids, model_kwargs = self.gather_rows(
+                        keep, input_ids, model_kwargs)
+                    unfinished_flag = paddle.full(
+                        [keep.shape[0], 1], True, dtype='bool')
+
             # Note(GuoxiaWang): Remove outputs = _forward_(**model_kwargs) 
             # and change it to pass directly to _post_process_ to avoid 
             # closed-loop problem of dynamic-to-static model
@@ -1160,10 +1508,548 @@ class GPTForGeneration(nn.Layer):
             if not paddle.any(unfinished_flag):
                 break
 
-        return input_ids[:, origin_len:], scores
+        if not finished_outputs:
+            return input_ids[:, origin_len:], scores
+
+        # Put the dropped rows back and pad them to the same length, which
+        # is the same as generating all the rows until the end.
+        finished_outputs.append((rows, input_ids[:, origin_len:], scores))
+        all_rows, all_ids, all_scores = [], [], []
+        for finished_rows, ids, finished_scores in finished_outputs:
+            all_rows.append(finished_rows)
+            all_ids.append(
+                paddle.concat(
+                    [
+                        ids, paddle.full(
+                            [ids.shape[0], cur_len - origin_len - ids.shape[1]],
+                            pad_token_id,
+                            dtype=ids.dtype)
+                    ],
+                    axis=1))
+            all_scores.append(finished_scores)
+        order = paddle.argsort(paddle.concat(all_rows))
+        return (paddle.gather(paddle.concat(all_ids), order),
+                paddle.gather(paddle.concat(all_scores), order))
+
+    def allocate_cache(self, gpt, batch_size, max_length):
+        """
+        Returns an empty preallocated cache of max_length for gpt.
+        """
+        dtype = gpt.embeddings.word_embeddings.weight.dtype
+        cache = []
+        for layer in gpt.decoder.layers:
+            shape = [
+                batch_size, layer.self_attn.num_heads, max_length,
+                layer.self_attn.head_dim
+            ]
+            cache.append(
+                MultiHeadAttention.PreallocatedCache(
+                    paddle.zeros(
+                        shape, dtype=dtype),
+                    paddle.zeros(
+                        shape, dtype=dtype),
+                    0))
+        return cache
+
+    def forward_with_cache(self, gpt, cache, input_ids, start, length,
+                           attention_mask, position_ids):
+        """
+        Feeds the tokens of [start, start + length) of every row of
+        input_ids after the first start tokens of the row in the
+        preallocated cache, start is a numpy array of [batch_size]. The
+        input_ids, attention_mask and position_ids are of all the tokens.
+        Returns the logits of the fed tokens, the cache is written in place.
+        """
+        offsets = start[:, None] + np.arange(length)[None, :]
+        index = paddle.to_tensor(offsets, dtype="int64")
+        # Every fed token attends to the tokens before it and itself.
+        causal = np.arange(attention_mask.shape[-1])[None, None, :] <= \
+            offsets[:, :, None]
+        attention_mask = paddle.logical_and(
+            paddle.to_tensor(causal),
+            attention_mask.astype("bool").unsqueeze(1))
+        attention_mask = (1.0 - attention_mask.astype(
+            paddle.get_default_dtype()).unsqueeze(1)) * -1e4
+        cache = [
+            type(layer_cache)(layer_cache.k, layer_cache.v,
+                              paddle.to_tensor(
+                                  start, dtype="int64"))
+            for layer_cache in cache
+        ]
+        hidden_states, _ = gpt(paddle.take_along_axis(
+            input_ids, index, axis=1),
+                               position_ids=paddle.take_along_axis(
+                                   position_ids, index, axis=1),
+                               attention_mask=attention_mask,
+                               use_cache=True,
+                               cache=cache)
+        return paddle.matmul(
+            hidden_states,
+            gpt.embeddings.word_embeddings.weight,
+            transpose_y=True)
+
+    def speculative_sampling(self,
+                             input_ids,
+                             logits_processors,
+                             max_length,
+                             pad_token_id,
+                             eos_token_id,
+                             top_k=None,
+                             top_p=None,
+                             temperature=None,
+                             num_draft_tokens=4,
+                             min_tokens_to_keep=1,
+                             streamer=None,
+                             **model_kwargs):
+        """
+        Samples with the draft model proposing num_draft_tokens tokens at
+        every step, and the target model verifying all of them in a single
+        forward. A draft token d is accepted with probability
+        min(1, p(d) / q(d)), where p and q are the distributions of the
+        target and the draft, and the first rejected one is resampled from
+        norm(max(p - q, 0)), so the tokens are distributed exactly as
+        sampling from the target model. If all the draft tokens are
+        accepted, one more token is sampled from the target.
+
+        Every row advances by its own number of accepted tokens. Both
+        models keep a preallocated cache written at the length of every
+        row, so the rejected tokens are dropped by the lengths, and the
+        logits processors see the tokens up to the longest row.
+        """
+        assert paddle.in_dynamic_mode(), \
+            "speculative sampling only supports dynamic mode."
+        batch_size, cur_len = input_ids.shape
+        origin_len = cur_len
+
+        # The 2D int attention mask and position ids of the prompt, extended
+        # for all the tokens to generate.
+        attention_mask = model_kwargs.get("attention_mask", None)
+        if attention_mask is None:
+            attention_mask = paddle.ones_like(input_ids, dtype="int64")
+        else:
+            if len(attention_mask.shape) == 4:
+                attention_mask = attention_mask[:, 0, -1, :]
+            if "float" in convert_dtype(attention_mask.dtype):
+                # The additive mask, 0 for the tokens to attend.
+                attention_mask = attention_mask > -1.0
+            attention_mask = attention_mask.astype("int64")
+        position_ids = model_kwargs.get("position_ids", None)
+        if position_ids is None:
+            position_ids = paddle.arange(
+                cur_len, dtype="int64").unsqueeze(0).expand_as(input_ids)
+        cache_length = max_length + num_draft_tokens + 1
+        extra_length = cache_length - cur_len
+        attention_mask = paddle.concat(
+            [
+                attention_mask, paddle.ones(
+                    [batch_size, extra_length], dtype="int64")
+            ],
+            axis=1)
+        position_ids = paddle.concat(
+            [
+                position_ids, position_ids[:, -1:] + paddle.arange(
+                    1, extra_length + 1, dtype=position_ids.dtype)
+            ],
+            axis=1)
+        # The tokens of every row, the first lens of them are generated.
+        tokens = paddle.concat(
+            [
+                input_ids, paddle.full(
+                    [batch_size, extra_length],
+                    pad_token_id,
+                    dtype=input_ids.dtype)
+            ],
+            axis=1)
+        lens = np.full([batch_size], cur_len, dtype="int64")
+
+        def _probs(logits):
+            if temperature is not None and temperature != 1.0:
+                logits = logits / temperature
+            return top_k_top_p_probs(logits, top_k, top_p, min_tokens_to_keep)
+
+        def _put(tokens, start, values):
+            index = paddle.to_tensor(
+                start[:, None] + np.arange(values.shape[1])[None, :],
+                dtype="int64")
+            return paddle.put_along_axis(tokens, index, values, axis=1)
+
+        # The caches hold all the tokens of every row but the last one,
+        # whose logits are computed by the next forward.
+        target_cache = self.allocate_cache(self.gpt, batch_size, cache_length)
+        draft_cache = self.allocate_cache(self.draft_gpt, batch_size,
+                                          cache_length)
+        if cur_len > 1:
+            for gpt, cache in [(self.gpt, target_cache),
+                               (self.draft_gpt, draft_cache)]:
+                self.forward_with_cache(gpt, cache, tokens,
+                                        np.zeros_like(lens), cur_len - 1,
+                                        attention_mask, position_ids)
+
+        rows = paddle.arange(batch_size, dtype='int64')
+        unfinished = np.ones([batch_size], dtype="bool")
+        score_sums = np.zeros([batch_size], dtype="float64")
+        # The draft cache may miss the last draft token of every row, so
+        # the draft feeds the last two tokens after a step, and one more
+        # for every step without draft tokens.
+        draft_window = 1
+        num_proposed, num_accepted = 0, 0
+        num_generated, num_row_forwards = 0, 0
+
+        while True:
+            active = np.logical_and(unfinished, lens < max_length)
+            if not active.any():
+                break
+            # Leave room for the token sampled from the target.
+            num_draft = min(num_draft_tokens,
+                            int(max_length - lens[active].min()) - 1)
+
+            draft_probs = []
+            for i in range(num_draft):
+                window = draft_window if i == 0 else 1
+                logits = self.forward_with_cache(
+                    self.draft_gpt, draft_cache, tokens,
+                    np.maximum(lens + i - window, 0), window, attention_mask,
+                    position_ids)
+                probs = _probs(
+                    logits_processors(tokens[:, :lens.max() + i],
+                                      logits[:, -1, :]))
+                draft_probs.append(probs)
+                tokens = _put(tokens, lens + i, paddle.multinomial(probs))
+            draft_window = 2 if num_draft > 0 else draft_window + 1
+
+            logits = self.forward_with_cache(self.gpt, target_cache, tokens,
+                                             lens - 1, num_draft + 1,
+                                             attention_mask, position_ids)
+            target_log_probs, target_probs = [], []
+            for i in range(num_draft + 1):
+                step_logits = logits_processors(tokens[:, :lens.max() + i],
+                                                logits[:, i, :])
+                target_log_probs.append(F.log_softmax(step_logits))
+                target_probs.append(_probs(step_logits))
+
+            # The distribution to sample the token after the i leading
+            # accepted draft tokens from.
+            next_probs = []
+            if num_draft > 0:
+                draft_ids = paddle.take_along_axis(
+                    tokens,
+                    paddle.to_tensor(
+                        lens[:, None] + np.arange(num_draft)[None, :],
+                        dtype="int64"),
+                    axis=1)
+                p = paddle.take_along_axis(
+                    paddle.stack(
+                        target_probs[:-1], axis=1),
+                    draft_ids.unsqueeze(-1),
+                    axis=2).squeeze(-1)
+                q = paddle.take_along_axis(
+                    paddle.stack(
+                        draft_probs, axis=1),
+                    draft_ids.unsqueeze(-1),
+                    axis=2).squeeze(-1)
+                # Accept with probability min(1, p / q).
+                accepted = paddle.rand(p.shape, dtype=p.dtype) * q < p
+                # The number of leading accepted tokens of every row.
+                num_leading = paddle.cumprod(
+                    accepted.astype('int64'), dim=1).sum(axis=1)
+                for i in range(num_draft):
+                    residual = paddle.clip(
+                        target_probs[i] - draft_probs[i], min=0.0)
+                    residual_sum = residual.sum(axis=-1, keepdim=True)
+                    next_probs.append(
+                        paddle.where(
+                            residual_sum.expand_as(residual) > 0,
+                            residual / paddle.clip(
+                                residual_sum, min=1e-12),
+                            target_probs[i]))
+            else:
+                draft_ids = paddle.zeros([batch_size, 0], dtype=tokens.dtype)
+                num_leading = paddle.zeros([batch_size], dtype='int64')
+            next_probs.append(target_probs[num_draft])
+            next_probs = paddle.take_along_axis(
+                paddle.stack(
+                    next_probs, axis=1),
+                num_leading.reshape([-1, 1, 1]),
+                axis=1).squeeze(1)
+            next_tokens = paddle.multinomial(next_probs)
+
+            # The new tokens of every row, the leading accepted draft tokens
+            # and the sampled one.
+            position = paddle.arange(num_draft + 1, dtype='int64').unsqueeze(0)
+            new_tokens = paddle.where(
+                position < num_leading.unsqueeze(1),
+                paddle.concat(
+                    [draft_ids, next_tokens.astype(draft_ids.dtype)],
+                    axis=1),
+                next_tokens.astype(draft_ids.dtype).expand(
+                    [batch_size, num_draft + 1]))
+            new_scores = paddle.take_along_axis(
+                paddle.stack(
+                    target_log_probs, axis=1),
+                new_tokens.unsqueeze(-1),
+                axis=2).squeeze(-1)
+            # Read back the step at once.
+            step = paddle.concat(
+                [
+                    new_tokens.astype('float32'), new_scores.astype('float32'),
+                    num_leading.astype('float32').unsqueeze(1)
+                ],
+                axis=1).numpy()
+            new_tokens = step[:, :num_draft + 1].astype("int64")
+            new_scores = step[:, num_draft + 1:-1]
+            num_leading = step[:, -1].astype("int64")
+
+            # The number of new tokens of every row, up to the first eos.
+            num_new = np.where(active,
+                               np.minimum(num_leading + 1, max_length - lens),
+                               0)
+            if eos_token_id is not None:
+                is_eos = np.logical_and(
+                    new_tokens == eos_token_id,
+                    np.arange(num_draft + 1)[None, :] < num_new[:, None])
+                has_eos = is_eos.any(axis=1)
+                num_new = np.where(has_eos, is_eos.argmax(axis=1) + 1,
+                                   num_new)
+                unfinished = np.logical_and(unfinished,
+                                            np.logical_not(has_eos))
+            kept = np.arange(num_draft + 1)[None, :] < num_new[:, None]
+            new_tokens = np.where(kept, new_tokens, pad_token_id)
+            score_sums += np.where(kept, new_scores, 0.0).sum(axis=1)
+
+            if streamer is not None:
+                for i in range(int(num_new.max())):
+                    streamer(
+                        paddle.to_tensor(new_tokens[:, i:i + 1]),
+                        paddle.to_tensor(kept[:, i:i + 1]), rows)
+            tokens = _put(tokens, lens, paddle.to_tensor(new_tokens))
+            lens += num_new
+
+            # The draft tokens kept by every row.
+            num_proposed += num_draft * int(active.sum())
+            num_accepted += int(
+                np.minimum(num_leading, num_new)[active].sum())
+            num_generated += int(num_new.sum())
+            num_row_forwards += int(active.sum())
+
+        self.speculative_stats = {
+            "acceptance_rate": num_accepted / max(num_proposed, 1),
+            "tokens_per_target_forward":
+            num_generated / max(num_row_forwards, 1),
+        }
+        logger.info(
+            "[speculative sampling] acceptance rate: %.4f, tokens per "
+            "target forward: %.4f" %
+            (self.speculative_stats["acceptance_rate"],
+             self.speculative_stats["tokens_per_target_forward"]))
+
+        generated = lens - origin_len
+        end = int(lens.max())
+        ids = tokens[:, origin_len:end]
+        ids = paddle.where(
+            paddle.arange(
+                end - origin_len, dtype='int64').unsqueeze(0) <
+            paddle.to_tensor(generated[:, None]), ids,
+            paddle.full_like(ids, pad_token_id))
+        scores = paddle.to_tensor(
+            (score_sums / np.maximum(generated, 1))[:, None],
+            dtype=paddle.get_default_dtype())
+        return ids, scores
+
+    def greedy_search(self, input_ids, logits_processors, max_length,
+                      pad_token_id, eos_token_id, **model_kwargs):
+        # The same loop as sampling, but takes the most probable token.
+        return self.sample(
+            input_ids,
+            logits_processors,
+            max_length,
+            pad_token_id,
+            eos_token_id,
+            greedy=True,
+            **model_kwargs)
+
+    def beam_search(self,
+                    input_ids,
+                    logits_processors,
+                    max_length,
+                    pad_token_id,
+                    eos_token_id,
+                    num_beams,
+                    num_beam_groups=1,
+                    length_penalty=0.0,
+                    early_stopping=False,
+                    num_return_sequences=1,
+                    **model_kwargs):
+        """
+        Beam search over input_ids of [batch_size * num_beams, seq_len].
+
+        The candidates of all the beams of a batch are selected by a single
+        topk over [batch_size, num_beams * vocab_size], and the cache is
+        reordered by gathering the selected beams. With num_beam_groups > 1,
+        the beams are split into groups searched one after another, and
+        `HammingDiversityLogitsProcessor` penalizes the tokens chosen by the
+        previous groups at the same step. The candidates of a group are read
+        back once a step, and the generated tokens are mirrored on host for
+        the finished hypotheses.
+
+        Returns the generated ids of [batch_size * num_return_sequences,
+        length] and their scores.
+        """
+        batch_beam_size, cur_len = input_ids.shape
+        batch_size = batch_beam_size // num_beams
+        origin_len = cur_len
+        group_size = num_beams // num_beam_groups
+
+        use_cache = model_kwargs.pop('use_cache')
+        beam_hyps = [[
+            BeamHypotheses(group_size, length_penalty, early_stopping)
+            for _ in range(num_beam_groups)
+        ] for _ in range(batch_size)]
+        group_done = np.zeros([batch_size, num_beam_groups], dtype=bool)
+        # Only the first beam of every group is alive at the beginning, so
+        # that the beams do not start with the same tokens.
+        beam_scores = np.full([batch_size, num_beams], -1e9, dtype='float32')
+        beam_scores[:, ::group_size] = 0.0
+        # The generated tokens of every beam mirrored on host, so that the
+        # finished hypotheses are taken without reading back input_ids.
+        generated_ids = np.zeros([batch_beam_size, 0], dtype='int64')
+
+        while cur_len < max_length:
+            model_inputs = self.prepare_inputs_for_generation(
+                input_ids, use_cache=use_cache, **model_kwargs)
+            outputs = self.gpt(**model_inputs, use_cache=use_cache)
+            logits = outputs[0] if isinstance(outputs, tuple) else outputs
+            # [batch_size * num_beams, vocab_size]
+            logits = paddle.matmul(
+                logits[:, -1, :],
+                self.gpt.embeddings.word_embeddings.weight,
+                transpose_y=True)
+            if num_beam_groups == 1:
+                logits = logits_processors(input_ids, logits)
+            log_probs = F.log_softmax(logits.astype('float32'), axis=-1)
+            vocab_size = log_probs.shape[-1]
+
+            next_tokens = np.full(
+                [batch_beam_size],
+                pad_token_id if pad_token_id is not None else 0,
+                dtype='int64')
+            beam_rows = np.arange(batch_beam_size, dtype='int64')
+
+            for group in range(num_beam_groups):
+                group_start = group * group_size
+                group_rows = (
+                    np.arange(batch_size)[:, None] * num_beams + np.arange(
+                        group_start, group_start + group_size)[None, :]
+                ).reshape([-1])
+                if num_beam_groups == 1:
+                    group_log_probs = log_probs
+                else:
+                    index = paddle.to_tensor(group_rows)
+                    group_log_probs = logits_processors(
+                        paddle.gather(input_ids, index),
+                        paddle.gather(log_probs, index),
+                        current_tokens=paddle.to_tensor(next_tokens),
+                        beam_group_idx=group)
+
+                group_scores = group_log_probs + paddle.to_tensor(
+                    beam_scores[:, group_start:group_start + group_size]
+                    .reshape([-1, 1]))
+                topk_scores, topk_ids = paddle.topk(
+                    group_scores.reshape([batch_size, -1]),
+                    k=2 * group_size)
+                # Read back the scores and the ids of the candidates at once.
+                topk = paddle.concat(
+                    [
+                        topk_scores.astype('float64'),
+                        topk_ids.astype('float64')
+                    ],
+                    axis=1).numpy()
+                topk_scores = topk[:, :2 * group_size]
+                topk_ids = topk[:, 2 * group_size:].astype('int64')
+
+                for batch in range(batch_size):
+                    if group_done[batch, group]:
+                        beam_scores[batch, group_start:group_start +
+                                    group_size] = 0.0
+                        continue
+
+                    num_selected = 0
+                    for rank, (score, index) in enumerate(
+                            zip(topk_scores[batch], topk_ids[batch])):
+                        beam, token = divmod(int(index), vocab_size)
+                        row = batch * num_beams + group_start + beam
+                        if eos_token_id is not None and token == eos_token_id:
+                            # Only the candidates within the top group_size
+                            # are finished hypotheses.
+                            if rank < group_size:
+                                beam_hyps[batch][group].add(
+                                    generated_ids[row].tolist() + [token],
+                                    float(score))
+                        else:
+                            out = batch * num_beams + group_start + \
+                                num_selected
+                            next_tokens[out] = token
+                            beam_rows[out] = row
+                            beam_scores[batch, group_start +
+                                        num_selected] = score
+                            num_selected += 1
+                        if num_selected == group_size:
+                            break
+
+                    group_done[batch, group] = beam_hyps[batch][
+                        group].is_done(
+                            float(topk_scores[batch].max()),
+                            cur_len - origin_len + 1)
+
+            generated_ids = np.concatenate(
+                [generated_ids[beam_rows], next_tokens[:, None]], axis=1)
+            # Reorder the inputs and the cache by the selected beams.
+            beam_rows = paddle.to_tensor(beam_rows)
+            model_kwargs = self.update_model_kwargs_for_generation(
+                outputs,
+                model_kwargs,
+                is_encoder_decoder=self.is_encoder_decoder)
+            input_ids, model_kwargs = self.gather_rows(beam_rows, input_ids,
+                                                       model_kwargs)
+            input_ids = paddle.concat(
+                [input_ids, paddle.to_tensor(next_tokens[:, None])], axis=1)
+            cur_len += 1
+
+            if group_done.all():
+                break
+
+        # The running beams of the unfinished sequences are hypotheses too.
+        for batch in range(batch_size):
+            for group in range(num_beam_groups):
+                if group_done[batch, group]:
+                    continue
+                for beam in range(group * group_size,
+                                  (group + 1) * group_size):
+                    beam_hyps[batch][group].add(
+                        generated_ids[batch * num_beams + beam].tolist(),
+                        float(beam_scores[batch, beam]))
+
+        pad = pad_token_id if pad_token_id is not None else eos_token_id
+        best_ids, best_scores = [], []
+        for batch in range(batch_size):
+            hyps = sorted(
+                [hyp for group in beam_hyps[batch] for hyp in group.beams],
+                key=lambda x: x[0],
+                reverse=True)
+            for score, hyp in hyps[:num_return_sequences]:
+                best_ids.append(hyp)
+                best_scores.append([score])
+        max_len = max(len(hyp) for hyp in best_ids)
+        best_ids = [hyp + [pad] * (max_len - len(hyp)) for hyp in best_ids]
+        return (paddle.to_tensor(
+            best_ids, dtype='int64'), paddle.to_tensor(
+                best_scores, dtype=paddle.get_default_dtype()))
 
     def forward(self, input_ids=None, **model_kwargs):
 
+        # streamer(next_tokens, unfinished_flag, rows) is called at every
+        # step, rows is the index of every row in the original batch.
+        streamer = model_kwargs.pop('streamer', None)
+
         max_length = self.max_length
         min_length = self.min_length
         decode_strategy = self.decode_strategy
@@ -1186,8 +2072,11 @@ class GPTForGeneration(nn.Layer):
         use_cache = self.use_cache
 
         assert (
-            decode_strategy in ["greedy_search", "sampling", "beam_search"]
-        ), "`decode_strategy` must be one of 'greedy_search', 'sampling' or 'beam_search' but received {}.".format(
+            decode_strategy in [
+                "greedy_search", "sampling", "beam_search",
+                "speculative_sampling"
+            ]
+        ), "`decode_strategy` must be one of 'greedy_search', 'sampling', 'beam_search' or 'speculative_sampling' but received {}.".format(
             decode_strategy)
 
         bos_token_id = bos_token_id if bos_token_id is not None else getattr(
@@ -1239,9 +2128,79 @@ class GPTForGeneration(nn.Layer):
                     expand_size=num_return_sequences,
                     **model_kwargs)
 
-            ret = self.sample(input_ids, logits_processors, max_length,
-                              pad_token_id, eos_token_id, top_k, top_p,
-                              temperature, **model_kwargs)
+            ret = self.sample(
+                input_ids,
+                logits_processors,
+                max_length,
+                pad_token_id,
+                eos_token_id,
+                top_k,
+                top_p,
+                temperature,
+                streamer=streamer,
+                **model_kwargs)
+        elif decode_strategy == 'speculative_sampling':
+            if self.draft_gpt is None:
+                raise ValueError(
+                    "A draft model is required by speculative sampling.")
+            if num_return_sequences > 1:
+                input_ids, model_kwargs = self.expand_inputs_for_generation(
+                    input_ids,
+                    expand_size=num_return_sequences,
+                    **model_kwargs)
+
+            ret = self.speculative_sampling(
+                input_ids,
+                logits_processors,
+                max_length,
+                pad_token_id,
+                eos_token_id,
+                top_k,
+                top_p,
+                temperature,
+                num_draft_tokens=self.num_draft_tokens,
+                streamer=streamer,
+                **model_kwargs)
+        elif decode_strategy == 'greedy_search' or num_beams == 1:
+            if num_return_sequences > 1:
+                raise ValueError(
+                    "`num_return_sequences` has to be 1, but is {} when doing"
+                    " greedy search.".format(num_return_sequences))
+
+            ret = self.greedy_search(
+                input_ids,
+                logits_processors,
+                max_length,
+                pad_token_id,
+                eos_token_id,
+                streamer=streamer,
+                **model_kwargs)
         else:
-            raise ValueError(f'Not support {decode_strategy} strategy yet!')
+            if num_return_sequences > num_beams:
+                raise ValueError(
+                    "`num_return_sequences` has to be smaller or equal to "
+                    "`num_beams`.")
+            if num_beams % num_beam_groups != 0:
+                raise ValueError(
+                    "`num_beams` should be divisible by `num_beam_groups` for "
+                    "group beam search.")
+            if streamer is not None:
+                raise ValueError("The streamer is not supported in beam "
+                                 "search, as the beams change at every step.")
+
+            input_ids, model_kwargs = self.expand_inputs_for_generation(
+                input_ids, expand_size=num_beams, **model_kwargs)
+
+            ret = self.beam_search(
+                input_ids,
+                logits_processors,
+                max_length,
+                pad_token_id,
+                eos_token_id,
+                num_beams,
+                num_beam_groups=num_beam_groups,
+                length_penalty=length_penalty,
+                early_stopping=early_stopping,
+                num_return_sequences=num_return_sequences,
+                **model_kwargs)
         return ret
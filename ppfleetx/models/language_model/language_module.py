@@ -28,6 +28,8 @@ import ppfleetx.models.language_model.gpt as gpt
 from ppfleetx.models.language_model.gpt.dygraph.sequence_parallel_utils import register_sequence_parallel_allreduce_hooks
 from ppfleetx.distributed.apis import env
 from ppfleetx.utils.log import logger
+from ppfleetx.utils.step_metrics import gpt_flops_per_token
+from ppfleetx.distributed.moe import MoELayer
 import paddleslim
 from .utils import process_configs
 from ppfleetx.data.tokenizers import GPTTokenizer
@@ -136,6 +138,9 @@ class LanguageModule(BasicModule):
         P = 12 * l * h * h * (1 + 13 / (12 * h) + (v + s) / (12 * l * h))
         logger.info('Model Size: {:.2f} B'.format(P / 1000.0 / 1000.0 /
                                                   1000.0))
+        # For the throughput and MFU of Engine.metrics.
+        self.tokens_per_sample = s
+        self.flops_per_sample = s * gpt_flops_per_token(l, h, v, s)
 
     def training_epoch_end(self, log_dict):
         logger.info("[Training] epoch: %d, total time: %.5f sec" %
@@ -212,9 +217,7 @@ class GPTModule(LanguageModule):
 
     def inference_end(self, outputs):
         for k, v in outputs.items():
-            for i in range(v.shape[0]):
-                out_ids = [int(x) for x in v[i]]
-                ret_str = self.tokenizer.decode(out_ids)
+            for ret_str in self.tokenizer.decode_batch(v):
                 # ret_str = text[i] + ret_str
                 print(ret_str)
 
@@ -450,6 +453,9 @@ class GPTFinetuneModule(BasicModule):
         P = 12 * l * h * h * (1 + 13 / (12 * h) + (v + s) / (12 * l * h))
         logger.info('Model Size: {:.2f} B'.format(P / 1000.0 / 1000.0 /
                                                   1000.0))
+        # For the throughput and MFU of Engine.metrics.
+        self.tokens_per_sample = s
+        self.flops_per_sample = s * gpt_flops_per_token(l, h, v, s)
 
     def training_epoch_end(self, log_dict):
         logger.info("[Training] epoch: %d, total time: %.5f sec" %
@@ -502,8 +508,21 @@ class GPTGenerationModule(BasicModule):
         self.tokenizer = tokenizer_class.from_pretrained(pretrained_name)
 
         if self.nranks == 1:
+            draft_gpt = None
+            if self.configs.get('DraftModel', None) is not None:
+                # The draft model shares the settings of the target model
+                # except the ones given in DraftModel, e.g. the sizes.
+                draft_setting = copy.deepcopy(model_setting)
+                draft_setting.update({
+                    k: v
+                    for k, v in self.configs.DraftModel.items()
+                    if k != 'ckpt_dir'
+                })
+                draft_gpt = gpt.GPTModel(**draft_setting)
             model = gpt.GPTForGeneration(
-                gpt.GPTModel(**model_setting), self.generation_cfgs)
+                gpt.GPTModel(**model_setting),
+                self.generation_cfgs,
+                draft_gpt=draft_gpt)
         else:
             assert self.nranks == self.configs.Distributed.dp_degree, \
                 "only support single card and data parallel in generation task."
@@ -551,30 +570,103 @@ class GPTGenerationModule(BasicModule):
 
         return inputs
 
-    def generate(self, input_text):
-        return self(input_text)
+    def generate(self, input_text, batch_size=None, stream_callback=None):
+        """
+        Generates the texts of a prompt or a list of prompts.
+        Args:
+            input_text (str|List[str]): the prompt or prompts.
+            batch_size (int): the number of prompts generated together, all
+                the prompts are in one batch if None.
+            stream_callback (callable): see `get_streamer`, the deltas are of
+                the sequences in the current batch.
+        Returns:
+            List[str]: the prompt followed by the generated text, there are
+                `num_return_sequences` sequences for every prompt.
+        """
+        if isinstance(input_text, str):
+            return self(input_text, stream_callback=stream_callback)
+
+        input_text = list(input_text)
+        batch_size = batch_size or max(len(input_text), 1)
+        generated_sequences = []
+        for start in range(0, len(input_text), batch_size):
+            generated_sequences.extend(
+                self(input_text[start:start + batch_size],
+                     stream_callback=stream_callback))
+        return generated_sequences
+
+    def get_streamer(self, stream_callback, batch_size):
+        """
+        Returns a streamer of GPTForGeneration, it decodes the new tokens of
+        every sequence and calls stream_callback with the list of text deltas
+        whenever there is new text, so that the text can be shown before the
+        whole generation is done.
+        """
+        decoders = [
+            self.tokenizer.stream_decoder(skip_special_tokens=True)
+            for _ in range(batch_size)
+        ]
 
-    def forward(self, input_text):
-        input_ids = self.tokenizer.encode(input_text)
-        inputs = {'input_ids': [input_ids]}
+        def streamer(next_tokens, unfinished_flag, rows):
+            # The finished rows may have been dropped from the batch, rows
+            # is the index of every row in the original batch.
+            deltas = [''] * batch_size
+            for row, tokens, unfinished in zip(rows.numpy(),
+                                               next_tokens.numpy(),
+                                               unfinished_flag.numpy()[:, 0]):
+                if unfinished:
+                    deltas[row] = decoders[row].put(tokens)
+            if any(deltas):
+                stream_callback(deltas)
+
+        def end():
+            deltas = [decoder.end() for decoder in decoders]
+            if any(deltas):
+                stream_callback(deltas)
+
+        return streamer, end
+
+    def forward(self, input_text, stream_callback=None):
+        input_texts = [input_text] if isinstance(input_text,
+                                                 str) else input_text
+        input_ids = self.tokenizer.encode_batch(input_texts)
+        # The prompts are padded on the left, so the attention mask hides
+        # the padding and the position ids start from the first token.
+        inputs = {
+            'input_ids': input_ids,
+            'attention_mask': [[1] * len(ids) for ids in input_ids],
+            'position_ids': [list(range(len(ids))) for ids in input_ids],
+        }
 
         inputs = self.left_padding(inputs, self.tokenizer.eos_token_id)
         input_ids = inputs['input_ids']
 
-        if len(input_ids) == 0:
+        model_kwargs = {}
+        if max(len(ids) for ids in input_ids) == 0:
             input_ids = None
         else:
-            # [1, seq_len]
+            # [batch_size, seq_len]
             input_ids = paddle.to_tensor(input_ids, dtype='int64')
-
-        ids, scores = self.model(input_ids=input_ids)
+            model_kwargs['attention_mask'] = paddle.to_tensor(
+                inputs['attention_mask'], dtype='int64')
+            model_kwargs['position_ids'] = paddle.to_tensor(
+                inputs['position_ids'], dtype='int64')
+
+        num_return_sequences = self.generation_cfgs.get(
+            'num_return_sequences', 1)
+        if stream_callback is None:
+            ids, scores = self.model(input_ids=input_ids, **model_kwargs)
+        else:
+            streamer, end_stream = self.get_streamer(
+                stream_callback, len(input_texts) * num_return_sequences)
+            ids, scores = self.model(
+                input_ids=input_ids, streamer=streamer, **model_kwargs)
+            end_stream()
 
         generated_sequences = []
-        for i, generated_ids in enumerate(ids):
-            generated_ids = generated_ids.numpy().tolist()
-            # Decode text
-            text = self.tokenizer.convert_ids_to_string(generated_ids)
-            sequence = input_text + text
+        # Decode text
+        for i, text in enumerate(self.tokenizer.decode_batch(ids)):
+            sequence = input_texts[i // num_return_sequences] + text
             generated_sequences.append(sequence)
 
         return generated_sequences
@@ -748,6 +840,9 @@ class MoEModule(LanguageModule):
         P = 12 * l * h * h * (1 + 13 / (12 * h) + (v + s) / (12 * l * h))
         logger.info('Model Size: {:.2f} B'.format(P / 1000.0 / 1000.0 /
                                                   1000.0))
+        # For the throughput and MFU of Engine.metrics.
+        self.tokens_per_sample = s
+        self.flops_per_sample = s * gpt_flops_per_token(l, h, v, s)
 
     def training_step(self, batch):
         tokens, position_ids, labels, loss_mask = batch
@@ -779,6 +874,29 @@ class MoEModule(LanguageModule):
 
         return loss
 
+    def training_step_end(self, log_dict):
+        super(MoEModule, self).training_step_end(log_dict)
+
+        # The dispatch statistics of the padded dispatch since the last log.
+        stats = [
+            layer.get_dispatch_stats() for layer in self.model.sublayers()
+            if isinstance(layer, MoELayer)
+        ]
+        stats = [layer_stats for layer_stats in stats if layer_stats]
+        if not stats:
+            return
+        logger.info(
+            "[train] moe drop rate: %.5f, capacity utilization: %.5f, max expert load: %.5f, "
+            "expert load of every layer: %s" %
+            (np.mean([layer_stats['drop_rate'] for layer_stats in stats]),
+             np.mean(
+                 [layer_stats['capacity_utilization']
+                  for layer_stats in stats]),
+             max(layer_stats['expert_load'].max() for layer_stats in stats), [
+                 np.round(layer_stats['expert_load'], 4).tolist()
+                 for layer_stats in stats
+             ]))
+
     def initialize_mp_dp_parameters(self):
         hcg = env.get_hcg()
         mp_group = hcg.get_model_parallel_group()
@@ -0,0 +1,174 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import json
+import queue
+import atexit
+import threading
+
+import paddle
+
+from ppfleetx.utils.log import logger
+
+DONE_FILENAME = "checkpoint.done"
+SAVING_FILENAME = "checkpoint.saving"
+
+
+def save_checkpoint_files(save_dir, files):
+    """
+    Saves every object of files, a dict from file name to the object, into
+    save_dir by `paddle.save`. Every file is written to a temporary file and
+    renamed, and a `checkpoint.done` marker is written at last. A
+    `checkpoint.saving` marker is kept while saving, so an interrupted save
+    is told apart from the checkpoints written before the markers.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    done_filename = os.path.join(save_dir, DONE_FILENAME)
+    saving_filename = os.path.join(save_dir, SAVING_FILENAME)
+    open(saving_filename, "w").close()
+    if os.path.exists(done_filename):
+        os.remove(done_filename)
+
+    for filename, obj in files.items():
+        path = os.path.join(save_dir, filename)
+        tmp_path = "{}.tmp.{}".format(path, os.getpid())
+        try:
+            paddle.save(obj, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    with open(done_filename, "w") as f:
+        json.dump(
+            {
+                "files": sorted(files),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S")
+            }, f)
+    os.remove(saving_filename)
+
+
+def is_checkpoint_done(save_dir):
+    return os.path.isfile(os.path.join(save_dir, DONE_FILENAME))
+
+
+def is_checkpoint_incomplete(save_dir):
+    """
+    Whether the saving of the checkpoint in save_dir was interrupted, i.e.
+    it has the `checkpoint.saving` marker or temporary files left. The
+    checkpoints written before the markers have neither of the markers.
+    """
+    if os.path.isfile(os.path.join(save_dir, SAVING_FILENAME)):
+        return True
+    return os.path.isdir(save_dir) and any(
+        ".tmp." in filename for filename in os.listdir(save_dir))
+
+
+def snapshot_state_dict(state_dict):
+    """
+    Copies the tensors of a (nested) state dict to host memory, pinned
+    memory if the tensor is on GPU, so that training can go on updating
+    them while the copies are being written.
+    """
+    if isinstance(state_dict, paddle.Tensor):
+        if state_dict.place.is_gpu_place():
+            return state_dict._copy_to(paddle.CUDAPinnedPlace(), True)
+        return state_dict.cpu() if not state_dict.place.is_cpu_place() \
+            else state_dict.clone()
+    if isinstance(state_dict, dict):
+        return type(state_dict)(
+            (k, snapshot_state_dict(v)) for k, v in state_dict.items())
+    if isinstance(state_dict, (list, tuple)):
+        return type(state_dict)(snapshot_state_dict(v) for v in state_dict)
+    return state_dict
+
+
+class AsyncCheckpointSaver(object):
+    """
+    Saves checkpoints in a background thread. `save` only takes a snapshot
+    of the state dicts in host memory and returns, the files are written by
+    the thread in order.
+
+    At most max_inflight checkpoints are snapshotted but not yet written,
+    which bounds the host memory, `save` blocks until an earlier one is
+    written when the limit is reached.
+
+    Args:
+        max_inflight (int): the max number of checkpoints being saved.
+    """
+
+    def __init__(self, max_inflight=1):
+        assert max_inflight > 0, "max_inflight should be positive."
+        self.max_inflight = max_inflight
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name="async_checkpoint_saver", daemon=True)
+        self._thread.start()
+        atexit.register(self.wait)
+
+    def save(self, save_dir, files):
+        """
+        Snapshots files, a dict from file name to the state dict, and saves
+        them into save_dir by `save_checkpoint_files` in the background.
+        """
+        self._raise_error()
+        if not self._slots.acquire(blocking=False):
+            start_time = time.time()
+            self._slots.acquire()
+            logger.warning(
+                "Waited %.3f sec for the previous checkpoints to be saved, "
+                "max_inflight is %d." %
+                (time.time() - start_time, self.max_inflight))
+        try:
+            files = {
+                filename: snapshot_state_dict(obj)
+                for filename, obj in files.items()
+            }
+        except Exception:
+            self._slots.release()
+            raise
+        self._queue.put((save_dir, files))
+
+    def wait(self):
+        """
+        Blocks until all the checkpoints are saved.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to save the checkpoint.") from error
+
+    def _run(self):
+        while True:
+            save_dir, files = self._queue.get()
+            try:
+                start_time = time.time()
+                save_checkpoint_files(save_dir, files)
+                logger.info("Saved checkpoint to %s in %.3f sec." %
+                            (save_dir, time.time() - start_time))
+            except Exception as e:
+                logger.warning("Failed to save checkpoint to %s: %s" %
+                               (save_dir, e))
+                self._error = e
+            finally:
+                del files
+                self._slots.release()
+                self._queue.task_done()
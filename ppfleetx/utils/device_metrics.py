@@ -0,0 +1,113 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import threading
+import collections
+
+import paddle
+
+from ppfleetx.utils.log import logger
+
+
+class MetricSnapshot(object):
+    """
+    The sums of the metrics of some steps, still on device until `read`.
+    """
+
+    def __init__(self, names, sums, count):
+        self.names = names
+        self.sums = sums
+        self.count = count
+
+    def read(self):
+        """
+        Copies the sums back to host at once and returns the averages.
+        """
+        if self.count == 0:
+            return {}
+        sums = self.sums.numpy().reshape([-1])
+        return {
+            name: float(value) / self.count
+            for name, value in zip(self.names, sums)
+        }
+
+
+class DeviceMetricAccumulator(object):
+    """
+    Running sums of scalar metrics kept on device, e.g. the losses between
+    two logging steps. `update` only launches an add on device, so no step
+    waits for the device, and the sums are read back by a single copy.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._sums = collections.OrderedDict()
+        self.count = 0
+
+    def update(self, **metrics):
+        for name, value in metrics.items():
+            value = paddle.reshape(value.detach().astype('float32'), [1])
+            if name in self._sums:
+                value = paddle.add(self._sums[name], value)
+            self._sums[name] = value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        Returns a `MetricSnapshot` of the sums and resets the accumulator.
+        """
+        names = list(self._sums.keys())
+        sums = paddle.concat(list(self._sums.values())) if names else None
+        snapshot = MetricSnapshot(names, sums, self.count)
+        self.reset()
+        return snapshot
+
+
+class AsyncLogFlusher(object):
+    """
+    Reads back the metric snapshots and calls the log functions with them
+    in a background thread, in order, so the training loop goes on to the
+    next step without waiting for the device.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="async_log_flusher", daemon=True)
+        self._thread.start()
+
+    def submit(self, snapshot, log_fn):
+        """
+        Calls log_fn with the averages of snapshot in the background.
+        """
+        self._queue.put((snapshot, log_fn))
+
+    def flush(self):
+        """
+        Blocks until all the submitted logs are written.
+        """
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            snapshot, log_fn = self._queue.get()
+            try:
+                log_fn(snapshot.read())
+            except Exception as e:
+                logger.warning("Failed to write the log: {}".format(e))
+            finally:
+                self._queue.task_done()
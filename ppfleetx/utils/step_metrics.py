@@ -0,0 +1,196 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+
+import paddle
+
+from ppfleetx.utils.log import logger
+
+# The dense fp16/bf16 peak TFLOPS of the common devices, used when
+# Engine.metrics.peak_tflops is not set.
+HALF_PEAK_TFLOPS = {
+    "A100": 312.,
+    "A800": 312.,
+    "H100": 989.,
+    "H800": 989.,
+    "V100": 125.,
+    "A10": 125.,
+    "T4": 65.,
+}
+
+
+def gpt_flops_per_token(l, h, v, s):
+    """
+    The training FLOPs of a token of GPT with l layers, hidden size h,
+    vocab size v and sequence length s, i.e. 3 times the forward FLOPs of
+    the matmuls. The recomputed forward is not counted, as MFU counts the
+    FLOPs of the model only.
+    """
+    return 72 * l * h * h * (1 + s / (6. * h) + v / (12. * l * h))
+
+
+def get_peak_tflops():
+    """
+    The fp16/bf16 peak TFLOPS of the current GPU, or None if unknown.
+    """
+    if not paddle.is_compiled_with_cuda():
+        return None
+    name = paddle.device.cuda.get_device_name()
+    for key in sorted(HALF_PEAK_TFLOPS, key=len, reverse=True):
+        if key in name:
+            return HALF_PEAK_TFLOPS[key]
+    return None
+
+
+class JsonlMetricsSink(object):
+    """
+    Appends every step record to a JSON Lines file.
+    """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self._file = open(path, "a")
+
+    def __call__(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class StepMetricsTracker(object):
+    """
+    Times every training step in phases and reports a record of it to the
+    sinks, the callables taking the record dict.
+
+    A step is split into the time waiting for the data loader, which is
+    measured separately from the compute, and the compute phases marked by
+    `end_phase`, e.g. forward_backward and optimizer. Throughput and the
+    FLOPs utilization are derived from the whole step time.
+
+    The phases are timed on host without synchronizing the device unless
+    sync_timing is True. Then the launching time is measured for a phase,
+    while the step time still matches the device once the host is blocked
+    by the device, so use sync_timing to profile the compute phases only.
+
+    Args:
+        samples_per_step (int): the number of samples of all the ranks at a
+            step.
+        tokens_per_sample (int): the number of tokens of a sample.
+        flops_per_sample (float): the training FLOPs of a sample.
+        world_size (int): the number of devices sharing the FLOPs.
+        peak_tflops (float): the peak TFLOPS of a device, MFU is not
+            reported if None.
+        sync_timing (bool): whether to synchronize the device at the end of
+            every phase.
+        sinks (list): the callables to report the records to.
+    """
+
+    def __init__(self,
+                 samples_per_step,
+                 tokens_per_sample=None,
+                 flops_per_sample=None,
+                 world_size=1,
+                 peak_tflops=None,
+                 sync_timing=False,
+                 sinks=None):
+        self.samples_per_step = samples_per_step
+        self.tokens_per_sample = tokens_per_sample
+        self.flops_per_sample = flops_per_sample
+        self.world_size = world_size
+        self.peak_tflops = peak_tflops
+        self.sync_timing = sync_timing and paddle.is_compiled_with_cuda()
+        self.sinks = list(sinks or [])
+
+        self._wait_start = None
+        self._phase_start = None
+        self._phases = {}
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def start_data_wait(self):
+        """
+        Called before fetching the batch of the next step.
+        """
+        self._wait_start = time.time()
+
+    def start_step(self):
+        """
+        Called when the batch of the step is fetched.
+        """
+        now = time.time()
+        if self._wait_start is None:
+            self._wait_start = now
+        self._phases = {"data_wait": now - self._wait_start}
+        self._phase_start = now
+
+    def end_phase(self, name):
+        if self._phase_start is None:
+            return
+        if self.sync_timing:
+            paddle.device.cuda.synchronize()
+        now = time.time()
+        self._phases[name] = self._phases.get(name, 0.) + \
+            now - self._phase_start
+        self._phase_start = now
+
+    def end_step(self, step, epoch=0):
+        """
+        Reports the record of the step to the sinks and returns it.
+        """
+        if self._phase_start is None:
+            return None
+        step_time = self._phase_start - self._wait_start
+        record = {"epoch": epoch, "step": step, "timestamp": time.time()}
+        record.update({
+            "{}_time".format(name): value
+            for name, value in self._phases.items()
+        })
+        record["step_time"] = step_time
+        record["data_wait_ratio"] = self._phases["data_wait"] / max(step_time,
+                                                                    1e-9)
+
+        step_time = max(step_time, 1e-9)
+        record["samples_per_sec"] = self.samples_per_step / step_time
+        if self.tokens_per_sample:
+            record["tokens_per_sec"] = self.samples_per_step * \
+                self.tokens_per_sample / step_time
+        if self.flops_per_sample:
+            tflops = self.samples_per_step * self.flops_per_sample / \
+                self.world_size / step_time / 1e12
+            record["tflops_per_device"] = tflops
+            if self.peak_tflops:
+                record["mfu"] = tflops / self.peak_tflops
+
+        self._phase_start = None
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                logger.warning("Failed to report the step metrics: {}".format(
+                    e))
+        return record
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, "close"):
+                sink.close()
@@ -56,8 +56,39 @@ if __name__ == "__main__":
 
         module.model.set_state_dict(model_dict)
 
-    input_text = 'Hi, GPT2. Tell me who Jack Ma is.'
-    result = module.generate(input_text)
+    draft_ckpt_dir = cfg.get('DraftModel', {}).get('ckpt_dir', None)
+    if draft_ckpt_dir is not None:
+        model_dict = paddle.load(
+            os.path.join(draft_ckpt_dir, "model.pdparams"))
+        # Only the GPTModel of the draft checkpoint is used.
+        draft_dict = {
+            key[len("gpt."):]: value.astype(paddle.float32)
+            for key, value in model_dict.items() if key.startswith("gpt.")
+        }
+        module.model.draft_gpt.set_state_dict(draft_dict)
+
+    input_file = cfg.Generation.get('input_file', None)
+    if input_file is not None:
+        # One prompt per line, generated Generation.batch_size at a time.
+        batch_size = cfg.Generation.get('batch_size', 1)
+        with open(input_file, 'r', encoding='utf-8') as f:
+            prompts = [line.rstrip('\n') for line in f if line.strip()]
+        for start in range(0, len(prompts), batch_size):
+            for result in module.generate(
+                    prompts[start:start + batch_size], batch_size=batch_size):
+                print(f'Generation: {result}')
+        sys.exit(0)
 
+    input_text = 'Hi, GPT2. Tell me who Jack Ma is.'
     print(f'Prompt: {input_text}')
-    print(f'Generation: {result[0]}')
+
+    if cfg.Generation.get('stream', False):
+        # Print the text of the first sequence as soon as it is generated.
+        print(f'Generation: {input_text}', end='', flush=True)
+        result = module.generate(
+            input_text,
+            stream_callback=lambda deltas: print(deltas[0], end='', flush=True))
+        print()
+    else:
+        result = module.generate(input_text)
+        print(f'Generation: {result[0]}')
@@ -0,0 +1,161 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import queue
+import asyncio
+
+import paddle
+import paddle.distributed as dist
+
+__dir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.abspath(os.path.join(__dir__, '../../')))
+
+from ppfleetx.utils import config
+from ppfleetx.utils.log import logger
+from ppfleetx.models import build_module
+from ppfleetx.distributed.apis import env
+from ppfleetx.models.language_model.gpt import (ContinuousBatchingScheduler,
+                                                GenerationRequest)
+
+
+class GenerationServer(object):
+    """
+    A minimal HTTP server for continuous batching generation.
+
+    POST /generate with a json body of {"prompt": str} and optionally
+    "max_dec_len", "top_k", "top_p" and "temperature", the response is
+    {"text": str, "finish_reason": str}. It answers 503 when the waiting
+    queue of the scheduler is full.
+    """
+
+    def __init__(self, scheduler, tokenizer, generation_cfgs):
+        self.scheduler = scheduler
+        self.tokenizer = tokenizer
+        self.generation_cfgs = generation_cfgs
+
+    async def generate(self, body):
+        request = GenerationRequest(
+            self.tokenizer.encode(body["prompt"]),
+            max_dec_len=int(
+                body.get("max_dec_len", self.generation_cfgs.get(
+                    "max_dec_len", 20))),
+            top_k=int(body.get("top_k", self.generation_cfgs.get("top_k", 0))),
+            top_p=float(
+                body.get("top_p", self.generation_cfgs.get("top_p", 1.0))),
+            temperature=float(
+                body.get("temperature",
+                         self.generation_cfgs.get("temperature", 1.0))))
+        request = await self.scheduler.generate(request)
+        if request.error is not None:
+            raise request.error
+        return {
+            "text": self.tokenizer.decode(
+                request.output_ids, skip_special_tokens=True),
+            "finish_reason": request.finish_reason,
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(
+                int(headers.get("content-length", 0)))
+
+            if method != "POST" or path != "/generate":
+                status, result = 404, {"error": "not found"}
+            else:
+                try:
+                    status, result = 200, await self.generate(
+                        json.loads(body))
+                except queue.Full:
+                    status, result = 503, {"error": "server busy"}
+                except (KeyError, ValueError) as e:
+                    status, result = 400, {"error": str(e)}
+        except Exception as e:
+            logger.warning("Failed to handle the request: {}".format(e))
+            status, result = 500, {"error": str(e)}
+
+        data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n"
+            "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, {200: "OK",
+                         400: "Bad Request",
+                         404: "Not Found",
+                         500: "Internal Server Error",
+                         503: "Service Unavailable"}[status],
+                len(data)).encode("latin-1") + data)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info("Serving generation on http://{}:{}/generate".format(
+            host, port))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    args = config.parse_args()
+    cfg = config.get_config(args.config, overrides=args.override, show=False)
+
+    if dist.get_world_size() > 1:
+        env.init_dist_env(cfg)
+
+    env.set_seed(cfg.Global.seed)
+
+    module = build_module(cfg)
+    config.print_config(cfg)
+
+    module.model.eval()
+
+    ckpt_dir = cfg.Engine.save_load.ckpt_dir
+    if ckpt_dir is not None:
+        model_path = os.path.join(ckpt_dir, "model.pdparams")
+        model_dict = paddle.load(model_path)
+
+        for key, value in model_dict.items():
+            model_dict[key] = model_dict[key].astype(paddle.float32)
+
+        module.model.set_state_dict(model_dict)
+
+    serving_cfgs = cfg.get("Serving", {})
+    scheduler = ContinuousBatchingScheduler(
+        module.model,
+        max_batch_size=serving_cfgs.get("max_batch_size", 8),
+        max_length=serving_cfgs.get("max_length",
+                                    cfg.Model.max_position_embeddings),
+        queue_size=serving_cfgs.get("queue_size", 64),
+        eos_token_id=module.tokenizer.eos_token_id)
+    scheduler.start()
+
+    server = GenerationServer(scheduler, module.tokenizer, cfg.Generation)
+    try:
+        asyncio.run(
+            server.serve(
+                serving_cfgs.get("host", "127.0.0.1"),
+                serving_cfgs.get("port", 8018)))
+    finally:
+        scheduler.stop()
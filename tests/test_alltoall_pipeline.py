@@ -0,0 +1,86 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+import numpy as np
+import paddle
+
+from ppfleetx.distributed.moe import comm_ops
+from ppfleetx.models.language_model.gpt.dygraph.single_model import GroupedExpertLayer
+
+
+class _DoneTask(object):
+    def wait(self):
+        pass
+
+
+def _identity_alltoall_async(in_tensor, group=None):
+    # The all-to-all of a single rank.
+    return in_tensor.clone(), _DoneTask()
+
+
+class TestAllToAllPipeline(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        paddle.seed(2022)
+        self.num_expert, self.capacity, self.d_model = 3, 14, 8
+        self.experts = GroupedExpertLayer(self.num_expert, self.d_model, 16)
+        self.x = paddle.randn([1, self.num_expert, self.capacity, self.d_model])
+        self.grad_out = paddle.randn(self.x.shape)
+
+    def _experts_fwd(self, x):
+        world_size, num_expert, capacity, _ = x.shape
+        x = x.transpose([1, 0, 2, 3]).reshape(
+            [num_expert, world_size * capacity, -1])
+        x = self.experts.grouped_forward(x)
+        return x.reshape([num_expert, world_size, capacity,
+                          -1]).transpose([1, 0, 2, 3])
+
+    def _run(self, num_chunks):
+        self.experts.clear_gradients()
+        x = self.x.clone()
+        x.stop_gradient = False
+        with mock.patch.object(comm_ops, "_alltoall_async",
+                               _identity_alltoall_async):
+            if num_chunks == 0:
+                out = self._experts_fwd(x)
+            else:
+                out = comm_ops.AllToAllPipeline.apply(x, self._experts_fwd,
+                                                      num_chunks, None)
+            paddle.autograd.backward([out], [self.grad_out])
+        grads = [param.grad.numpy() for param in self.experts.parameters()]
+        return out.numpy(), x.grad.numpy(), grads
+
+    def test_equal_to_unchunked(self):
+        ref_out, ref_grad, ref_param_grads = self._run(0)
+        # 7 chunks of 2 and more chunks than the capacity.
+        for num_chunks in [1, 2, 3, 7, 20]:
+            out, grad, param_grads = self._run(num_chunks)
+            np.testing.assert_allclose(out, ref_out, rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(grad, ref_grad, rtol=1e-5, atol=1e-6)
+            for param_grad, ref_param_grad in zip(param_grads,
+                                                  ref_param_grads):
+                np.testing.assert_allclose(
+                    param_grad, ref_param_grad, rtol=1e-5, atol=1e-5)
+
+    def test_split_sizes(self):
+        self.assertEqual(comm_ops._split_sizes(14, 3), [5, 5, 4])
+        self.assertEqual(comm_ops._split_sizes(3, 7), [1, 1, 1])
+        self.assertEqual(comm_ops._split_sizes(0, 2), [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import numpy as np
+import paddle
+import paddle.nn.functional as F
+
+from ppfleetx.models.language_model.gpt.dygraph.single_model import GPTModel, GPTForGeneration
+from ppfleetx.models.language_model.gpt.dygraph.processor import BeamHypotheses
+
+EOS_TOKEN_ID = 30
+
+
+class TestBeamSearch(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        paddle.seed(1)
+        self.gpt = GPTModel(
+            vocab_size=32,
+            hidden_size=32,
+            num_layers=2,
+            num_attention_heads=4,
+            ffn_hidden_size=64,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            max_position_embeddings=128)
+        self.gpt.eval()
+
+    def _log_probs(self, input_ids):
+        hidden_states = self.gpt(paddle.to_tensor([input_ids]))
+        logits = paddle.matmul(
+            hidden_states[:, -1, :],
+            self.gpt.embeddings.word_embeddings.weight,
+            transpose_y=True)
+        return F.log_softmax(logits, axis=-1).numpy()[0]
+
+    def _reference(self, input_ids, num_beams, max_dec_len, length_penalty,
+                   early_stopping):
+        """
+        Beam search recomputing every beam without cache, the candidates
+        are ranked by score, then by beam and token.
+        """
+        hyps = BeamHypotheses(num_beams, length_penalty, early_stopping)
+        beams = [(0.0, [])] + [(-1e9, [])] * (num_beams - 1)
+        for step in range(max_dec_len):
+            candidates = []
+            for beam, (score, tokens) in enumerate(beams):
+                log_probs = self._log_probs(input_ids + tokens)
+                candidates.extend((score + log_prob, beam, token)
+                                  for token, log_prob in enumerate(log_probs))
+            candidates.sort(key=lambda x: (-x[0], x[1], x[2]))
+            candidates = candidates[:2 * num_beams]
+            next_beams = []
+            for rank, (score, beam, token) in enumerate(candidates):
+                if token == EOS_TOKEN_ID:
+                    if rank < num_beams:
+                        hyps.add(beams[beam][1] + [token], score)
+                else:
+                    next_beams.append((score, beams[beam][1] + [token]))
+                if len(next_beams) == num_beams:
+                    break
+            beams = next_beams
+            if hyps.is_done(candidates[0][0], step + 1):
+                break
+        else:
+            for score, tokens in beams:
+                hyps.add(tokens, score)
+        return sorted(hyps.beams, key=lambda x: -x[0])
+
+    def test_equal_to_reference(self):
+        input_ids = [[1, 2, 3, 4], [7, 8, 9, 10]]
+        num_return_sequences = 2
+        for num_beams, length_penalty, early_stopping, max_dec_len in [
+            (3, 0.0, False, 8), (4, 1.0, False, 6), (2, 0.0, True, 8)
+        ]:
+            model = GPTForGeneration(self.gpt, {
+                "decode_strategy": "beam_search",
+                "num_beams": num_beams,
+                "length_penalty": length_penalty,
+                "early_stopping": early_stopping,
+                "max_dec_len": max_dec_len,
+                "num_return_sequences": num_return_sequences,
+                "eos_token_id": EOS_TOKEN_ID,
+                "pad_token_id": EOS_TOKEN_ID,
+            })
+            model.eval()
+            with paddle.no_grad():
+                ids, scores = model(input_ids=paddle.to_tensor(input_ids))
+                ids, scores = ids.numpy(), scores.numpy()
+                for batch, prompt in enumerate(input_ids):
+                    expected = self._reference(prompt, num_beams,
+                                               max_dec_len, length_penalty,
+                                               early_stopping)
+                    for i in range(num_return_sequences):
+                        row = batch * num_return_sequences + i
+                        score, tokens = expected[i]
+                        self.assertEqual(ids[row, :len(tokens)].tolist(),
+                                         tokens)
+                        np.testing.assert_allclose(
+                            scores[row, 0], score, rtol=1e-4, atol=1e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
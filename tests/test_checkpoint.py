@@ -0,0 +1,101 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import paddle
+
+from ppfleetx.core.engine.eager_engine import EagerEngine
+from ppfleetx.utils import checkpoint
+from ppfleetx.utils.checkpoint import AsyncCheckpointSaver, save_checkpoint_files, is_checkpoint_done, is_checkpoint_incomplete
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        self.save_dir = tempfile.mkdtemp()
+        self.model = paddle.nn.Linear(4, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.save_dir)
+
+    def _load(self):
+        # EagerEngine.load of a single card engine.
+        engine = SimpleNamespace(
+            _ckpt_dir=self.save_dir,
+            _distributed=False,
+            _module=SimpleNamespace(model=self.model),
+            mode="eval")
+        EagerEngine.load(engine)
+
+    def test_save(self):
+        save_checkpoint_files(self.save_dir,
+                              {"model.pdparams": self.model.state_dict()})
+        self.assertTrue(is_checkpoint_done(self.save_dir))
+        self.assertFalse(is_checkpoint_incomplete(self.save_dir))
+        self.assertEqual(
+            sorted(os.listdir(self.save_dir)),
+            [checkpoint.DONE_FILENAME, "model.pdparams"])
+        self._load()
+
+    def test_async_save(self):
+        weight = self.model.weight.numpy()
+        saver = AsyncCheckpointSaver()
+        saver.save(self.save_dir, {"model.pdparams": self.model.state_dict()})
+        # The saved state is the one at the call.
+        with paddle.no_grad():
+            self.model.weight.set_value(self.model.weight + 1.0)
+        saver.wait()
+        self.assertTrue(is_checkpoint_done(self.save_dir))
+        self._load()
+        np.testing.assert_array_equal(self.model.weight.numpy(), weight)
+
+    def test_refuse_interrupted_save(self):
+        save = paddle.save
+
+        def interrupted_save(obj, path):
+            if "model_state.pdopt" in path:
+                raise KeyboardInterrupt
+            save(obj, path)
+
+        with mock.patch.object(checkpoint.paddle, "save", interrupted_save):
+            with self.assertRaises(KeyboardInterrupt):
+                save_checkpoint_files(self.save_dir, {
+                    "model.pdparams": self.model.state_dict(),
+                    "model_state.pdopt": {},
+                })
+        self.assertFalse(is_checkpoint_done(self.save_dir))
+        self.assertTrue(is_checkpoint_incomplete(self.save_dir))
+        self.assertIn(checkpoint.SAVING_FILENAME, os.listdir(self.save_dir))
+        with self.assertRaisesRegex(ValueError, "incomplete"):
+            self._load()
+
+    def test_load_legacy(self):
+        # The checkpoints saved before the markers have neither of them.
+        paddle.save(self.model.state_dict(),
+                    os.path.join(self.save_dir, "model.pdparams"))
+        self.assertFalse(is_checkpoint_done(self.save_dir))
+        self.assertFalse(is_checkpoint_incomplete(self.save_dir))
+        self._load()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import paddle
+
+from ppfleetx.models.language_model.gpt.dygraph.single_model import GPTModel, GPTForGeneration
+from ppfleetx.models.language_model.gpt.dygraph.continuous_batching import ContinuousBatchingScheduler, GenerationRequest
+
+EOS_TOKEN_ID = 31
+
+
+class TestContinuousBatching(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        paddle.seed(2022)
+        self.gpt = GPTModel(
+            vocab_size=64,
+            hidden_size=32,
+            num_layers=2,
+            num_attention_heads=4,
+            ffn_hidden_size=64,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            max_position_embeddings=128)
+        self.gpt.eval()
+
+    def _generate(self, input_ids, max_dec_len):
+        model = GPTForGeneration(self.gpt, {
+            "decode_strategy": "greedy_search",
+            "max_dec_len": max_dec_len,
+            "eos_token_id": EOS_TOKEN_ID,
+            "pad_token_id": EOS_TOKEN_ID,
+        })
+        model.eval()
+        with paddle.no_grad():
+            ids, _ = model(input_ids=paddle.to_tensor([input_ids]))
+        ids = ids.numpy()[0].tolist()
+        if EOS_TOKEN_ID in ids:
+            ids = ids[:ids.index(EOS_TOKEN_ID) + 1]
+        return ids
+
+    def test_greedy_equal_to_generate(self):
+        # More requests of different lengths than the slots, so that the
+        # requests are admitted into the slots freed by the others.
+        prompts = [[5, 6, 7, 8, 9], [1, 2, 5], [10, 11, 12, 40, 41, 42, 43],
+                   [3], [7, 7, 7, 1, 9, 30, 32, 33, 34, 35], [4, 4]]
+        max_dec_lens = [12, 5, 20, 3, 16, 9]
+
+        model = GPTForGeneration(self.gpt, {"eos_token_id": EOS_TOKEN_ID})
+        model.eval()
+        scheduler = ContinuousBatchingScheduler(
+            model, max_batch_size=2, max_length=64, queue_size=8)
+        requests = [
+            GenerationRequest(
+                input_ids, max_dec_len=max_dec_len, temperature=0)
+            for input_ids, max_dec_len in zip(prompts, max_dec_lens)
+        ]
+        for request in requests:
+            scheduler.submit(request)
+        with paddle.no_grad():
+            while scheduler.step():
+                pass
+
+        for request in requests:
+            expected = self._generate(request.input_ids, request.max_dec_len)
+            self.assertEqual(request.output_ids, expected)
+            self.assertEqual(request.finish_reason, "eos"
+                             if expected[-1] == EOS_TOKEN_ID else "length")
+
+
+if __name__ == "__main__":
+    unittest.main()
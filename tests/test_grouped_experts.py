@@ -0,0 +1,137 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import numpy as np
+import paddle
+
+from ppfleetx.distributed.moe.gate import NaiveGate
+from ppfleetx.models.language_model.gpt.dygraph.single_model import ExpertLayer, GroupedExpertLayer
+
+
+def loop_experts_fwd(x, expert_count, experts):
+    """
+    The per-expert loop of `MoELayer` computing the rows sorted by expert.
+    """
+    y = []
+    last_index = 0
+    for idx, count in enumerate(expert_count):
+        if count <= 0:
+            continue
+        y.append(experts[idx](x[last_index:last_index + count]))
+        last_index += count
+    return paddle.concat(y, axis=0)
+
+
+class TestGroupedExperts(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        paddle.seed(2022)
+        self.d_model, self.d_hidden = 8, 16
+        self.expert_count = np.array([3, 0, 7, 1, 4], dtype="int64")
+        self.experts = paddle.nn.LayerList([
+            ExpertLayer(self.d_model, self.d_hidden)
+            for _ in self.expert_count
+        ])
+        for expert in self.experts:
+            for linear in [expert.htoh4, expert.h4toh]:
+                linear.bias.set_value(paddle.randn(linear.bias.shape))
+        self.grouped = GroupedExpertLayer.from_experts(self.experts)
+        self.x = paddle.randn([int(self.expert_count.sum()), self.d_model])
+
+    def _grouped_fwd(self, x, capacity):
+        return self.grouped(x,
+                            paddle.to_tensor(self.expert_count), capacity)
+
+    def test_equal_to_loop(self):
+        x_loop = self.x.clone()
+        x_loop.stop_gradient = False
+        ref = loop_experts_fwd(x_loop, self.expert_count, self.experts)
+        ref.sum().backward()
+
+        x = self.x.clone()
+        x.stop_gradient = False
+        out = self._grouped_fwd(x, int(self.expert_count.max()))
+        out.sum().backward()
+
+        np.testing.assert_allclose(out.numpy(), ref.numpy(), atol=1e-5)
+        np.testing.assert_allclose(
+            x.grad.numpy(), x_loop.grad.numpy(), atol=1e-5)
+        for name in ["htoh4", "h4toh"]:
+            weight_grad = getattr(self.grouped, name + "_weight").grad.numpy()
+            bias_grad = getattr(self.grouped, name + "_bias").grad.numpy()
+            for idx, expert in enumerate(self.experts):
+                linear = getattr(expert, name)
+                if self.expert_count[idx] == 0:
+                    self.assertTrue(np.all(weight_grad[idx] == 0))
+                    continue
+                np.testing.assert_allclose(
+                    weight_grad[idx], linear.weight.grad.numpy(), atol=1e-5)
+                np.testing.assert_allclose(
+                    bias_grad[idx, 0], linear.bias.grad.numpy(), atol=1e-5)
+
+    def test_larger_capacity(self):
+        out = self._grouped_fwd(self.x, int(self.expert_count.max()))
+        padded_out = self._grouped_fwd(self.x, 11)
+        np.testing.assert_allclose(padded_out.numpy(), out.numpy(), atol=1e-6)
+
+    def test_drop_over_capacity(self):
+        capacity = 2
+        ref = loop_experts_fwd(self.x, self.expert_count,
+                               self.experts).numpy()
+        out = self._grouped_fwd(self.x, capacity).numpy()
+
+        positions = np.concatenate(
+            [np.arange(count) for count in self.expert_count])
+        kept = positions < capacity
+        np.testing.assert_allclose(out[kept], ref[kept], atol=1e-5)
+        self.assertTrue(np.all(out[~kept] == 0))
+
+    def test_skewed_gate(self):
+        # A gate routing almost every token to the first expert, the rows
+        # sorted by expert as the dynamic dispatch does.
+        num_tokens, top_k = 32, 2
+        gate = NaiveGate(self.d_model, len(self.expert_count), topk=top_k)
+        gate.gate.bias.set_value(
+            np.array(
+                [8.0, 0.0, 0.0, 0.0, 4.0], dtype="float32"))
+        inp = paddle.randn([num_tokens, self.d_model])
+        _, expert_idx = gate(inp)
+        expert_idx = expert_idx.numpy().reshape([-1])
+        order = np.argsort(expert_idx, kind="stable")
+        x = paddle.gather(
+            inp, paddle.to_tensor(order // top_k, dtype="int64"))
+        expert_count = np.bincount(
+            expert_idx, minlength=len(self.expert_count)).astype("int64")
+        self.assertGreater(expert_count.max(), 2 * num_tokens * top_k /
+                           len(self.expert_count))
+
+        ref = loop_experts_fwd(x, expert_count, self.experts)
+        # The default capacity of MoELayer, the max count, drops nothing.
+        out = self.grouped(x,
+                           paddle.to_tensor(expert_count),
+                           int(expert_count.max()))
+        np.testing.assert_allclose(out.numpy(), ref.numpy(), atol=1e-5)
+
+    def test_empty(self):
+        x = paddle.zeros([0, self.d_model])
+        out = self.grouped(x,
+                           paddle.zeros(
+                               [len(self.expert_count)], dtype="int64"), 4)
+        self.assertEqual(out.shape, [0, self.d_model])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+import numpy as np
+import paddle
+import paddle.distributed as dist
+
+from ppfleetx.distributed.moe import utils
+
+NUM_NODES, LOCAL_SIZE = 2, 2
+
+
+def _gather_alltoall(in_tensor, group=None):
+    # Gloo has no all-to-all, every rank keeps its blocks of the inputs of
+    # all the ranks instead.
+    if isinstance(group, utils.HierarchicalGroup):
+        return utils._hierarchical_alltoall(in_tensor, group)
+    group = dist.collective._get_default_group() if group is None else group
+    tensors = []
+    dist.all_gather(tensors, in_tensor, group=group)
+    return paddle.stack([
+        tensor.reshape([group.nranks, -1])[group.rank] for tensor in tensors
+    ]).reshape(in_tensor.shape)
+
+
+def _check_hierarchical_alltoall():
+    dist.init_parallel_env()
+    group = dist.new_group(list(range(dist.get_world_size())))
+    hierarchical_group = utils.get_hierarchical_group(group, LOCAL_SIZE)
+    assert hierarchical_group.num_nodes == NUM_NODES
+
+    # The blocks of [world_size, num_expert, capacity, d_model] as the
+    # padded dispatch, different on every rank.
+    paddle.seed(2022 + dist.get_rank())
+    x = paddle.randn([group.nranks, 3, 5, 4])
+    with mock.patch.object(utils, "_alltoall", _gather_alltoall):
+        flat = utils._alltoall(x, group=group)
+        hierarchical = utils._alltoall(x, group=hierarchical_group)
+    np.testing.assert_array_equal(hierarchical.numpy(), flat.numpy())
+
+
+class TestHierarchicalAllToAll(unittest.TestCase):
+    def test_equal_to_flat(self):
+        dist.spawn(
+            _check_hierarchical_alltoall,
+            nprocs=NUM_NODES * LOCAL_SIZE,
+            backend="gloo")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import numpy as np
+import paddle
+
+from ppfleetx.models.language_model.gpt.dygraph.single_model import GPTModel, GPTForGeneration
+
+PREFIX = [1, 2, 3, 4, 5, 6, 7, 8, 9, 1]
+
+
+class TestPrefixCache(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        paddle.seed(3)
+        self.gpt = GPTModel(
+            vocab_size=12,
+            hidden_size=32,
+            num_layers=2,
+            num_attention_heads=4,
+            ffn_hidden_size=64,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            max_position_embeddings=128)
+        self.gpt.eval()
+
+    def _build(self, **configs):
+        configs.update({
+            "decode_strategy": "greedy_search",
+            "max_dec_len": 6,
+            "eos_token_id": 11,
+            "pad_token_id": 0,
+        })
+        model = GPTForGeneration(self.gpt, configs)
+        model.eval()
+        return model
+
+    def test_prefill_equal_to_full_prefill(self):
+        model = self._build(prefix_cache_mb=1, prefix_cache_block_size=4)
+        with paddle.no_grad():
+            model.prefill_with_prefix_cache(
+                paddle.to_tensor([PREFIX + [2, 3]]))
+            for input_ids in [
+                    PREFIX + [2, 3, 4], PREFIX + [5], PREFIX[:7] + [3] * 6
+            ]:
+                input_ids = paddle.to_tensor([input_ids])
+                hidden_states, cache = model.prefill_with_prefix_cache(
+                    input_ids)
+                self.assertLess(hidden_states.shape[1], input_ids.shape[1])
+                ref_hidden_states, ref_cache = self.gpt(input_ids,
+                                                        use_cache=True)
+                np.testing.assert_allclose(
+                    hidden_states[:, -1].numpy(),
+                    ref_hidden_states[:, -1].numpy(),
+                    atol=1e-5)
+                for layer_cache, ref_layer_cache in zip(cache, ref_cache):
+                    np.testing.assert_allclose(
+                        layer_cache.k.numpy(),
+                        ref_layer_cache.k.numpy(),
+                        atol=1e-5)
+                    np.testing.assert_allclose(
+                        layer_cache.v.numpy(),
+                        ref_layer_cache.v.numpy(),
+                        atol=1e-5)
+        self.assertGreater(model.prefix_cache.hit_rate, 0)
+
+    def test_generate_equal_to_generate(self):
+        for preallocate_cache in [True, False]:
+            self._check_generate(preallocate_cache)
+
+    def _check_generate(self, preallocate_cache):
+        model = self._build(
+            prefix_cache_mb=1,
+            prefix_cache_block_size=4,
+            preallocate_cache=preallocate_cache)
+        ref_model = self._build(preallocate_cache=preallocate_cache)
+        with paddle.no_grad():
+            # The second round reuses the prefixes of the first one.
+            for _ in range(2):
+                for input_ids in [
+                        PREFIX + [2, 3, 4], PREFIX + [2, 3, 4, 5, 6, 7, 8],
+                    [PREFIX + [2, 3, 4], PREFIX + [7, 7, 7]]
+                ]:
+                    input_ids = paddle.to_tensor(input_ids)
+                    if len(input_ids.shape) == 1:
+                        input_ids = input_ids.unsqueeze(0)
+                    ids, scores = model(input_ids=input_ids)
+                    ref_ids, ref_scores = ref_model(input_ids=input_ids)
+                    np.testing.assert_array_equal(ids.numpy(),
+                                                  ref_ids.numpy())
+                    np.testing.assert_allclose(
+                        scores.numpy(), ref_scores.numpy(), atol=1e-4)
+        self.assertGreater(len(model.prefix_cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+# Copyright (c) 2022 PaddlePaddle Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+
+import numpy as np
+import paddle
+
+from ppfleetx.models.language_model.gpt.dygraph.single_model import GPTModel, GPTForGeneration
+from ppfleetx.models.language_model.gpt.dygraph.processor import top_k_top_p_probs
+
+
+def build_gpt(vocab_size, hidden_size, num_layers):
+    gpt = GPTModel(
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        num_layers=num_layers,
+        num_attention_heads=4,
+        ffn_hidden_size=2 * hidden_size,
+        hidden_dropout_prob=0.0,
+        attention_probs_dropout_prob=0.0,
+        max_position_embeddings=128)
+    gpt.eval()
+    return gpt
+
+
+class TestSpeculativeSampling(unittest.TestCase):
+    def setUp(self):
+        paddle.set_device("cpu")
+        paddle.seed(5)
+
+    def _generate(self, gpt, draft_gpt, input_ids, **configs):
+        model = GPTForGeneration(gpt, configs, draft_gpt=draft_gpt)
+        model.eval()
+        with paddle.no_grad():
+            ids, scores = model(input_ids=paddle.to_tensor(input_ids))
+        return ids.numpy(), scores.numpy(), model
+
+    def test_greedy_equal_to_greedy_search(self):
+        gpt, draft_gpt = build_gpt(16, 32, 2), build_gpt(16, 16, 1)
+        input_ids = np.random.RandomState(0).randint(0, 16, [6, 5])
+        for eos_token_id in [None, 3, 7]:
+            configs = {
+                "max_dec_len": 13,
+                "eos_token_id": eos_token_id,
+                "pad_token_id": 0,
+            }
+            ids, scores, _ = self._generate(
+                gpt, None, input_ids, decode_strategy="greedy_search",
+                **configs)
+            # The rows accept different numbers of draft tokens.
+            for num_draft_tokens in [1, 2, 5]:
+                spec_ids, spec_scores, model = self._generate(
+                    gpt,
+                    draft_gpt,
+                    input_ids,
+                    decode_strategy="speculative_sampling",
+                    top_k=1,
+                    num_draft_tokens=num_draft_tokens,
+                    **configs)
+                np.testing.assert_array_equal(spec_ids, ids)
+                np.testing.assert_allclose(spec_scores, scores, atol=1e-5)
+                self.assertLessEqual(
+                    model.speculative_stats["acceptance_rate"], 1.0)
+
+    def test_self_draft_accepts_all(self):
+        gpt = build_gpt(16, 32, 2)
+        _, _, model = self._generate(
+            gpt,
+            gpt, [[1, 2, 3, 4], [7, 8, 9, 10]],
+            decode_strategy="speculative_sampling",
+            max_dec_len=12,
+            num_draft_tokens=3,
+            eos_token_id=None,
+            pad_token_id=0)
+        self.assertAlmostEqual(model.speculative_stats["acceptance_rate"],
+                               1.0)
+        self.assertAlmostEqual(
+            model.speculative_stats["tokens_per_target_forward"], 4.0)
+
+    def test_distribution(self):
+        vocab_size, num_samples = 6, 20000
+        temperature, top_p = 0.8, 0.9
+        gpt, draft_gpt = build_gpt(vocab_size, 32, 2), build_gpt(vocab_size,
+                                                                 16, 1)
+        prompt = [1, 2]
+        ids, _, _ = self._generate(
+            gpt,
+            draft_gpt, [prompt] * num_samples,
+            decode_strategy="speculative_sampling",
+            max_dec_len=2,
+            num_draft_tokens=3,
+            top_p=top_p,
+            temperature=temperature,
+            eos_token_id=None,
+            pad_token_id=0)
+        freqs = np.bincount(
+            ids[:, 0] * vocab_size + ids[:, 1],
+            minlength=vocab_size * vocab_size) / num_samples
+
+        def probs(input_ids):
+            hidden_states = gpt(paddle.to_tensor(input_ids))
+            logits = paddle.matmul(
+                hidden_states[:, -1, :],
+                gpt.embeddings.word_embeddings.weight,
+                transpose_y=True)
+            return top_k_top_p_probs(logits / temperature, 0, top_p).numpy()
+
+        # The distribution of the first two tokens sampled from the target.
+        with paddle.no_grad():
+            first_probs = probs([prompt])[0]
+            second_probs = probs(
+                [prompt + [token] for token in range(vocab_size)])
+        expected = (first_probs[:, None] * second_probs).reshape([-1])
+        np.testing.assert_allclose(freqs, expected, atol=0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()